@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive z grid (adaptive_z_points) of a caustic with its waist at the
+center of the scan, for several random beams.
+
+    python benchmarks/adaptive_grid.py -r 200000 -n 200 -z 11 -m 41 -s 5
+
+The beam is symmetric about its waist at z = 0, so the grid must be
+symmetric about z = 0 as well: noise in the binned FWHM curves must not
+refine one side only.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+import numpy as np
+import Shadow
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic import adaptive_z_points
+
+
+def synthetic_beam(nrays, seed=0):
+    """
+    Shadow beam of a Gaussian source with its waist at y = 0 (mm, rad).
+    """
+    rng = np.random.default_rng(seed)
+    beam = Shadow.Beam(nrays)
+    rays = beam.rays
+    rays[:, 0] = rng.normal(0, 1e-3, nrays)
+    rays[:, 2] = rng.normal(0, 1e-3, nrays)
+    rays[:, 3] = rng.normal(0, 1e-4, nrays)
+    rays[:, 5] = rng.normal(0, 1e-4, nrays)
+    rays[:, 4] = np.sqrt(1 - rays[:, 3]**2 - rays[:, 5]**2)
+    rays[:, 6] = 1.0
+    rays[:, 9] = 1.0
+    rays[:, 10] = 8000.0
+    rays[:, 11] = np.arange(nrays) + 1
+    return beam
+
+
+if __name__ == '__main__':
+
+    p = optparse.OptionParser()
+    p.add_option('-r', dest='nrays', type='int', default=200000, help='number of rays')
+    p.add_option('-n', dest='nbins', type='int', default=200, help='number of bins in x and y')
+    p.add_option('-z', dest='nz', type='int', default=11, help='number of coarse planes')
+    p.add_option('-m', dest='max_planes', type='int', default=41, help='maximum number of planes')
+    p.add_option('-s', dest='seeds', type='int', default=5, help='number of random beams')
+    (opt, args) = p.parse_args()
+
+    print('{0} rays, {1} x {1} bins, {2} coarse planes in [-50, 50], at most {3} planes\n'.format(opt.nrays, opt.nbins, opt.nz, opt.max_planes))
+
+    n_symmetric = 0
+    for seed in range(opt.seeds):
+        beam = synthetic_beam(opt.nrays, seed)
+        t0 = time.time()
+        z_points = adaptive_z_points(beam, -50.0, 50.0, opt.nz, 1, 3, 23, opt.nbins, opt.nbins, [-0.03, 0.03], [-0.03, 0.03],
+                                     max_planes=opt.max_planes)
+        elapsed = time.time() - t0
+        symmetric = len(z_points) % 2 == 1 and np.allclose(z_points, -z_points[::-1])
+        n_symmetric += symmetric
+        print('seed {0}: {1} planes, finest step {2:.3f}, symmetric: {3} ({4:.2f} s)'.format(seed, len(z_points), np.diff(z_points).min(), symmetric, elapsed))
+        if not symmetric:
+            print('    z = {0}'.format(np.round(z_points, 3).tolist()))
+
+    print('\nsymmetric grids: {0} of {1}'.format(n_symmetric, opt.seeds))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded caustic: shards computed by separate processes into a temporary
+directory, merged, and compared with the caustic of a single run.
+
+    python benchmarks/caustic_shards.py -r 200000 -n 200 -z 201 -s 4
+
+Each process builds the same synthetic Gaussian beam (as a job would load
+the same star.xx file) and writes one shard. The merged file must have the
+same planes and projections as the single run, and the same statistics
+(except the elapsed times) and summary attributes up to rounding: the
+moments are summed over blocks of planes that depend on the z range.
+"""
+
+import multiprocessing
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+import Shadow
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic_batch import run_caustic, merge_shards
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import CausticReader, PLANE_COLUMNS
+
+
+def synthetic_beam(nrays, seed=0):
+    """
+    Shadow beam of a Gaussian source focused at y = 0 (mm, rad).
+    """
+    rng = np.random.default_rng(seed)
+    beam = Shadow.Beam(nrays)
+    rays = beam.rays
+    rays[:, 0] = rng.normal(0, 5e-3, nrays)
+    rays[:, 2] = rng.normal(0, 2e-3, nrays)
+    rays[:, 3] = rng.normal(0, 2e-4, nrays)
+    rays[:, 5] = rng.normal(0, 1e-4, nrays)
+    rays[:, 4] = np.sqrt(1 - rays[:, 3]**2 - rays[:, 5]**2)
+    rays[:, 6] = 1.0
+    rays[:, 9] = 1.0
+    rays[:, 10] = 8000.0
+    rays[:, 11] = np.arange(nrays) + 1
+    return beam
+
+def same(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    if a.dtype.kind in 'fc' and b.dtype.kind in 'fc':
+        if a.shape != b.shape:
+            return False
+        # absolute tolerance from the data: some moments (e.g. the mean) are close to zero
+        scale = np.nanmax(np.abs(a)) if np.any(np.isfinite(a)) else 0.0
+        return np.allclose(a, b, rtol=1e-12, atol=1e-9 * scale, equal_nan=True)
+    return np.array_equal(a, b)
+
+def caustic(filename, opt, shard=None):
+    beam = synthetic_beam(opt.nrays)
+    return run_caustic(filename, beam, -50.0, 50.0, opt.nz, 0.0, 1, 3, 23, opt.nbins, opt.nbins, [-0.03, 0.03], [-0.03, 0.03], shard=shard)
+
+def run_shard(args):
+    filename, opt, shard = args
+    return caustic(filename, opt, shard)
+
+
+if __name__ == '__main__':
+
+    p = optparse.OptionParser()
+    p.add_option('-r', dest='nrays', type='int', default=200000, help='number of rays')
+    p.add_option('-n', dest='nbins', type='int', default=200, help='number of bins in x and y')
+    p.add_option('-z', dest='nz', type='int', default=201, help='number of planes')
+    p.add_option('-s', dest='shards', type='int', default=4, help='number of shards (one process each)')
+    (opt, args) = p.parse_args()
+
+    directory = tempfile.mkdtemp()
+    single = os.path.join(directory, 'single.h5')
+    merged = os.path.join(directory, 'merged.h5')
+    shards = [os.path.join(directory, 'caustic.shard{0}.h5'.format(i)) for i in range(opt.shards)]
+
+    t0 = time.time()
+    caustic(single, opt)
+    t_single = time.time() - t0
+
+    t0 = time.time()
+    with multiprocessing.Pool(opt.shards) as pool:
+        complete = pool.map(run_shard, [(name, opt, (i, opt.shards)) for i, name in enumerate(shards)])
+    t_shards = time.time() - t0
+    if not all(complete):
+        raise RuntimeError('Incomplete shards')
+
+    t0 = time.time()
+    merge_shards(shards, merged)
+    t_merge = time.time() - t0
+
+    with CausticReader(single) as a, CausticReader(merged) as b:
+        same_planes = np.array_equal(a.read_level(1), b.read_level(1))
+        stats_a, stats_b = a.statistics(), b.statistics()
+        same_stats = all(same(stats_a[name], stats_b[name]) for name in PLANE_COLUMNS if name != 'elapsed_time')
+    with h5py.File(single, 'r') as a, h5py.File(merged, 'r') as b:
+        same_projections = np.array_equal(a['histoXZ'][()], b['histoXZ'][()]) and np.array_equal(a['histoYZ'][()], b['histoYZ'][()])
+        keys = [key for key in a.attrs if key not in ['begin time', 'end time']]
+        same_attributes = all(same(a.attrs[key], b.attrs[key]) for key in keys) and set(a.attrs) == set(b.attrs)
+
+    print('{0} planes of {1} x {1} bins, {2} rays, {3} shards ({4})\n'.format(opt.nz, opt.nbins, opt.nrays, opt.shards, directory))
+    print('single run:       {0:.2f} s'.format(t_single))
+    print('shards (parallel): {0:.2f} s'.format(t_shards))
+    print('merge:            {0:.2f} s'.format(t_merge))
+    print('\nsame planes: {0}, statistics: {1}, projections: {2}, attributes: {3}'.format(same_planes, same_stats, same_projections, same_attributes))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Write time, read time and file size of the caustic file for every storage
+option (dtype, codec, shuffle), on a synthetic Gaussian beam.
+
+    python benchmarks/caustic_storage.py -r 200000 -n 400 -z 101
+
+Runs without Shadow: the synthetic beam is propagated with the same formula
+as the FreeSpacePropagator and binned with the caustic histogram kernel.
+"""
+
+import itertools
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import CausticWriter, CausticReader, compression_filters
+from orangecontrib.shadow.lnls.widgets.utility.histogram import histogram2d_stack
+
+
+def synthetic_planes(nrays, nbins, nz, seed=0):
+    """
+    Histograms of a Gaussian beam focused at z = 0, as a (nz, nbins, nbins)
+    array, and the z points (mm).
+    """
+    rng = np.random.default_rng(seed)
+    x0 = rng.normal(0, 5e-3, nrays)
+    y0 = rng.normal(0, 2e-3, nrays)
+    xp = rng.normal(0, 2e-4, nrays)
+    yp = rng.normal(0, 1e-4, nrays)
+    weights = rng.uniform(0.5, 1.0, nrays)
+
+    z_points = np.linspace(-50, 50, nz)
+    planes = np.zeros((nz, nbins, nbins))
+    for i, z in enumerate(z_points):
+        h = x0 + z * xp
+        v = y0 + z * yp
+        planes[i] = histogram2d_stack(h, v, weights, [-0.03, 0.03], [-0.03, 0.03], nbins, nbins)['histogram'][0]
+    return z_points, planes
+
+def run(filename, z_points, planes, **storage):
+    nz, nx, ny = planes.shape
+
+    t0 = time.time()
+    with CausticWriter(filename, z_points, 0.0, 1, 3, 23, nx, ny, [-0.03, 0.03], [-0.03, 0.03], 0,
+                       background=True, **storage) as writer:
+        for plane in planes:
+            writer.append_plane(plane, {'z': 0.0})
+    t_write = time.time() - t0
+
+    t0 = time.time()
+    with CausticReader(filename) as reader:
+        reader.projections()
+    t_read = time.time() - t0
+
+    return t_write, t_read, os.path.getsize(filename)
+
+
+if __name__ == '__main__':
+
+    p = optparse.OptionParser()
+    p.add_option('-r', dest='nrays', type='int', default=200000, help='number of rays')
+    p.add_option('-n', dest='nbins', type='int', default=400, help='number of bins in x and y')
+    p.add_option('-z', dest='nz', type='int', default=101, help='number of planes')
+    (opt, args) = p.parse_args()
+
+    z_points, planes = synthetic_planes(opt.nrays, opt.nbins, opt.nz)
+    raw_size = planes.nbytes
+
+    print('{0} planes of {1} x {1} bins, {2:.1f} MB as float64\n'.format(opt.nz, opt.nbins, raw_size / 1e6))
+    print('{0:>8} {1:>10} {2:>6} {3:>8} {4:>10} {5:>10} {6:>10} {7:>7}'.format('dtype', 'codec', 'level', 'shuffle',
+                                                                            'write (s)', 'read (s)', 'size (MB)', 'ratio'))
+
+    codecs = [('none', 0), ('gzip', 1), ('gzip', 4), ('gzip', 9), ('lzf', 0), ('blosc-lz4', 5)]
+    filename = os.path.join(tempfile.mkdtemp(), 'caustic_storage.h5')
+
+    for dtype, (codec, level), shuffle in itertools.product(['float64', 'float32'], codecs, [False, True]):
+        try:
+            compression_filters(codec, level, shuffle)
+        except ImportError:
+            continue  # hdf5plugin not installed
+        t_write, t_read, size = run(filename, z_points, planes, dtype=dtype, compression=codec, compression_level=level, shuffle=shuffle)
+        print('{0:>8} {1:>10} {2:>6} {3:>8} {4:>10.3f} {5:>10.3f} {6:>10.2f} {7:>7.1f}'.format(dtype, codec, level, str(shuffle),
+                                                                                         t_write, t_read, size / 1e6, raw_size / size))
+    os.remove(filename)
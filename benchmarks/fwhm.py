@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Time and agreement of the batch FWHM (fwhm_stack) against the per-profile
+get_fwhm of the Caustic widget, on noisy Gaussian profiles.
+
+    python benchmarks/fwhm.py -n 400 -z 201 -o 200
+
+fwhm_stack runs the scan of get_fwhm on the same oversampled grid, so the
+two must agree exactly; the benchmark exits with an error otherwise.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from orangecontrib.shadow.lnls.widgets.utility.histogram import fwhm_stack, get_fwhm
+
+
+def synthetic_profiles(nbins, nz, counts=1000, seed=0):
+    """
+    Poisson-noisy Gaussian profiles of random width and center, as a
+    (nz, nbins) array, and the bin centers.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(-1, 1, nbins)
+    sigma = rng.uniform(0.05, 0.3, nz)
+    center = rng.uniform(-0.3, 0.3, nz)
+    profiles = counts * np.exp(-0.5 * np.square((x - center[:, np.newaxis]) / sigma[:, np.newaxis]))
+    return x, rng.poisson(profiles).astype(np.float64)
+
+
+if __name__ == '__main__':
+
+    p = optparse.OptionParser()
+    p.add_option('-n', dest='nbins', type='int', default=400, help='number of bins per profile')
+    p.add_option('-z', dest='nz', type='int', default=201, help='number of profiles')
+    p.add_option('-o', dest='oversampling', type='int', default=200, help='oversampling of get_fwhm')
+    p.add_option('-s', dest='seed', type='int', default=0, help='random seed')
+    (opt, args) = p.parse_args()
+
+    x, profiles = synthetic_profiles(opt.nbins, opt.nz, seed=opt.seed)
+    step = x[1] - x[0]
+
+    t0 = time.time()
+    reference = np.array([get_fwhm(x, profile, oversampling=opt.oversampling)[0] for profile in profiles])
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    fwhm = fwhm_stack(x, profiles, oversampling=opt.oversampling)[0]
+    t_stack = time.time() - t0
+
+    deviation = np.abs(fwhm - reference) / step
+
+    print('{0} profiles of {1} bins\n'.format(opt.nz, opt.nbins))
+    print('get_fwhm (oversampling {0}): {1:.3f} s'.format(opt.oversampling, t_loop))
+    print('fwhm_stack:                  {0:.4f} s ({1:.0f}x)'.format(t_stack, t_loop / t_stack))
+    print('deviation (bins): max {0}, {1} profiles differ'.format(deviation.max(), np.count_nonzero(deviation)))
+
+    if(np.any(fwhm != reference)):
+        sys.exit('fwhm_stack does not match get_fwhm')
@@ -0,0 +1,675 @@
+# -*- coding: utf-8 -*-
+"""
+Computational core of the Caustic widget.
+
+Nothing in this module imports Qt or Orange, so it can be used from worker
+processes without dragging the whole OASYS canvas along.
+"""
+
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+
+import numpy as np
+import Shadow
+from scipy.optimize import curve_fit
+
+from orangecontrib.shadow.lnls.widgets.utility.histogram import histogram1d_stack, histogram2d_stack, marginal_moments
+
+
+#################################################################################
+# Free-space propagation
+#################################################################################
+
+# Shadow columns whose value changes when the beam is propagated in free space.
+# Columns 1 and 3 are handled by the propagator; the others need Shadow's retrace.
+POSITION_COLUMNS = {1: 0, 3: 2}
+Z_DEPENDENT_COLUMNS = (1, 2, 3, 13, 20)
+
+class FreeSpacePropagator(object):
+    """
+    Vectorized replacement of Shadow's beam.retrace() for caustic scans.
+
+    The position, direction and flag columns are read once from the beam, which
+    is left untouched. A ray at transverse position x0 and longitudinal position
+    y0 reaches the plane y = z at
+
+        x(z) = x0 + (z - y0) * vx / vy
+
+    so a whole block of planes is obtained with one broadcasted operation.
+    Blocks are sized so that the propagated coordinates of a block never use
+    more than max_block_bytes.
+    """
+
+    def __init__(self, beam, colh, colv, colref, max_block_bytes=2**26):
+
+        if not self.is_supported(colh, colv, colref):
+            raise ValueError('Columns {0}, {1} (weight {2}) can not be propagated in free space.'.format(colh, colv, colref))
+
+        rays = beam.rays
+        good = rays[:,9] > 0
+
+        y0 = rays[good, 1]
+        vy = rays[good, 4]
+
+        self.nrays = int(np.count_nonzero(good))
+        self.max_block_bytes = max_block_bytes
+        self.h = self._column_terms(beam, rays, good, colh, y0, vy)
+        self.v = self._column_terms(beam, rays, good, colv, y0, vy)
+
+        if(colref == 0):
+            self.weights = np.ones(self.nrays)
+        else:
+            self.weights = beam.getshonecol(colref, nolost=1)
+
+    @staticmethod
+    def is_supported(colh, colv, colref=0):
+        for col in [colh, colv, colref]:
+            if col in Z_DEPENDENT_COLUMNS and col not in POSITION_COLUMNS:
+                return False
+        return colref not in POSITION_COLUMNS
+
+    @staticmethod
+    def _column_terms(beam, rays, good, col, y0, vy):
+        # returns (offset, slope) such that col(z) = offset + z * slope
+        if col in POSITION_COLUMNS:
+            icol = POSITION_COLUMNS[col]
+            slope = rays[good, icol + 3] / vy
+            return rays[good, icol] - y0 * slope, slope
+        return beam.getshonecol(col, nolost=1), None
+
+    @staticmethod
+    def _evaluate(terms, z_block):
+        offset, slope = terms
+        if slope is None:
+            return np.broadcast_to(offset, (len(z_block), len(offset)))
+        return offset[np.newaxis, :] + np.asarray(z_block)[:, np.newaxis] * slope[np.newaxis, :]
+
+    def block_size(self, bytes_per_plane=0):
+        # two float64 coordinates per ray and per plane, plus whatever the
+        # caller stores for each plane (e.g. its histogram); histogram2d_stack
+        # computes its bin indices one plane at a time, so its temporaries do
+        # not grow with the block
+        return max(1, int(self.max_block_bytes // max(1, 16 * self.nrays + bytes_per_plane)))
+
+    def propagate(self, z_block):
+        """
+        Horizontal and vertical coordinates of the good rays at each plane of
+        z_block, as two (len(z_block), nrays) arrays.
+        """
+        return self._evaluate(self.h, z_block), self._evaluate(self.v, z_block)
+
+    def iter_blocks(self, z_points, bytes_per_plane=0):
+        """
+        Yield (z_block, h, v) for consecutive blocks of z_points.
+        """
+        z_points = np.asarray(z_points)
+        nblock = self.block_size(bytes_per_plane)
+        for i in range(0, len(z_points), nblock):
+            z_block = z_points[i:i + nblock]
+            h, v = self.propagate(z_block)
+            yield z_block, h, v
+
+
+def _histo2_tickets(stack):
+    """
+    Split a histogram2d_stack result in one dictionary per plane, with the
+    keys of Shadow's histo2 used by the caustic (including Shadow's FWHM
+    estimate) plus the moments already computed by the kernel.
+    """
+    for i in range(len(stack['histogram'])):
+        ticket = {'histogram': stack['histogram'][i],
+                  'bin_h_edges': stack['bin_h_edges'],
+                  'bin_v_edges': stack['bin_v_edges'],
+                  'bin_h_center': stack['bin_h_center'],
+                  'bin_v_center': stack['bin_v_center'],
+                  'histogram_h': stack['histogram_h'][i],
+                  'histogram_v': stack['histogram_v'][i],
+                  'nbins_h': len(stack['bin_h_center']),
+                  'nbins_v': len(stack['bin_v_center']),
+                  'intensity': stack['intensity'][i],
+                  'mean_h': stack['mean_h'][i],
+                  'mean_v': stack['mean_v'][i],
+                  'rms_h': stack['rms_h'][i],
+                  'rms_v': stack['rms_v'][i]}
+
+        for plane in ['h', 'v']:
+            profile = ticket['histogram_' + plane]
+            center = ticket['bin_' + plane + '_center']
+            above = np.where(profile >= np.max(profile) * 0.5)[0]
+            if(above.size > 1):
+                ticket['fwhm_' + plane] = (center[1] - center[0]) * (above[-1] - above[0])
+                ticket['fwhm_coordinates_' + plane] = (center[above[0]], center[above[-1]])
+            else:
+                ticket['fwhm_' + plane] = None
+
+        yield ticket
+
+def _propagate_and_histo(propagator, z_points, nbinsh, nbinsv, xrange, yrange):
+    for z_block, h, v in propagator.iter_blocks(z_points, bytes_per_plane=8*nbinsh*nbinsv):
+        stack = histogram2d_stack(h, v, propagator.weights, xrange, yrange, nbinsh, nbinsv)
+        for ticket in _histo2_tickets(stack):
+            yield ticket
+
+
+#################################################################################
+# Second-moment (analytic) caustic
+#################################################################################
+
+class SecondMomentCaustic(object):
+    """
+    Closed-form RMS caustic of a beam in free space.
+
+    With x(z) = a + z * s for every ray (see FreeSpacePropagator), the weighted
+    centroid and variance at any plane are
+
+        <x>(z)     = <a> + z <s>
+        sigma²(z)  = <a²> + 2 z <a s> + z² <s²>      (central moments)
+
+    so the second-moment matrix of the good rays, computed once, gives the
+    whole caustic without histograms. The waist is at z0 = -<a s> / <s²>, with
+    size sigma0² = <a²> - <a s>² / <s²>; the emittance is sigma0 * sigma_s and
+    the Rayleigh-like length (beta*) is sigma0 / sigma_s, sigma_s being the
+    RMS divergence.
+
+    RMS values are those of the rays, not of the binned histograms, so they do
+    not depend on the bin size or on the histogram ranges.
+    """
+
+    def __init__(self, beam, colh=1, colv=3, colref=23):
+
+        if(colh not in POSITION_COLUMNS or colv not in POSITION_COLUMNS):
+            raise ValueError('The analytic caustic needs the X and Z position columns (1 and 3), not {0} and {1}.'.format(colh, colv))
+
+        propagator = FreeSpacePropagator(beam, colh, colv, colref)
+        weights = propagator.weights
+
+        self.nrays = propagator.nrays
+        self.intensity = np.sum(weights)
+        self.moments = {'h': self._moments(propagator.h, weights, self.intensity),
+                        'v': self._moments(propagator.v, weights, self.intensity)}
+
+    @staticmethod
+    def _moments(terms, weights, total):
+        # weighted mean of (a, s) and central second-moment matrix
+        a, s = terms
+        mean_a = np.dot(weights, a) / total
+        mean_s = np.dot(weights, s) / total
+        da = a - mean_a
+        ds = s - mean_s
+        return {'mean_a': mean_a,
+                'mean_s': mean_s,
+                'aa': np.dot(weights, da * da) / total,
+                'as': np.dot(weights, da * ds) / total,
+                'ss': np.dot(weights, ds * ds) / total}
+
+    def centroid(self, z, plane='h'):
+        m = self.moments[plane]
+        return m['mean_a'] + np.asarray(z) * m['mean_s']
+
+    def rms(self, z, plane='h'):
+        m = self.moments[plane]
+        z = np.asarray(z)
+        variance = m['aa'] + 2.0 * z * m['as'] + z * z * m['ss']
+        return np.sqrt(np.maximum(variance, 0.0))
+
+    def waist(self, plane='h'):
+        """
+        Dict with the waist position and size, RMS divergence, emittance and
+        Rayleigh-like length of one plane. A collimated beam (no divergence)
+        has no waist: its position is NaN and its Rayleigh length infinite.
+        """
+        m = self.moments[plane]
+        divergence = np.sqrt(m['ss'])
+        if(m['ss'] > 0):
+            z0 = -m['as'] / m['ss']
+            size = np.sqrt(max(m['aa'] - m['as']**2 / m['ss'], 0.0))
+            rayleigh = size / divergence
+        else:
+            z0 = np.nan
+            size = np.sqrt(m['aa'])
+            rayleigh = np.inf
+        return {'z_waist': z0,
+                'rms_waist': size,
+                'center_waist': m['mean_a'] + z0 * m['mean_s'] if np.isfinite(z0) else m['mean_a'],
+                'divergence': divergence,
+                'emittance': size * divergence,
+                'rayleigh': rayleigh}
+
+    def caustic(self, z_points):
+        """
+        Centroid and RMS curves at z_points, with the keys of the caustic
+        file statistics ('z', 'mean_h', 'mean_v', 'rms_h', 'rms_v').
+        """
+        z_points = np.asarray(z_points, dtype=float)
+        return {'z': z_points,
+                'mean_h': self.centroid(z_points, 'h'),
+                'mean_v': self.centroid(z_points, 'v'),
+                'rms_h': self.rms(z_points, 'h'),
+                'rms_v': self.rms(z_points, 'v')}
+
+    def summary(self):
+        """
+        Flat dict of the waist parameters of both planes, e.g. 'z_waist_h',
+        'rms_waist_v', 'rayleigh_h'.
+        """
+        summary = {}
+        for plane in ['h', 'v']:
+            for key, value in self.waist(plane).items():
+                summary[key + '_' + plane] = value
+        return summary
+
+
+#################################################################################
+# Gaussian-beam fits
+#################################################################################
+
+def gaussian_beam(z, s0, z0, beta):
+    return s0*np.sqrt(1 + ((z-z0)/beta)**2)
+
+def beam_quality_factor(emittance, wavelength):
+    """
+    M² of a beam of RMS emittance (size x divergence) at a wavelength in the
+    same length unit: 1 for a Gaussian (diffraction-limited) beam.
+    """
+    return 4.0 * np.pi * np.asarray(emittance) / wavelength
+
+def fit_gaussian_beams(z, curves, masks=None, refine=False):
+    """
+    Fits gaussian_beam(z, s0, z0, beta) to each row of curves.
+
+    s² = s0² + (s0 / beta)² (z - z0)² is a quadratic polynomial of z, so all
+    curves are fitted at once by linear least squares on s², with weights for
+    constant relative errors on s, and the parameters follow in closed form.
+    Their uncertainties are propagated from the covariance of the polynomial
+    coefficients, scaled by the residuals. With refine, each fit is then
+    refined by a nonlinear fit of s (curve_fit) started at that solution.
+
+    Parameters
+    ----------
+    z : array
+        (nz,) positions.
+    curves : array
+        (ncurves, nz) sizes. Points that are NaN or not positive are ignored.
+    masks : array, optional
+        (ncurves, nz) booleans, the points to fit (e.g. the fit z ranges).
+    refine : bool, optional
+
+    Returns
+    -------
+    dict
+        's0', 'z0', 'beta' and their uncertainties 's0_err', 'z0_err',
+        'beta_err', (ncurves,) arrays with beta > 0, and 'valid': False (and
+        parameters NaN) where a curve has fewer than 4 points or is not
+        convex.
+    """
+    z = np.asarray(z, dtype=np.float64)
+    curves = np.atleast_2d(np.asarray(curves, dtype=np.float64))
+    ncurves, nz = curves.shape
+
+    with np.errstate(invalid='ignore'):
+        usable = np.isfinite(curves) & (curves > 0)
+    if masks is not None:
+        usable &= np.broadcast_to(masks, curves.shape)
+    npoints = usable.sum(axis=1)
+    s = np.where(usable, curves, 1.0)
+
+    # centered and scaled z for a well-conditioned normal matrix
+    zc = 0.5 * (z.max() + z.min())
+    zs = 0.5 * (z.max() - z.min()) or 1.0
+    t = (z - zc) / zs
+    A = np.stack([np.ones_like(t), t, t * t], axis=-1)
+
+    # rows of s_i² = a + b t_i + c t_i² divided by s_i² (relative errors)
+    w = np.where(usable, 1.0 / (s * s), 0.0)
+    Aw = w[:, :, np.newaxis] * A[np.newaxis]
+    yw = usable.astype(np.float64)
+
+    results = {key: np.full(ncurves, np.nan) for key in ['s0', 'z0', 'beta', 's0_err', 'z0_err', 'beta_err']}
+    results['valid'] = np.zeros(ncurves, dtype=bool)
+
+    solvable = npoints >= 4
+    if not np.any(solvable):
+        return results
+
+    N = np.einsum('kni,knj->kij', Aw[solvable], Aw[solvable])
+    rhs = np.einsum('kni,kn->ki', Aw[solvable], yw[solvable])
+    p = np.linalg.solve(N, rhs[:, :, np.newaxis])[:, :, 0]
+    residuals = np.einsum('kni,ki->kn', Aw[solvable], p) - yw[solvable]
+    variance = np.sum(residuals**2, axis=1) / (npoints[solvable] - 3)
+    covariance = np.linalg.inv(N) * variance[:, np.newaxis, np.newaxis]
+
+    a, b, c = p.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s0 = np.sqrt(a - b * b / (4 * c))
+        t0 = -b / (2 * c)
+        beta_t = s0 / np.sqrt(c)
+
+        # Jacobian of (s0, t0, beta_t) with respect to (a, b, c)
+        J = np.zeros((len(a), 3, 3))
+        J[:, 0] = np.stack([1 / (2 * s0), -b / (4 * c * s0), b * b / (8 * c * c * s0)], axis=-1)
+        J[:, 1] = np.stack([np.zeros_like(a), -1 / (2 * c), b / (2 * c * c)], axis=-1)
+        J[:, 2] = J[:, 0] / np.sqrt(c)[:, np.newaxis]
+        J[:, 2, 2] -= s0 / (2 * c**1.5)
+        errors = np.sqrt(np.einsum('kij,kjl,kil->ki', J, covariance, J))
+
+    valid = (c > 0) & np.isfinite(s0) & (s0 > 0)
+    idx = np.flatnonzero(solvable)[valid]
+    results['valid'][idx] = True
+    results['s0'][idx] = s0[valid]
+    results['z0'][idx] = zc + zs * t0[valid]
+    results['beta'][idx] = zs * beta_t[valid]
+    results['s0_err'][idx] = errors[valid, 0]
+    results['z0_err'][idx] = zs * errors[valid, 1]
+    results['beta_err'][idx] = zs * errors[valid, 2]
+
+    if refine:
+        for k in idx:
+            used = usable[k]
+            p0 = [results['s0'][k], results['z0'][k], results['beta'][k]]
+            try:
+                popt, pcov = curve_fit(gaussian_beam, z[used], curves[k, used], p0=p0, sigma=curves[k, used], maxfev=2000)
+            except (RuntimeError, ValueError):
+                continue  # keep the linear solution
+            perr = np.sqrt(np.diag(pcov))
+            if np.all(np.isfinite(popt)) and np.all(np.isfinite(perr)):
+                results['s0'][k], results['z0'][k], results['beta'][k] = abs(popt[0]), popt[1], abs(popt[2])
+                results['s0_err'][k], results['z0_err'][k], results['beta_err'][k] = perr
+
+    return results
+
+
+#################################################################################
+# Parallel z-plane execution
+#################################################################################
+
+_worker_beam = None
+_worker_propagator = None
+
+def _init_worker(rays, propagator):
+    # each worker owns a private copy of the rays (or of the propagator
+    # arrays) and retraces it in place
+    global _worker_beam, _worker_propagator
+    _worker_propagator = propagator
+    if propagator is None:
+        _worker_beam = Shadow.Beam()
+        _worker_beam.rays = np.array(rays, copy=True)
+
+def _retrace_and_histo(beam, z, colh, colv, colref, nbinsh, nbinsv, xrange, yrange):
+    beam.retrace(z)
+    return beam.histo2(col_h=colh, col_v=colv, nbins_h=nbinsh, nbins_v=nbinsv, nolost=1, ref=colref, xrange=xrange, yrange=yrange)
+
+def _histo_shard(args):
+    z_shard, colh, colv, colref, nbinsh, nbinsv, xrange, yrange = args
+    if _worker_propagator is not None:
+        return list(_propagate_and_histo(_worker_propagator, z_shard, nbinsh, nbinsv, xrange, yrange))
+    return [_retrace_and_histo(_worker_beam, z, colh, colv, colref, nbinsh, nbinsv, xrange, yrange) for z in z_shard]
+
+def split_z_points(z_points, n_shards):
+    """
+    Split the z grid in contiguous shards, keeping the original order.
+    Empty shards (more shards than planes) are dropped.
+    """
+    n_shards = max(1, min(int(n_shards), len(z_points)))
+    return [shard for shard in np.array_split(np.asarray(z_points), n_shards) if len(shard) > 0]
+
+def iter_caustic_histograms(beam, z_points, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes=1, shards_per_process=4,
+                            shards_in_flight=None):
+    """
+    Yield the Shadow histo2 dictionary of every plane in z_points, in order.
+
+    Whenever the columns allow it the planes are computed by the
+    FreeSpacePropagator; otherwise a copy of the beam is retraced with Shadow.
+    The input beam is never modified.
+
+    With n_processes > 1 the z grid is split in shards that are distributed
+    over a pool of worker processes, each one propagating its own copy of the
+    ray arrays. At most shards_in_flight shards (2 per process by default)
+    are submitted and not yet yielded, so finished histograms never pile up
+    ahead of a slow consumer.
+    """
+    if FreeSpacePropagator.is_supported(colh, colv, colref):
+        propagator = FreeSpacePropagator(beam, colh, colv, colref)
+    else:
+        propagator = None
+
+    if(n_processes <= 1 or len(z_points) < 2):
+        if propagator is not None:
+            for histo in _propagate_and_histo(propagator, z_points, nbinsh, nbinsv, xrange, yrange):
+                yield histo
+        else:
+            beam = beam.duplicate()
+            for z in z_points:
+                yield _retrace_and_histo(beam, z, colh, colv, colref, nbinsh, nbinsv, xrange, yrange)
+        return
+
+    n_processes = min(int(n_processes), len(z_points))
+    shards = split_z_points(z_points, n_processes*shards_per_process)
+    tasks = [(shard, colh, colv, colref, nbinsh, nbinsv, xrange, yrange) for shard in shards]
+    rays = beam.rays if propagator is None else None
+
+    window = max(1, int(shards_in_flight or 2*n_processes))
+
+    with multiprocessing.Pool(processes=n_processes, initializer=_init_worker, initargs=(rays, propagator)) as pool:
+        # results are taken in shard order, so planes can be written as they arrive;
+        # the next shard is submitted only once one has been yielded
+        pending = collections.deque()
+        tasks = iter(tasks)
+        for task in itertools.islice(tasks, window):
+            pending.append(pool.apply_async(_histo_shard, (task,)))
+        while pending:
+            histos = pending.popleft().get()
+            for histo in histos:
+                yield histo
+            del histos
+            for task in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(_histo_shard, (task,)))
+
+def beam_fingerprint(beam):
+    """
+    SHA-1 of the ray array of a Shadow beam. Two beams with the same
+    fingerprint give the same caustic, which is what resuming a run relies on.
+    """
+    return hashlib.sha1(np.ascontiguousarray(beam.rays).tobytes()).hexdigest()
+
+def caustic_cache_key(beam, colh, colv, colref, parameters):
+    """
+    Content key of a caustic scan: hash of the good rays (positions,
+    directions, flag and the histogram and weight columns) and of the scan
+    parameters (a dict of JSON-serializable values: z grid, ranges, bins,
+    storage options...).
+    """
+    rays = beam.rays
+    good = rays[:,9] > 0
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(np.ascontiguousarray(rays[good][:, [0, 1, 2, 3, 4, 5, 9]]).tobytes())
+    for col in [colh, colv, colref]:
+        if(col > 0 and col not in [1, 2, 3, 4, 5, 6, 10]):
+            digest.update(np.ascontiguousarray(beam.getshonecol(col, nolost=1)).tobytes())
+    digest.update(json.dumps([int(colh), int(colv), int(colref), parameters], sort_keys=True).encode())
+    return digest.hexdigest()
+
+def beam_wavelength(beam):
+    """
+    Intensity-weighted mean wavelength of the good rays, in Angstroms, or
+    None when the beam has no good ray.
+    """
+    if beam.nrays(nolost=1) == 0:
+        return None
+    wavelength = beam.getshonecol(19, nolost=1)
+    intensity = beam.getshonecol(23, nolost=1)
+    if not np.sum(intensity) > 0:
+        return float(np.mean(wavelength))
+    return float(np.average(wavelength, weights=intensity))
+
+
+#################################################################################
+# Adaptive z sampling
+#################################################################################
+
+def profile_fwhm(centers, profiles):
+    """
+    Shadow-style FWHM (distance between the outmost bins at or above half
+    maximum) of each profile of a (nplanes, nbins) stack. NaN when fewer than
+    two bins are above half maximum, as in _histo2_tickets.
+    """
+    profiles = np.atleast_2d(profiles)
+    above = profiles >= 0.5 * profiles.max(axis=1)[:, np.newaxis]
+    first = above.argmax(axis=1)
+    last = profiles.shape[1] - 1 - above[:, ::-1].argmax(axis=1)
+    fwhm = (centers[1] - centers[0]) * (last - first)
+    return np.where((last > first) & (profiles.max(axis=1) > 0), fwhm, np.nan)
+
+def caustic_profile_curves(beam, z_points, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes=1, propagator=None):
+    """
+    RMS and FWHM of the horizontal and vertical profiles at every plane of
+    z_points, as a (4, nz) array (rms_h, rms_v, fwhm_h, fwhm_v).
+
+    With the FreeSpacePropagator only the 1D profiles are binned, which is
+    much cheaper than the 2D histograms of a full scan.
+    """
+    if propagator is None and FreeSpacePropagator.is_supported(colh, colv, colref):
+        propagator = FreeSpacePropagator(beam, colh, colv, colref)
+
+    h_centers = np.linspace(xrange[0], xrange[1], nbinsh + 1)
+    v_centers = np.linspace(yrange[0], yrange[1], nbinsv + 1)
+    h_centers = 0.5 * (h_centers[:-1] + h_centers[1:])
+    v_centers = 0.5 * (v_centers[:-1] + v_centers[1:])
+
+    if propagator is not None:
+        profiles_h, profiles_v = [], []
+        for z_block, h, v in propagator.iter_blocks(z_points, bytes_per_plane=8*(nbinsh + nbinsv)):
+            profiles_h.append(histogram1d_stack(h, propagator.weights, xrange, nbinsh))
+            profiles_v.append(histogram1d_stack(v, propagator.weights, yrange, nbinsv))
+        profiles_h = np.concatenate(profiles_h)
+        profiles_v = np.concatenate(profiles_v)
+    else:
+        histos = list(iter_caustic_histograms(beam, z_points, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes=n_processes))
+        profiles_h = np.array([histo['histogram_h'] for histo in histos])
+        profiles_v = np.array([histo['histogram_v'] for histo in histos])
+
+    return np.array([marginal_moments(h_centers, profiles_h)[1],
+                     marginal_moments(v_centers, profiles_v)[1],
+                     profile_fwhm(h_centers, profiles_h),
+                     profile_fwhm(v_centers, profiles_v)])
+
+def interpolation_errors(z_points, curve):
+    """
+    Distance between the value of curve at each inner plane of z_points and
+    the linear interpolation of its two neighbours.
+    """
+    t = (z_points[1:-1] - z_points[:-2]) / (z_points[2:] - z_points[:-2])
+    return np.abs(curve[1:-1] - (curve[:-2] + t * (curve[2:] - curve[:-2])))
+
+def curve_noise(z_points, curves, resolution):
+    """
+    Deviation below which each curve is considered flat: three times the
+    robust (median based) spread of its interpolation errors on z_points,
+    and at least resolution.
+
+    On a coarse grid most planes are away from the waist, where the curves
+    are nearly straight, so the median error measures the noise of the curve
+    rather than its bending.
+    """
+    z_points = np.asarray(z_points)
+    noise = np.array(resolution, dtype=np.float64)
+    if(len(z_points) < 3):
+        return noise
+    for i, curve in enumerate(curves):
+        error = interpolation_errors(z_points, curve)
+        if np.any(np.isfinite(error)):
+            noise[i] = max(noise[i], 3 * 1.4826 * np.nanmedian(error))
+    return noise
+
+def refinement_points(z_points, curves, tolerance, resolution=None, max_points=None):
+    """
+    Midpoints of the intervals of z_points that need refinement, most urgent
+    first.
+
+    The error of a plane is the distance between its curve value and the
+    linear interpolation of its two neighbours, relative to the curve
+    minimum; both intervals around a plane whose error exceeds tolerance are
+    split. Intervals next to the minimum of each curve come first.
+    resolution gives, for each curve, a deviation below which the curve is
+    considered flat (see curve_noise). A curve with no error left above
+    tolerance does not put its minimum first.
+
+    With max_points, at most that many midpoints are returned, leaving out
+    also the intervals whose error is within 10% of the first one left out,
+    so that the two sides of a symmetric caustic are refined together.
+    """
+    z_points = np.asarray(z_points)
+    if(len(z_points) < 3):
+        return np.array([])
+
+    scores = np.zeros(len(z_points) - 1)
+    priority = np.zeros(len(z_points) - 1, dtype=bool)
+
+    if resolution is None:
+        resolution = np.zeros(len(curves))
+
+    for curve, res in zip(curves, resolution):
+        if np.all(np.isnan(curve)):
+            continue
+        scale = np.nanmin(curve)
+        if not(scale > 0):
+            continue
+        error = interpolation_errors(z_points, curve)
+        error = np.maximum(error - res, 0.0) / scale
+        error = np.nan_to_num(error, nan=0.0)
+        if not np.any(error > tolerance):
+            continue
+        scores[:-1] = np.maximum(scores[:-1], error)
+        scores[1:] = np.maximum(scores[1:], error)
+        imin = np.nanargmin(curve)
+        priority[max(imin - 1, 0):imin + 1] = True
+
+    needed = np.where(scores > tolerance)[0]
+    # minimum neighbourhood first, then by decreasing error
+    needed = needed[np.lexsort((-scores[needed], ~priority[needed]))]
+
+    if max_points is not None and len(needed) > max_points:
+        first_out = needed[max_points]
+        needed = needed[:max_points]
+        tie = (priority[needed] == priority[first_out]) & (scores[needed] <= 1.1 * scores[first_out])
+        needed = needed[~tie]
+
+    return 0.5 * (z_points[needed] + z_points[needed + 1])
+
+def adaptive_z_points(beam, zStart, zFin, nz, colh, colv, colref, nbinsh, nbinsv, xrange, yrange,
+                      tolerance=0.01, max_planes=301, max_iterations=8, n_processes=1):
+    """
+    Non-uniform z grid refined where the RMS and FWHM curves bend, i.e.
+    around the waist.
+
+    Starts from nz uniform planes and bisects the intervals returned by
+    refinement_points until none is left, max_planes is reached or after
+    max_iterations bisections (the finest step is then the coarse step
+    divided by 2**max_iterations). Returns the sorted z array.
+    """
+    if FreeSpacePropagator.is_supported(colh, colv, colref):
+        propagator = FreeSpacePropagator(beam, colh, colv, colref)
+    else:
+        propagator = None
+
+    z_points = np.linspace(zStart, zFin, nz)
+    curves = caustic_profile_curves(beam, z_points, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes, propagator)
+
+    # binned FWHM values jump by a bin at each edge, and by several bins
+    # when the flanks are noisy; the noise is taken from the coarse curves
+    resolution = [0.0, 0.0, 2 * (xrange[1] - xrange[0]) / nbinsh, 2 * (yrange[1] - yrange[0]) / nbinsv]
+    resolution[2:] = curve_noise(z_points, curves[2:], resolution[2:])
+
+    for iteration in range(max_iterations):
+        new_points = refinement_points(z_points, curves, tolerance, resolution, max(0, max_planes - len(z_points)))
+        if(len(new_points) == 0):
+            break
+        new_curves = caustic_profile_curves(beam, new_points, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes, propagator)
+        z_points = np.concatenate([z_points, new_points])
+        curves = np.concatenate([curves, new_curves], axis=1)
+        order = np.argsort(z_points)
+        z_points, curves = z_points[order], curves[:, order]
+
+    return z_points
@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+"""
+Headless caustic runs, e.g. one caustic per beamline variant on cluster nodes.
+
+run_caustic and summarize_caustic are what the Caustic widget runs, so the
+files written here are the same HDF5 caustics; nothing in this module imports
+Qt or Orange. As a script, it takes saved Shadow beams (star.xx files) or
+directories of them:
+
+    python -m orangecontrib.shadow.lnls.widgets.utility.caustic_batch star.01 -z -5 5 -n 101 -o caustic.h5
+    oasys-lnls-caustic beams/ -z -5 5 -n 101 --auto-ranges -j 8 -o caustics/ --index $SLURM_ARRAY_TASK_ID
+
+Each beam is written to OUTPUT/<beam file name>.h5 (next to the beam without
+-o). The exit status is 0 when every caustic is complete.
+
+Long scans can be sharded: with --shards N --shard-index I each job computes
+one of N contiguous z sub-ranges into OUTPUT/<beam file name>.shardI.h5, and
+--merge assembles the shards into a single caustic, with the projections,
+pyramid and summary attributes of a normal run:
+
+    oasys-lnls-caustic star.01 -z -5 5 -n 2000 --shards 16 --shard-index $SLURM_ARRAY_TASK_ID -o shards/
+    oasys-lnls-caustic --merge caustic.h5 shards/
+"""
+
+import json
+import optparse
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+import Shadow
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic import iter_caustic_histograms, adaptive_z_points, beam_fingerprint, caustic_cache_key, \
+    beam_wavelength, split_z_points
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import CausticWriter, CausticReader, STORAGE_DTYPES, COMPRESSION_CODECS, \
+    CAUSTIC_FORMAT_VERSION, GZIP_LEVEL, PLANE_COLUMNS, write_pyramid
+from orangecontrib.shadow.lnls.widgets.utility.caustic_cache import CausticCache
+from orangecontrib.shadow.lnls.widgets.utility.histogram import fwhm_stack, image_statistics
+
+
+def weighted_avg_and_std(values, weights):
+    """
+    By EOL - stackoverflow - 10/03/2010
+    Return the weighted average and standard deviation.
+    values, weights -- Numpy ndarrays with the same shape.
+    """
+    try:
+        average = np.average(values, weights=weights)
+        variance = np.average((values-average)**2, weights=weights)  # Fast and numerically precise
+        return (average, np.sqrt(variance))
+    except:
+        print('   Mean and RMS values could not be calculated.')
+        return (np.nan, np.nan)
+
+def good_ranges(beam, zStart, zFin, colh, colv):
+    """
+    [hmin, hmax, vmin, vmax] covering the good rays at z = 0, zStart and zFin.
+    """
+    r_z0h = beam.get_good_range(icol=colh, nolost=1)
+    r_z0v = beam.get_good_range(icol=colv, nolost=1)
+
+    beam_copy = beam.duplicate()
+    beam_copy.retrace(zStart)
+    r_zStarth = beam_copy.get_good_range(icol=colh, nolost=1)
+    r_zStartv = beam_copy.get_good_range(icol=colv, nolost=1)
+
+    beam_copy = beam.duplicate()
+    beam_copy.retrace(zFin)
+    r_zFinh = beam_copy.get_good_range(icol=colh, nolost=1)
+    r_zFinv = beam_copy.get_good_range(icol=colv, nolost=1)
+
+    rh_min = np.min(r_z0h + r_zStarth + r_zFinh)
+    rh_max = np.max(r_z0h + r_zStarth + r_zFinh)
+    rv_min = np.min(r_z0v + r_zStartv + r_zFinv)
+    rv_max = np.max(r_z0v + r_zStartv + r_zFinv)
+
+    return [rh_min, rh_max, rv_min, rv_max]
+
+def storage_options(dtype='float64', compression='gzip', compression_level=GZIP_LEVEL, shuffle=False, chunks='auto'):
+    """
+    Keyword arguments of CausticWriter for the storage settings. chunks is
+    'auto' or a 'z, x, y' string.
+    """
+    if(dtype not in STORAGE_DTYPES):
+        raise ValueError('Data type must be one of ' + ', '.join(STORAGE_DTYPES))
+    if(compression not in COMPRESSION_CODECS):
+        raise ValueError('Compression must be one of ' + ', '.join(COMPRESSION_CODECS))
+    if(compression == 'gzip' and not 0 <= compression_level <= 9):
+        raise ValueError('Compression Level must be between 0 and 9')
+
+    if(str(chunks).strip().lower() in ['', 'auto']):
+        chunks = None
+    else:
+        try:
+            chunks = [int(c) for c in str(chunks).replace('(', '').replace(')', '').split(',')]
+        except ValueError:
+            raise ValueError("Chunk Shape must be 'auto' or three integers (z, x, y)")
+        if(len(chunks) != 3 or min(chunks) < 1):
+            raise ValueError("Chunk Shape must be 'auto' or three positive integers (z, x, y)")
+
+    return {'dtype': dtype,
+            'compression': compression,
+            'compression_level': compression_level,
+            'shuffle': bool(shuffle),
+            'chunks': chunks}
+
+def print_cache_statistics(cache):
+    stats = cache.statistics()
+    sys.stdout.write('\nCaustic cache: {0} hits, {1} misses, {2} files, {3:.1f} MB\n'.format(stats['hits'], stats['misses'], stats['entries'], stats['bytes']/1024**2))
+
+def plane_statistics(data, z, zOffset, t0):
+    """
+    Row of the statistics table for the histograms of one plane (see
+    iter_caustic_histograms).
+    """
+    if 'mean_h' in data: # already calculated by the histogram kernel
+        mean_h, rms_h = data['mean_h'], data['rms_h']
+        mean_v, rms_v = data['mean_v'], data['rms_v']
+    else:
+        mean_h, rms_h = weighted_avg_and_std(data['bin_h_center'], data['histogram_h'])
+        mean_v, rms_v = weighted_avg_and_std(data['bin_v_center'], data['histogram_v'])
+
+    peak = image_statistics(data['histogram'], data['bin_h_center'], data['bin_v_center'])
+
+    stats = {'z': z + zOffset,
+             'mean_h': mean_h,
+             'mean_v': mean_v,
+             'rms_h': rms_h,
+             'rms_v': rms_v,
+             'fwhm_h': fwhm_stack(data['bin_h_center'], data['histogram_h'])[0][0],
+             'fwhm_v': fwhm_stack(data['bin_v_center'], data['histogram_v'])[0][0],
+             'peak_h': peak['peak_h'],
+             'peak_v': peak['peak_v'],
+             'elapsed_time': round(time.time() - t0, 3)}
+
+    if data.get('fwhm_h') is not None:
+        stats['fwhm_h_shadow'] = data['fwhm_h']
+        stats['center_h_shadow'] = (data['fwhm_coordinates_h'][0] + data['fwhm_coordinates_h'][1]) / 2.0
+    else:
+        print('CAUSTIC WARNING: FWHM X could not be calculated by Shadow')
+        stats['fwhm_h_shadow'] = np.nan
+        stats['center_h_shadow'] = np.nan
+
+    if data.get('fwhm_v') is not None:
+        stats['fwhm_v_shadow'] = data['fwhm_v']
+        stats['center_v_shadow'] = (data['fwhm_coordinates_v'][0] + data['fwhm_coordinates_v'][1]) / 2.0
+    else:
+        print('CAUSTIC WARNING: FWHM Y could not be calculated by Shadow')
+        stats['fwhm_v_shadow'] = np.nan
+        stats['center_v_shadow'] = np.nan
+
+    return stats
+
+def shard_z_points(z_points, n_shards, index):
+    """
+    Shard index of the n_shards contiguous z sub-ranges of z_points: the
+    index of its first plane and its z points.
+    """
+    shards = split_z_points(z_points, n_shards)
+    if(len(shards) != n_shards or not 0 <= index < n_shards):
+        raise ValueError('Shard {0} of {1} does not exist for {2} z points'.format(index, n_shards, len(z_points)))
+    return sum(len(shard) for shard in shards[:index]), shards[index]
+
+def run_caustic(filename, beam, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes=1,
+                adaptive=False, tolerance=0.01, max_planes=301, storage=None, resume=False, cache=None, progress=None, cancel=None,
+                shard=None):
+    """
+    Computes the caustic and writes it to filename. progress, if given, is
+    called after each plane with a dict of the planes done, their total,
+    the rays per second and the estimated remaining time (s). cancel is a
+    threading.Event: when set, the scan stops after the current plane and
+    the file is closed with the planes computed so far. Returns True when
+    the file is complete.
+
+    shard = (index, count) only computes that shard of the z points (see
+    shard_z_points) into a shard file, to be assembled by merge_shards.
+    Shards are neither summarized nor cached.
+    """
+    t0 = time.time()
+    good_rays = beam.nrays(nolost=1)
+
+    if shard is not None:
+        cache = None
+    if cache is not None:
+        key = caustic_cache_key(beam, colh, colv, colref,
+                                {'format_version': CAUSTIC_FORMAT_VERSION,
+                                 'zStart': zStart, 'zFin': zFin, 'nz': nz, 'zOffset': zOffset,
+                                 'nbins': [nbinsh, nbinsv], 'xrange': list(xrange), 'yrange': list(yrange),
+                                 'adaptive': [tolerance, max_planes] if adaptive else False,
+                                 'storage': storage or {}})
+        if cache.fetch(key, filename):
+            sys.stdout.write('\nSame beam and settings as a previous run: caustic copied from the cache ')
+            print_cache_statistics(cache)
+            return True
+
+    if(adaptive):
+        z_points = adaptive_z_points(beam, zStart, zFin, nz, colh, colv, colref, nbinsh, nbinsv, xrange, yrange,
+                                     tolerance=tolerance, max_planes=max(nz, max_planes), n_processes=n_processes)
+        sys.stdout.write('\nAdaptive Z sampling: {0} planes (min. step {1:.3e}) '.format(len(z_points), np.min(np.diff(z_points)) if len(z_points) > 1 else 0.0))
+    else:
+        z_points = np.linspace(zStart, zFin, nz)
+    shard_info = None
+    if shard is not None:
+        # adaptive z points are the same in every shard: they only depend on the beam and the settings
+        start, shard_points = shard_z_points(z_points, shard[1], shard[0])
+        shard_info = {'index': shard[0], 'count': shard[1], 'start': start, 'z_points': z_points}
+        z_points = shard_points
+    if cancel is not None and cancel.is_set():
+        return False
+    with CausticWriter(filename, z_points, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, good_rays, background=True,
+                       resume=resume, fingerprint=beam_fingerprint(beam), wavelength=beam_wavelength(beam), shard=shard_info,
+                       **(storage or {})) as writer:
+        if(writer.start > 0):
+            sys.stdout.write('\nResuming: {0} of {1} planes already in the file '.format(writer.start, len(z_points)))
+        histos = iter_caustic_histograms(beam, z_points[writer.start:], colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes=n_processes)
+        t_planes = time.time()
+        try:
+            for i, histo in enumerate(histos, start=writer.start):
+                writer.append_plane(histo['histogram'], plane_statistics(histo, z_points[i], zOffset, t0))
+                if progress is not None:
+                    done = i + 1 - writer.start
+                    elapsed = max(time.time() - t_planes, 1e-9)
+                    progress({'done': i + 1, 'total': len(z_points), 'rays_per_s': done * good_rays / elapsed,
+                              'eta': (len(z_points) - i - 1) * elapsed / done})
+                if cancel is not None and cancel.is_set():
+                    writer.close(status='cancelled')
+                    break
+        finally:
+            histos.close() # stops the worker processes
+
+    # the file is finalized (minimums, projections) only once all planes are there
+    if(writer.complete):
+        if shard is None:
+            summarize_caustic(filename, write_attributes=True)
+        if cache is not None:
+            cache.store(key, filename)
+            print_cache_statistics(cache)
+    elif cancel is not None and cancel.is_set():
+        sys.stdout.write('\nCaustic cancelled: the file has the planes computed so far; run it again with "Resume" to compute the missing ones.\n')
+    else:
+        sys.stdout.write('\nCaustic incomplete: run it again with "Resume" to compute the missing planes.\n')
+    return writer.complete
+
+def find_shard_files(paths):
+    """
+    The shard files of paths: files are taken as they are, directories
+    contribute their .h5 files with shard attributes.
+    """
+    shards = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.h5'):
+                    with h5py.File(os.path.join(path, name), 'r') as f:
+                        if 'shard_index' in f.attrs:
+                            shards.append(os.path.join(path, name))
+        elif os.path.isfile(path):
+            shards.append(path)
+        else:
+            raise ValueError('No such shard file or directory: ' + path)
+    return shards
+
+def merge_shards(shard_files, filename, storage=None):
+    """
+    Assembles the shard files of a scan (see run_caustic) into the caustic
+    file filename, as written by an unsharded run: the planes and
+    statistics rows are appended in z order, then the file is summarized
+    (projections, pyramid and summary attributes, see summarize_caustic).
+    storage overrides the storage options of the shards.
+
+    The shards must all be complete, of the same scan, and cover it exactly
+    once; a ValueError tells which is not.
+
+    Returns
+    -------
+    outdict : the summary of the merged caustic.
+    """
+    shards = {}
+    for name in shard_files:
+        with CausticReader(name) as reader:
+            attrs = reader.attrs
+            if('shard_index' not in attrs):
+                raise ValueError('Not a shard file: ' + name)
+            if(attrs['status'] != 'complete'):
+                raise ValueError('Shard {0} is {1}: run it again (with --resume) before merging'.format(name, attrs['status']))
+            index = int(attrs['shard_index'])
+            if(index in shards):
+                raise ValueError('Shard {0} is both in {1} and {2}'.format(index, shards[index]['file'], name))
+            shards[index] = {'file': name, 'count': int(attrs['shard_count']), 'start': int(attrs['shard_start']), 'nz': reader.nz,
+                             'scan': attrs['scan_parameters'], 'good_rays': int(attrs['good_rays'])}
+    if not shards:
+        raise ValueError('No shard files to merge')
+
+    first = shards[min(shards)]
+    count = first['count']
+    for index, shard in shards.items():
+        if(shard['scan'] != first['scan'] or shard['count'] != count or shard['good_rays'] != first['good_rays']):
+            raise ValueError('{0} and {1} are shards of different scans'.format(first['file'], shard['file']))
+    missing = sorted(set(range(count)) - set(shards))
+    if missing:
+        raise ValueError('Missing shards: ' + ', '.join(str(index) for index in missing))
+
+    with CausticReader(first['file']) as reader:
+        z_points = reader.f['scan_z_points'][()]
+        attrs = dict(reader.attrs)
+    stop = 0
+    for index in range(count):
+        if(shards[index]['start'] != stop):
+            raise ValueError('Shard {0} does not start where shard {1} ends'.format(index, index - 1))
+        stop += shards[index]['nz']
+    if(stop != len(z_points)):
+        raise ValueError('The shards have {0} of the {1} planes of the scan'.format(stop, len(z_points)))
+
+    parameters = json.loads(first['scan'])
+    if storage is None:
+        storage = {'dtype': parameters['dtype'], 'compression': parameters['compression'],
+                   'compression_level': parameters['compression_level'], 'shuffle': parameters['shuffle'],
+                   'chunks': parameters['chunks'] or None}
+
+    with CausticWriter(filename, z_points, parameters['zOffset'], parameters['col_h'], parameters['col_v'], parameters['col_ref'],
+                       parameters['nbins_h'], parameters['nbins_v'], parameters['xrange'], parameters['yrange'], first['good_rays'],
+                       offsets=attrs.get('offsets'), background=True, fingerprint=parameters['beam_fingerprint'],
+                       wavelength=attrs.get('wavelength'), **storage) as writer:
+        for index in range(count):
+            with CausticReader(shards[index]['file']) as reader:
+                stats = reader.statistics()
+                for start, planes in reader.iter_slabs():
+                    for i, plane in enumerate(planes, start=start):
+                        writer.append_plane(plane, {name: stats[name][i] for name in PLANE_COLUMNS})
+
+    return summarize_caustic(filename, write_attributes=True)[0]
+
+def summarize_caustic(filename, write_attributes=False):
+    """
+    Minimum sizes, their z and centers, and the size and center curves of a
+    caustic file. With write_attributes, they are stored as file attributes,
+    with the XZ and YZ projections ('histoXZ', 'histoYZ') and the pyramid
+    levels.
+
+    Returns
+    -------
+    outdict, histoH, histoV : the summary and the XZ and YZ projections.
+    """
+    with CausticReader(filename) as reader:
+
+        ###### READ DATA #######################
+
+        zStart = reader.attrs['zStart']
+        zFin = reader.attrs['zFin']
+        nz = reader.attrs['nz']
+
+        z_points = reader.z_points()
+
+        stats = reader.statistics()
+        center_shadow = np.array([stats['center_h_shadow'], stats['center_v_shadow']]).transpose()
+        center = np.array([stats['mean_h'], stats['mean_v']]).transpose()
+        rms = np.array([stats['rms_h'], stats['rms_v']]).transpose()
+        fwhm = np.array([stats['fwhm_h'], stats['fwhm_v']]).transpose()
+        fwhm_shadow = np.array([stats['fwhm_h_shadow'], stats['fwhm_v_shadow']]).transpose()
+
+        if not write_attributes:
+            histoH, histoV = reader.projections()
+
+    if(write_attributes):
+        # the pyramid levels are built in the same pass over the cube as the projections
+        histoH, histoV = write_pyramid(filename)
+
+    #### FIND MINIMUMS AND ITS Z POSITIONS
+
+    rms_min = [np.min(rms[:,0]), np.min(rms[:,1])]
+    fwhm_min = [np.min(fwhm[:,0]), np.min(fwhm[:,1])]
+    fwhm_shadow_min = [np.min(fwhm_shadow[:,0]), np.min(fwhm_shadow[:,1])]
+
+    rms_min_z=np.array([z_points[np.abs(rms[:,0]-rms_min[0]).argmin()],
+                        z_points[np.abs(rms[:,1]-rms_min[1]).argmin()]])
+
+    fwhm_min_z=np.array([z_points[np.abs(fwhm[:,0]-fwhm_min[0]).argmin()],
+                         z_points[np.abs(fwhm[:,1]-fwhm_min[1]).argmin()]])
+
+    fwhm_shadow_min_z=np.array([z_points[np.abs(fwhm_shadow[:,0]-fwhm_shadow_min[0]).argmin()],
+                                z_points[np.abs(fwhm_shadow[:,1]-fwhm_shadow_min[1]).argmin()]])
+
+    center_rms = np.array([center[:,0][np.abs(z_points-rms_min_z[0]).argmin()],
+                           center[:,1][np.abs(z_points-rms_min_z[1]).argmin()]])
+
+    center_fwhm = np.array([center[:,0][np.abs(z_points-fwhm_min_z[0]).argmin()],
+                            center[:,1][np.abs(z_points-fwhm_min_z[1]).argmin()]])
+
+    center_fwhm_shadow = np.array([center[:,0][np.abs(z_points-fwhm_shadow_min_z[0]).argmin()],
+                                   center[:,1][np.abs(z_points-fwhm_shadow_min_z[1]).argmin()]])
+
+
+    outdict = {'zStart': zStart,
+               'zFin': zFin,
+               'nz': nz,
+               'center_h_array': center[:,0],
+               'center_v_array': center[:,1],
+               'center_shadow_h_array': center_shadow[:,0],
+               'center_shadow_v_array': center_shadow[:,1],
+               'rms_h_array': rms[:,0],
+               'rms_v_array': rms[:,1],
+               'fwhm_h_array': fwhm[:,0],
+               'fwhm_v_array': fwhm[:,1],
+               'fwhm_shadow_h_array': fwhm_shadow[:,0],
+               'fwhm_shadow_v_array': fwhm_shadow[:,1],
+               'rms_min_h': rms_min[0],
+               'rms_min_v': rms_min[1],
+               'fwhm_min_h': fwhm_min[0],
+               'fwhm_min_v': fwhm_min[1],
+               'fwhm_shadow_min_h': fwhm_shadow_min[0],
+               'fwhm_shadow_min_v': fwhm_shadow_min[1],
+               'z_rms_min_h': rms_min_z[0],
+               'z_rms_min_v': rms_min_z[1],
+               'z_fwhm_min_h': fwhm_min_z[0],
+               'z_fwhm_min_v': fwhm_min_z[1],
+               'z_fwhm_shadow_min_h': fwhm_shadow_min_z[0],
+               'z_fwhm_shadow_min_v': fwhm_shadow_min_z[1],
+               'center_rms_h': center_rms[0],
+               'center_rms_v': center_rms[1],
+               'center_fwhm_h': center_fwhm[0],
+               'center_fwhm_v': center_fwhm[1],
+               'center_fwhm_shadow_h': center_fwhm_shadow[0],
+               'center_fwhm_shadow_v': center_fwhm_shadow[1]}
+
+    if(write_attributes):
+        with h5py.File(filename, 'a') as f:
+            for key in list(outdict.keys()):
+                f.attrs[key] = outdict[key]
+
+            for dset in ['histoXZ', 'histoYZ']:
+                if dset in f:
+                    del f[dset]
+            f.create_dataset('histoXZ', data=histoH, dtype=float, compression="gzip")
+            f.create_dataset('histoYZ', data=histoV, dtype=float, compression="gzip")
+
+    return outdict, histoH, histoV
+
+def find_beam_files(paths):
+    """
+    The Shadow beam files of paths: files are taken as they are, directories
+    contribute their star.* files (caustic .h5 files excluded), sorted.
+    """
+    beams = []
+    for path in paths:
+        if os.path.isdir(path):
+            beams += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.startswith('star.') and not name.endswith('.h5') and os.path.isfile(os.path.join(path, name)))
+        elif os.path.isfile(path):
+            beams.append(path)
+        else:
+            raise ValueError('No such beam file or directory: ' + path)
+    return beams
+
+def load_beam(filename):
+    beam = Shadow.Beam()
+    beam.load(filename)
+    return beam
+
+def output_filename(beam_file, output=None, single=False):
+    """
+    Caustic file of beam_file: output itself for a single beam and an output
+    ending in .h5, OUTPUT/<beam file name>.h5 otherwise (next to the beam
+    without output).
+    """
+    if(output and single and output.endswith('.h5')):
+        return output
+    directory = output or os.path.dirname(beam_file)
+    return os.path.join(directory, os.path.basename(beam_file) + '.h5')
+
+def main(argv=None):
+
+    p = optparse.OptionParser(usage='%prog [options] BEAM [BEAM ...]\n       %prog --merge FILE SHARD [SHARD ...]\n\n'
+                                    'BEAM: Shadow beam file (star.xx) or directory of star.* files\n'
+                                    'SHARD: shard file or directory of shard files')
+    p.add_option('-o', '--output', dest='output', default='',
+                 help='caustic file (single beam) or directory of the caustic files (default: next to the beams)')
+    p.add_option('--index', dest='index', type='int', default=None,
+                 help='only run the beam of this index (0-based) in the list of beams, e.g. $SLURM_ARRAY_TASK_ID')
+    p.add_option('-z', '--z-range', dest='z_range', type='float', nargs=2, default=(-5.0, 5.0), help='first and last z')
+    p.add_option('-n', '--nz', dest='nz', type='int', default=101, help='number of z points')
+    p.add_option('--z-offset', dest='z_offset', type='float', default=0.0, help='offset added to the z of the file')
+    p.add_option('-x', '--x-range', dest='x_range', type='float', nargs=2, default=(-0.01, 0.01), help='histogram range of the X column')
+    p.add_option('-y', '--y-range', dest='y_range', type='float', nargs=2, default=(-0.01, 0.01), help='histogram range of the Y column')
+    p.add_option('--auto-ranges', dest='auto_ranges', action='store_true', default=False,
+                 help='X and Y ranges covering the good rays at z = 0 and at the first and last z of each beam')
+    p.add_option('-b', '--bins', dest='bins', type='int', nargs=2, default=(200, 200), help='number of X and Y bins')
+    p.add_option('--colh', dest='colh', type='int', default=1, help='X column (Shadow, 1-based)')
+    p.add_option('--colv', dest='colv', type='int', default=3, help='Y column (Shadow, 1-based)')
+    p.add_option('--weight', dest='colref', type='int', default=23, help='weight column (0: none)')
+    p.add_option('-j', '--processes', dest='n_processes', type='int', default=1, help='number of processes')
+    p.add_option('--adaptive', dest='tolerance', type='float', default=0,
+                 help='adaptive z sampling with this refinement tolerance (0: uniform z)')
+    p.add_option('--max-planes', dest='max_planes', type='int', default=301, help='maximum number of z points of the adaptive sampling')
+    p.add_option('--storage', dest='storage', action='store_true', default=False,
+                 help='with --merge, store the merged caustic with the storage options below instead of those of the shards')
+    p.add_option('--dtype', dest='dtype', default='float64', help='data type of the caustic: ' + ', '.join(STORAGE_DTYPES))
+    p.add_option('--compression', dest='compression', default='gzip', help='compression codec: ' + ', '.join(COMPRESSION_CODECS))
+    p.add_option('--compression-level', dest='compression_level', type='int', default=GZIP_LEVEL, help='gzip level')
+    p.add_option('--shuffle', dest='shuffle', action='store_true', default=False, help='shuffle filter')
+    p.add_option('--chunks', dest='chunks', default='auto', help="chunk shape 'z,x,y' or 'auto'")
+    p.add_option('--resume', dest='resume', action='store_true', default=False, help='complete unfinished files of the same beam and settings')
+    p.add_option('--shards', dest='shards', type='int', default=0,
+                 help='split the z points in this number of shards and only compute the one of --shard-index')
+    p.add_option('--shard-index', dest='shard_index', type='int', default=None,
+                 help='shard to compute (0-based), e.g. $SLURM_ARRAY_TASK_ID')
+    p.add_option('--merge', dest='merge', metavar='FILE', default='',
+                 help='merge the shard files (or directories of them) given as arguments into the caustic FILE')
+    p.add_option('--cache', dest='cache', default='', help='directory of a caustic cache shared by the runs (default: no cache)')
+    p.add_option('--cache-size', dest='cache_size', type='float', default=2000, help='maximum size of the cache (MB)')
+    opt, args = p.parse_args(argv)
+
+    if not args:
+        p.error('no input file or directory given')
+    if(opt.merge):
+        t0 = time.time()
+        try:
+            storage = None
+            if(opt.storage):
+                storage = storage_options(opt.dtype, opt.compression, opt.compression_level, opt.shuffle, opt.chunks)
+            shards = find_shard_files(args)
+            outdict = merge_shards(shards, opt.merge, storage=storage)
+        except ValueError as exception:
+            p.error(str(exception))
+        sys.stdout.write('{0} shards merged into {1} ({2} planes) in {3:.1f} s\n'.format(len(shards), opt.merge, len(outdict['rms_h_array']),
+                                                                                      time.time() - t0))
+        return 0
+    shard = None
+    if(opt.shards > 0):
+        if(opt.shard_index is None or not 0 <= opt.shard_index < opt.shards):
+            p.error('--shards needs a --shard-index between 0 and {0}'.format(opt.shards - 1))
+        if(opt.tolerance <= 0 and opt.shards > opt.nz):
+            p.error('more shards than z points')
+        shard = (opt.shard_index, opt.shards)
+    if(opt.nz < 1 or min(opt.bins) < 1 or opt.n_processes < 1):
+        p.error('the number of z points, bins and processes must be positive')
+    try:
+        beams = find_beam_files(args)
+        storage = storage_options(opt.dtype, opt.compression, opt.compression_level, opt.shuffle, opt.chunks)
+    except ValueError as exception:
+        p.error(str(exception))
+    if(opt.index is not None):
+        if not 0 <= opt.index < len(beams):
+            p.error('index {0} out of the {1} beams'.format(opt.index, len(beams)))
+        beams = beams[opt.index:opt.index + 1]
+    if(opt.output and not (len(beams) == 1 and shard is None and opt.output.endswith('.h5'))):
+        os.makedirs(opt.output, exist_ok=True)
+
+    cache = CausticCache(directory=opt.cache, max_bytes=opt.cache_size*1024**2) if opt.cache else None
+
+    complete = True
+    for beam_file in beams:
+        t0 = time.time()
+        filename = output_filename(beam_file, opt.output, single=(len(beams) == 1 and shard is None))
+        if shard is not None:
+            filename = filename[:-len('.h5')] + '.shard{0}.h5'.format(shard[0])
+        sys.stdout.write('{0} -> {1}'.format(beam_file, filename))
+        sys.stdout.flush()
+
+        beam = load_beam(beam_file)
+        if(opt.auto_ranges):
+            ranges = good_ranges(beam.duplicate(), opt.z_range[0], opt.z_range[1], opt.colh, opt.colv)
+            xrange, yrange = ranges[:2], ranges[2:]
+        else:
+            xrange, yrange = opt.x_range, opt.y_range
+
+        done = run_caustic(filename, beam, opt.z_range[0], opt.z_range[1], opt.nz, opt.z_offset, opt.colh, opt.colv, opt.colref,
+                           opt.bins[0], opt.bins[1], xrange, yrange, n_processes=opt.n_processes,
+                           adaptive=(opt.tolerance > 0), tolerance=opt.tolerance, max_planes=opt.max_planes,
+                           storage=storage, resume=opt.resume, cache=cache, shard=shard)
+        complete = complete and done
+        sys.stdout.write('\n{0} in {1:.1f} s\n'.format('finished' if done else 'INCOMPLETE', time.time() - t0))
+        sys.stdout.flush()
+
+    return 0 if complete else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
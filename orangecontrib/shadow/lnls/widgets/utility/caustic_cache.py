@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Caches of caustic files.
+
+CausticCache is the on-disk cache of results: entries are complete caustic
+files named after a content key (see caustic.caustic_cache_key), so a scan
+of an unchanged beam with unchanged settings is served by copying the cached
+file. CausticSessionCache keeps the files loaded by the widget in memory, so
+that replotting with other units, scales or ranges does not read the file
+again. Both are capped in size and evict the least recently used entries
+first.
+"""
+
+import collections
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import CausticReader
+from orangecontrib.shadow.lnls.widgets.utility.histogram import image_statistics
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'oasys1-lnls', 'caustic')
+
+
+class CausticCache(object):
+    """
+    Size-capped LRU cache of caustic files, with persistent hit and miss
+    counters. The modification time of an entry is its last use.
+    """
+
+    def __init__(self, directory=None, max_bytes=2*1024**3):
+        self.directory = directory or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._stats_file = os.path.join(self.directory, 'statistics.json')
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.h5')
+
+    def fetch(self, key, filename):
+        """
+        Copies the entry of key to filename. Returns False (a miss) when
+        there is no such entry.
+        """
+        entry = self.path(key)
+        if not os.path.isfile(entry):
+            self._count('misses')
+            return False
+
+        shutil.copyfile(entry, filename)
+        os.utime(entry, None)
+        self._count('hits')
+        return True
+
+    def store(self, key, filename):
+        """
+        Adds a complete caustic file to the cache and evicts the least
+        recently used entries above the size cap.
+        """
+        entry = self.path(key)
+        tmp = entry + '.tmp'
+        shutil.copyfile(filename, tmp)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def entries(self):
+        """
+        (path, size, last use) of the entries, least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.h5'):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        for path, size, last_use in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for path, size, last_use in self.entries():
+            os.remove(path)
+        if os.path.isfile(self._stats_file):
+            os.remove(self._stats_file)
+
+    def statistics(self):
+        """
+        Dict with the hits and misses so far, the number of entries and their
+        total size in bytes.
+        """
+        stats = {'hits': 0, 'misses': 0}
+        if os.path.isfile(self._stats_file):
+            try:
+                with open(self._stats_file) as f:
+                    stats.update(json.load(f))
+            except ValueError:
+                pass
+        entries = self.entries()
+        stats['entries'] = len(entries)
+        stats['bytes'] = sum(entry[1] for entry in entries)
+        return stats
+
+    def _count(self, counter):
+        stats = self.statistics()
+        stats[counter] += 1
+        with open(self._stats_file, 'w') as f:
+            json.dump({'hits': stats['hits'], 'misses': stats['misses']}, f)
+
+
+class LoadedCaustic(object):
+    """
+    In-memory view of a caustic file with the read API of CausticReader.
+
+    The attributes, z points, plane ranges, statistics and the list of
+    pyramid levels are read when the entry is created. The cube is kept after the first pass over the whole
+    file (projections, peak positions of old files) when it is smaller than
+    max_cube_bytes; until then, and for larger cubes, cuts and planes are
+    read from the file. Results are memoized, so repeating a request with
+    the same cut positions does not touch the file.
+    """
+
+    def __init__(self, filename, max_cube_bytes=None, on_grow=None):
+        self.filename = filename
+        self.max_cube_bytes = max_cube_bytes
+        self._on_grow = on_grow
+
+        with CausticReader(filename) as reader:
+            self.version = reader.version
+            self.nz = reader.nz
+            self.attrs = dict(reader.attrs)
+            self._z_points = np.array(reader.z_points())
+            self._ranges = reader.plane_ranges()
+            self._statistics = reader.statistics()
+            if 'histoXZ' in reader.f:
+                self.histoXZ = np.array(reader.f['histoXZ'])
+                self.histoYZ = np.array(reader.f['histoYZ'])
+            else:
+                self.histoXZ = self.histoYZ = None
+            self._levels = reader.pyramid_levels()
+            itemsize = reader.f['caustic'].dtype.itemsize if self.version > 1 else 8
+            self._cube_bytes = int(np.sum(self._ranges[:, 4] * self._ranges[:, 5])) * itemsize
+
+        self._cube = None
+        self._cuts = collections.OrderedDict()
+        self._plane = (None, None)
+        self._level_planes = collections.OrderedDict()
+        self._projections = None
+        self._peaks = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the entry.
+        """
+        arrays = [self._z_points, self._ranges, self.histoXZ, self.histoYZ, self._plane[1]]
+        arrays += list(self._statistics.values())
+        for cuts in self._cuts.values():
+            arrays += list(cuts[0]) + list(cuts[1])
+        arrays += list(self._level_planes.values())
+        if self._projections is not None:
+            arrays += list(self._projections)
+        if self._peaks is not None:
+            arrays += list(self._peaks)
+        if self._cube is not None:
+            arrays += self._cube if isinstance(self._cube, list) else [self._cube]
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def z_points(self):
+        return self._z_points.copy()
+
+    def plane_ranges(self):
+        return self._ranges.copy()
+
+    def statistics(self):
+        return {name: values.copy() for name, values in self._statistics.items()}
+
+    def read_cuts(self, h_index, v_index):
+        """
+        Same as CausticReader.read_cuts, from memory when possible. The last
+        8 cut positions are memoized.
+        """
+        h_index = np.broadcast_to(np.asarray(h_index, dtype=int), (self.nz,))
+        v_index = np.broadcast_to(np.asarray(v_index, dtype=int), (self.nz,))
+        key = (h_index.tobytes(), v_index.tobytes())
+
+        if key in self._cuts:
+            self._cuts.move_to_end(key)
+            return self._copy_cuts(self._cuts[key])
+
+        if self._cube is None:
+            with CausticReader(self.filename) as reader:
+                cuts = reader.read_cuts(h_index, v_index)
+        elif self.version == 1:
+            cuts = ([plane[:, v_index[i]] for i, plane in enumerate(self._cube)],
+                    [plane[h_index[i], :] for i, plane in enumerate(self._cube)])
+        else:
+            cuts = (self._cube[:, :, v_index[0]], self._cube[:, h_index[0], :])
+
+        self._cuts[key] = cuts
+        if len(self._cuts) > 8:
+            self._cuts.popitem(last=False)
+        return self._copy_cuts(cuts)
+
+    def _copy_cuts(self, cuts):
+        # callers may modify the arrays (e.g. clipping for log plots)
+        if self.version == 1:
+            return [cut.copy() for cut in cuts[0]], [cut.copy() for cut in cuts[1]]
+        return cuts[0].copy(), cuts[1].copy()
+
+    def read_plane(self, i):
+        if self._cube is not None:
+            return self._cube[i].copy()
+        if self._plane[0] != i:
+            with CausticReader(self.filename) as reader:
+                self._plane = (i, reader.read_plane(i))
+        return self._plane[1].copy()
+
+    def pyramid_levels(self):
+        return {factor: (z.copy(), ranges.copy()) for factor, (z, ranges) in self._levels.items()}
+
+    def read_level(self, factor, index=None):
+        """
+        Same as CausticReader.read_level. The last 8 planes of the pyramid
+        levels are memoized.
+        """
+        if factor == 1:
+            if index is not None:
+                return self.read_plane(index)
+            if self._cube is not None and self.version > 1:
+                return self._cube.copy()
+        elif index is not None:
+            key = (factor, index)
+            if key not in self._level_planes:
+                with CausticReader(self.filename) as reader:
+                    self._level_planes[key] = reader.read_level(factor, index)
+                if len(self._level_planes) > 8:
+                    self._level_planes.popitem(last=False)
+            self._level_planes.move_to_end(key)
+            return self._level_planes[key].copy()
+        with CausticReader(self.filename) as reader:
+            return reader.read_level(factor, index)
+
+    def iter_slabs(self, factor=1):
+        """
+        Same as CausticReader.iter_slabs; the planes read at full resolution
+        are kept as the cube when it fits in max_cube_bytes.
+        """
+        if factor > 1:
+            with CausticReader(self.filename) as reader:
+                for start, planes in reader.iter_slabs(factor):
+                    yield start, planes
+            return
+
+        if self._cube is not None:
+            if self.version == 1:
+                for i, plane in enumerate(self._cube):
+                    yield i, plane[np.newaxis]
+            else:
+                yield 0, self._cube
+            return
+
+        keep = self.max_cube_bytes is None or self._cube_bytes <= self.max_cube_bytes
+        slabs = []
+        with CausticReader(self.filename) as reader:
+            for start, planes in reader.iter_slabs():
+                planes = planes[:self.nz - start]
+                if keep:
+                    slabs.append(planes)
+                yield start, planes
+
+        if keep:
+            if self.version == 1:
+                self._cube = [slab[0] for slab in slabs]
+            else:
+                self._cube = np.concatenate(slabs) if slabs else np.zeros((0, 0, 0))
+            if self._on_grow is not None:
+                self._on_grow(self)
+
+    def projections(self):
+        if self._projections is None:
+            histoH = np.zeros((int(self._ranges[0, 4]), self.nz))
+            histoV = np.zeros((int(self._ranges[0, 5]), self.nz))
+            for start, planes in self.iter_slabs():
+                histoH[:, start:start + len(planes)] = planes.sum(axis=2, dtype=np.float64).transpose()
+                histoV[:, start:start + len(planes)] = planes.sum(axis=1, dtype=np.float64).transpose()
+            self._projections = (histoH, histoV)
+        return self._projections
+
+    def peak_positions(self):
+        if self._peaks is None:
+            peak_h, peak_v = self._statistics['peak_h'].copy(), self._statistics['peak_v'].copy()
+            if np.any(np.isnan(peak_h)):
+                for start, planes in self.iter_slabs():
+                    r = self._ranges[start]
+                    peaks = image_statistics(planes, np.linspace(r[0], r[1], int(r[4])), np.linspace(r[2], r[3], int(r[5])))
+                    peak_h[start:start + len(planes)] = peaks['peak_h']
+                    peak_v[start:start + len(planes)] = peaks['peak_v']
+            self._peaks = (peak_h, peak_v)
+        return self._peaks
+
+
+class CausticSessionCache(object):
+    """
+    Size-capped LRU cache of LoadedCaustic entries, keyed by path,
+    modification time and size: a file rewritten by a new run is a new
+    entry, and its previous entry is dropped.
+
+    The entry table is only changed under a lock, so that loading, eviction
+    (also triggered by an entry growing) and clearing can come from
+    different threads.
+    """
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                entry = self._entries[key]
+                entry.max_cube_bytes = self.max_bytes
+                return entry
+
+            for old_key in [k for k in self._entries if k[0] == path]:
+                del self._entries[old_key]
+
+            entry = LoadedCaustic(path, max_cube_bytes=self.max_bytes, on_grow=self.evict)
+            self._entries[key] = entry
+            self._evict(entry)
+            return entry
+
+    def evict(self, keep=None):
+        """
+        Drops least recently used entries until the cache fits in max_bytes.
+        keep is never dropped.
+        """
+        with self._lock:
+            self._evict(keep)
+
+    def _evict(self, keep):
+        total = sum(entry.nbytes for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry is keep:
+                continue
+            total -= entry.nbytes
+            del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def statistics(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': sum(entry.nbytes for entry in self._entries.values())}
@@ -0,0 +1,825 @@
+# -*- coding: utf-8 -*-
+"""
+HDF5 file format of the Caustic widget.
+
+Version 1 (written up to OASYS1-LNLS-ShadowOui 0.2.3) stores one gzip dataset
+per plane ('step_001', 'step_002', ...) with the plane properties as dataset
+attributes.
+
+Version 2 stores the whole caustic as one chunked (nz, nx, ny) dataset,
+'caustic', written through a single open file handle. The plane properties are
+rows of the compound 'statistics' table (one row per z), which grows while the
+scan runs and is loaded with a single read. The histogram ranges, which are the
+same for every plane, are file attributes.
+
+Complete version 2 files also hold a multi-resolution pyramid: the 'pyramid'
+group has one subgroup per binning factor (PYRAMID_FACTORS) with a 'caustic'
+cube binned in x and y, with every plane, and its 'z'. Previews read the
+coarsest level that still fills the display (see pyramid_level) instead of the
+full cube; volumes are also averaged in z while they are read (see
+volume_level).
+
+A long scan can also be split in z sub-ranges computed by separate jobs: each
+shard is a version 2 file of its planes that also records the whole scan
+(see CausticWriter), and caustic_batch.merge_shards assembles them.
+
+CausticReader reads both versions through the same interface.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+import h5py
+import numpy as np
+
+try:
+    # registers the Blosc filter, needed to write and read 'blosc-lz4' files
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+from orangecontrib.shadow.lnls.widgets.utility.histogram import image_statistics, rebin_planes
+
+
+CAUSTIC_FORMAT_VERSION = 2
+
+GZIP_LEVEL = 4
+
+# storage options of the caustic dataset
+STORAGE_DTYPES = ['float64', 'float32']
+COMPRESSION_CODECS = ['none', 'gzip', 'lzf', 'blosc-lz4']
+
+# per-plane properties: the columns of the 'statistics' table of version 2 files
+PLANE_COLUMNS = ['z', 'mean_h', 'mean_v', 'rms_h', 'rms_v', 'fwhm_h', 'fwhm_v',
+                 'fwhm_h_shadow', 'fwhm_v_shadow', 'center_h_shadow', 'center_v_shadow', 'peak_h', 'peak_v',
+                 'elapsed_time']
+
+STATISTICS_DTYPE = np.dtype([(name, np.float64) for name in PLANE_COLUMNS])
+
+# binning factors of the pyramid levels, along x and y
+PYRAMID_FACTORS = (2, 4, 8)
+
+
+def caustic_chunk_shape(nz, nx, ny, itemsize=8, target_bytes=2**20, max_cz=8, max_cxy=64):
+    """
+    Chunk shape of the (nz, nx, ny) caustic dataset.
+
+    x and y are split in blocks of at most max_cxy bins and z in slabs of at
+    most max_cz planes, keeping chunks under target_bytes. The XZ and YZ cuts
+    read by the widget only decompress the chunks that contain the requested
+    row or column, e.g. 1/16 of the cube each for 1000 x 1000 bins, at the
+    cost of decompressing a slab of max_cz planes to read a single XY plane.
+    """
+    cx = max(1, min(nx, max_cxy))
+    cy = max(1, min(ny, max_cxy))
+    cz = int(target_bytes // (cx * cy * itemsize))
+    cz = max(1, min(nz, max_cz, cz))
+    return (cz, cx, cy)
+
+def compression_filters(compression='gzip', compression_level=GZIP_LEVEL, shuffle=False):
+    """
+    Keyword arguments of h5py's create_dataset for a codec of
+    COMPRESSION_CODECS. Blosc does its own byte shuffling, so the HDF5
+    shuffle filter is only used by the other codecs.
+    """
+    if compression in [None, 'none']:
+        return {'shuffle': shuffle}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': int(compression_level), 'shuffle': shuffle}
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': shuffle}
+    if compression == 'blosc-lz4':
+        if hdf5plugin is None:
+            raise ImportError("For Blosc compression, please 'pip install hdf5plugin' in the oasys environment")
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=int(compression_level),
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    raise ValueError('Unknown compression codec: {0} (choose from {1})'.format(compression, ', '.join(COMPRESSION_CODECS)))
+
+
+def caustic_run_parameters(z_points, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange,
+                           dtype, compression, compression_level, shuffle, chunks, fingerprint):
+    """
+    JSON string identifying a caustic run: two files with the same string
+    hold the same planes.
+    """
+    parameters = {'z_points': hashlib.sha1(np.ascontiguousarray(z_points, dtype=np.float64).tobytes()).hexdigest(),
+                  'nz': len(z_points),
+                  'zOffset': float(zOffset),
+                  'col_h': int(colh),
+                  'col_v': int(colv),
+                  'col_ref': int(colref),
+                  'nbins_h': int(nbinsh),
+                  'nbins_v': int(nbinsv),
+                  'xrange': [float(xrange[0]), float(xrange[1])],
+                  'yrange': [float(yrange[0]), float(yrange[1])],
+                  'dtype': dtype,
+                  'compression': compression or 'none',
+                  'compression_level': int(compression_level),
+                  'shuffle': bool(shuffle),
+                  'chunks': [int(c) for c in chunks],
+                  'beam_fingerprint': fingerprint or ''}
+    return json.dumps(parameters, sort_keys=True)
+
+
+class CausticWriter(object):
+    """
+    Writes a version 2 caustic file through a single open handle.
+
+    Planes are appended in z order and buffered until a full z-slab of chunks
+    is available, so that every chunk is compressed exactly once. gzip chunks
+    are shuffled and deflated here, with zlib (which releases the GIL), and
+    stored with write_direct_chunk; the result is a standard gzip-filtered
+    dataset. Other codecs go through h5py's filter pipeline.
+
+    dtype, compression (one of COMPRESSION_CODECS), compression_level,
+    shuffle and chunks set the storage of the caustic dataset, and are
+    recorded in the file attributes.
+
+    With background=True the slabs are compressed and written by a writer
+    thread fed by a bounded queue, so that the computation of the next planes
+    overlaps with the compression of the previous ones. append_plane blocks
+    when queue_bytes of planes are waiting (backpressure). Errors of the
+    writer thread are raised by the next append_plane or by close.
+
+    close() always writes the pending planes and sets the 'end time' and
+    'status' attributes; 'status' is 'complete' only when all nz planes were
+    written ('incomplete', 'cancelled' or 'failed' otherwise).
+
+    The run parameters and the fingerprint of the input beam (see
+    caustic.beam_fingerprint) are stored in the file. With resume=True, an
+    existing file of the same run is reopened instead of overwritten, and
+    only the planes from self.start on have to be appended. The mean
+    wavelength of the beam (Angstroms), when given, is stored as the
+    'wavelength' attribute for the beam quality factors of the fits.
+
+    shard, for one z sub-range of a sharded scan, is a dict with the 'index'
+    and 'count' of the shard, the index of its first plane in the scan
+    ('start') and the 'z_points' of the whole scan. They are stored
+    ('shard_index', 'shard_count', 'shard_start' attributes and the
+    'scan_z_points' dataset) with the run parameters of the whole scan
+    ('scan_parameters'), which are the same in every shard of a scan (see
+    merge_shards).
+    """
+
+    def __init__(self, filename, z_points, zOffset, colh, colv, colref, nbinsh, nbinsv,
+                 xrange, yrange, good_rays, offsets=None, chunks=None, background=False, queue_bytes=2**27,
+                 dtype='float64', compression='gzip', compression_level=GZIP_LEVEL, shuffle=False,
+                 resume=False, fingerprint=None, wavelength=None, shard=None):
+
+        z_points = np.asarray(z_points, dtype=float)
+        nz = len(z_points)
+
+        self.filename = filename
+        self.nz = nz
+
+        dtype = np.dtype(dtype)
+        requested_chunks = chunks
+        if chunks is None:
+            chunks = caustic_chunk_shape(nz, nbinsh, nbinsv, itemsize=dtype.itemsize)
+        chunks = tuple(int(min(c, n)) for c, n in zip(chunks, (nz, nbinsh, nbinsv)))
+        filters = compression_filters(compression, compression_level, shuffle)
+
+        # chunks that we can compress ourselves, off h5py's lock
+        self.direct_chunks = (compression == 'gzip')
+        self.compression_level = int(compression_level)
+        self.shuffle = bool(shuffle)
+
+        run_parameters = caustic_run_parameters(z_points, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange,
+                                                dtype.name, compression, compression_level, shuffle, chunks, fingerprint)
+        if shard is not None:
+            # the chunks of a shard depend on its size: the scan records the requested ones
+            shard = dict(shard, parameters=caustic_run_parameters(shard['z_points'], zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange,
+                                                                  dtype.name, compression, compression_level, shuffle,
+                                                                  requested_chunks or [], fingerprint))
+
+        self.f = None
+        self.start = 0
+        if(resume and os.path.isfile(filename)):
+            self._open_for_resume(run_parameters)
+
+        if self.f is None:
+            self._create(z_points, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, good_rays, offsets,
+                         dtype, chunks, filters, compression, compression_level, shuffle, run_parameters, fingerprint,
+                         wavelength, shard)
+
+        self.slab = self.cube.chunks[0]
+        self._start = self.start
+        self._planes = []
+        self._stats = []
+
+        self._error = None
+        self._thread = None
+        if background:
+            plane_bytes = 8 * nbinsh * nbinsv
+            self._queue = queue.Queue(maxsize=max(1, int(queue_bytes // plane_bytes)))
+            self._thread = threading.Thread(target=self._consume, name='CausticWriter', daemon=True)
+            self._thread.start()
+
+    def _create(self, z_points, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, good_rays, offsets,
+                dtype, chunks, filters, compression, compression_level, shuffle, run_parameters, fingerprint,
+                wavelength, shard=None):
+
+        nz = len(z_points)
+        self.f = h5py.File(self.filename, 'w')
+
+        attrs = self.f.attrs
+        attrs['format_version'] = CAUSTIC_FORMAT_VERSION
+        attrs['begin time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        attrs['status'] = 'running'
+        attrs['zStart'] = z_points[0]
+        attrs['zFin'] = z_points[-1]
+        attrs['nz'] = nz
+        attrs['zOffset'] = zOffset
+        attrs['zStep'] = (z_points[-1] - z_points[0]) / (nz - 1) if nz > 1 else 0.0
+        # False for adaptive scans: the planes are then at the z of the statistics table
+        attrs['z_uniform'] = bool(nz < 3 or np.allclose(np.diff(z_points), attrs['zStep'], rtol=1e-6, atol=0))
+        attrs['col_h'] = colh
+        attrs['col_v'] = colv
+        attrs['col_ref'] = colref
+        attrs['nbins_h'] = nbinsh
+        attrs['nbins_v'] = nbinsv
+        attrs['good_rays'] = good_rays
+        if offsets is not None:
+            attrs['offsets'] = offsets
+        if wavelength is not None:
+            attrs['wavelength'] = wavelength
+
+        # bin centers, as the 'xStart'/'xFin' attributes of version 1 planes
+        h_step = (xrange[1] - xrange[0]) / nbinsh
+        v_step = (yrange[1] - yrange[0]) / nbinsv
+        attrs['xStart'] = xrange[0] + h_step / 2.0
+        attrs['xFin'] = xrange[1] - h_step / 2.0
+        attrs['nx'] = nbinsh
+        attrs['yStart'] = yrange[0] + v_step / 2.0
+        attrs['yFin'] = yrange[1] - v_step / 2.0
+        attrs['ny'] = nbinsv
+
+        self.cube = self.f.create_dataset('caustic', shape=(nz, nbinsh, nbinsv), dtype=dtype,
+                                          chunks=chunks, **filters)
+
+        attrs['storage_dtype'] = dtype.name
+        attrs['compression'] = compression or 'none'
+        attrs['compression_level'] = int(compression_level) if compression in ['gzip', 'blosc-lz4'] else 0
+        attrs['shuffle'] = bool(shuffle)
+        attrs['chunks'] = chunks
+
+        # identity of the run, checked when resuming
+        attrs['run_parameters'] = run_parameters
+        attrs['beam_fingerprint'] = fingerprint or ''
+
+        if shard is not None:
+            attrs['shard_index'] = int(shard['index'])
+            attrs['shard_count'] = int(shard['count'])
+            attrs['shard_start'] = int(shard['start'])
+            attrs['scan_parameters'] = shard['parameters']
+            self.f.create_dataset('scan_z_points', data=np.asarray(shard['z_points'], dtype=float))
+
+        # one row per finished plane, appended as the scan goes
+        self.statistics = self.f.create_dataset('statistics', shape=(0,), maxshape=(None,), dtype=STATISTICS_DTYPE,
+                                                chunks=(max(1, min(nz, 1024)),))
+
+    def _open_for_resume(self, run_parameters):
+        """
+        Reopens an interrupted file of the same run; self.start is then the
+        first plane to compute. Files of other runs are left to be
+        overwritten.
+        """
+        try:
+            f = h5py.File(self.filename, 'r+')
+        except OSError:
+            return
+        if('caustic' not in f or 'statistics' not in f or f.attrs.get('run_parameters', '') != run_parameters
+           or f['statistics'].dtype != STATISTICS_DTYPE):
+            f.close()
+            return
+
+        self.f = f
+        self.cube = f['caustic']
+        self.statistics = f['statistics']
+
+        # a chunk is compressed once: the last, partially written z-slab is recomputed
+        done = self.statistics.shape[0]
+        if(done < self.nz):
+            done = (done // self.cube.chunks[0]) * self.cube.chunks[0]
+            self.statistics.resize((done,))
+        self.start = done
+        f.attrs['status'] = 'running'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(status=None if exc_type is None else 'failed')
+
+    def append_plane(self, histogram, stats):
+        """
+        Append the next plane: its (nx, ny) histogram and a dict with the
+        PLANE_COLUMNS values ('z' included).
+        """
+        if self._error is not None:
+            raise self._error
+        if self._thread is not None:
+            self._queue.put((histogram, stats))
+        else:
+            self._append(histogram, stats)
+
+    def _append(self, histogram, stats):
+        self._planes.append(histogram)
+        self._stats.append(stats)
+        if len(self._planes) == self.slab:
+            self.flush()
+
+    def _consume(self):
+        # writer thread: after an error the queue is still drained, so that
+        # the producer never blocks on a full queue
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is None:
+                try:
+                    self._append(*item)
+                except Exception as exception:
+                    self._error = exception
+
+    def _write_slab(self, start, planes):
+        if not self.direct_chunks:
+            self.cube[start:start + len(planes)] = planes
+            return
+
+        cz, cx, cy = self.cube.chunks
+        itemsize = self.cube.dtype.itemsize
+        nplanes, nx, ny = planes.shape
+        for x0 in range(0, nx, cx):
+            for y0 in range(0, ny, cy):
+                # edge chunks are stored full size, padded with the fill value
+                block = planes[:, x0:x0 + cx, y0:y0 + cy]
+                chunk = np.zeros((cz, cx, cy), dtype=self.cube.dtype)
+                chunk[:block.shape[0], :block.shape[1], :block.shape[2]] = block
+                if self.shuffle:
+                    # HDF5 shuffle filter: byte k of every element, then byte k+1...
+                    data = chunk.view(np.uint8).reshape(-1, itemsize).transpose().tobytes()
+                else:
+                    data = chunk.tobytes()
+                self.cube.id.write_direct_chunk((start, x0, y0), zlib.compress(data, self.compression_level))
+
+    def flush(self):
+        if not self._planes:
+            return
+
+        start, stop = self._start, self._start + len(self._planes)
+        self._write_slab(start, np.array(self._planes, dtype=self.cube.dtype))
+
+        rows = np.zeros(stop - start, dtype=STATISTICS_DTYPE)
+        for name in PLANE_COLUMNS:
+            rows[name] = [stats.get(name, np.nan) for stats in self._stats]
+        self.statistics.resize((stop,))
+        self.statistics[start:stop] = rows
+
+        self._start = stop
+        self._planes = []
+        self._stats = []
+        # keep the file consistent on disk, so that a killed run can be resumed
+        self.f.flush()
+
+    def close(self, status=None):
+        """
+        Writes the pending planes and closes the file. status is recorded when
+        the scan did not finish ('cancelled', 'failed'); by default it is
+        'incomplete'. An error of the writer thread is raised whatever the
+        status, once the file is closed.
+        """
+        if self.f is None:
+            return
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        try:
+            if self._error is None:
+                self.flush()
+        finally:
+            if self._start == self.nz:
+                self.f.attrs['status'] = 'complete'
+            else:
+                self.f.attrs['status'] = 'failed' if self._error is not None else (status or 'incomplete')
+            self.f.attrs['end time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            self.f.close()
+            self.f = None
+
+        if self._error is not None:
+            # from __exit__ it is chained to the exception that stopped the scan
+            raise self._error
+
+    @property
+    def complete(self):
+        return self._start == self.nz
+
+
+class CausticReader(object):
+    """
+    Read access to caustic files of any version.
+
+    Planes are always returned as (nx, ny) arrays, i.e. with the layout of
+    Shadow's histo2 'histogram'.
+    """
+
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        self.f = h5py.File(filename, mode)
+        self.attrs = self.f.attrs
+
+        if 'caustic' in self.f:
+            self.version = int(self.attrs.get('format_version', CAUSTIC_FORMAT_VERSION))
+            self.plane_names = []
+            # planes are complete once their statistics row is written
+            self.nz = self.f['statistics'].shape[0]
+        else:
+            self.version = 1
+            # 'histoXZ' and 'histoYZ' share the file root with the planes
+            self.plane_names = sorted([name for name in self.f.keys() if name.startswith('step_')])
+            self.nz = len(self.plane_names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def z_points(self):
+        """
+        Scan coordinates of the planes (without the z offset).
+        """
+        if self.version == 1:
+            return np.linspace(self.attrs['zStart'], self.attrs['zFin'], self.attrs['nz'])
+        return self.f['statistics']['z'] - self.attrs['zOffset']
+
+    def plane_ranges(self):
+        """
+        (nz, 6) array with xStart, xFin, yStart, yFin, nx, ny of every plane.
+        """
+        if self.version == 1:
+            ranges = np.zeros((self.nz, 6))
+            for i, name in enumerate(self.plane_names):
+                attrs = self.f[name].attrs
+                ranges[i] = [attrs['xStart'], attrs['xFin'], attrs['yStart'], attrs['yFin'], attrs['nx'], attrs['ny']]
+            return ranges
+        row = [self.attrs['xStart'], self.attrs['xFin'], self.attrs['yStart'], self.attrs['yFin'], self.attrs['nx'], self.attrs['ny']]
+        return np.tile(np.array(row, dtype=float), (self.nz, 1))
+
+    def read_plane(self, i):
+        if self.version == 1:
+            return np.array(self.f[self.plane_names[i]])
+        return self.f['caustic'][i]
+
+    def read_cuts(self, h_index, v_index):
+        """
+        Cuts of every plane through the bin (h_index, v_index): the h profiles
+        at v_index and the v profiles at h_index. Indices are scalars or one
+        per plane. Only these hyperslabs are read, not the whole planes: for
+        version 2 files two reads of the cube, which decompress the chunks
+        containing the requested row and column.
+
+        Returns
+        -------
+        cuts_h, cuts_v : (nz, nx) and (nz, ny) arrays for version 2 files,
+        lists of nz arrays for version 1 files (whose planes may differ in size).
+        """
+        h_index = np.broadcast_to(np.asarray(h_index, dtype=int), (self.nz,))
+        v_index = np.broadcast_to(np.asarray(v_index, dtype=int), (self.nz,))
+
+        if self.version == 1:
+            cuts_h = [self.f[name][:, v_index[i]] for i, name in enumerate(self.plane_names)]
+            cuts_v = [self.f[name][h_index[i], :] for i, name in enumerate(self.plane_names)]
+            return cuts_h, cuts_v
+
+        # all planes of a version 2 file share the same bins
+        cube = self.f['caustic']
+        return cube[:self.nz, :, int(v_index[0])], cube[:self.nz, int(h_index[0]), :]
+
+    def peak_positions(self):
+        """
+        (peak_h, peak_v) arrays with the position of the maximum of each
+        plane. Taken from the statistics when stored, computed from the
+        planes for files written before they were.
+        """
+        stats = self.statistics()
+        peak_h, peak_v = stats['peak_h'], stats['peak_v']
+        if not np.any(np.isnan(peak_h)):
+            return peak_h, peak_v
+
+        ranges = self.plane_ranges()
+        for start, planes in self.iter_slabs():
+            r = ranges[start]
+            h_centers = np.linspace(r[0], r[1], int(r[4]))
+            v_centers = np.linspace(r[2], r[3], int(r[5]))
+            planes = planes[:self.nz - start]
+            peaks = image_statistics(planes, h_centers, v_centers)
+            peak_h[start:start + len(planes)] = peaks['peak_h']
+            peak_v[start:start + len(planes)] = peaks['peak_v']
+        return peak_h, peak_v
+
+    def iter_slabs(self, factor=1):
+        """
+        Yield (start, planes) for consecutive groups of planes, following the
+        chunking of version 2 files, of the full resolution or of the pyramid
+        level of a binning factor.
+        """
+        if factor > 1:
+            cube = self.f['pyramid'][str(factor)]['caustic']
+            for start in range(0, cube.shape[0], cube.chunks[0]):
+                yield start, cube[start:start + cube.chunks[0]]
+            return
+        if self.version == 1:
+            for i in range(self.nz):
+                yield i, self.read_plane(i)[np.newaxis]
+            return
+        cube = self.f['caustic']
+        slab = cube.chunks[0] if cube.chunks else 1
+        for start in range(0, self.nz, slab):
+            # the last slab stops at nz, even if the cube is longer
+            yield start, cube[start:min(start + slab, self.nz)]
+
+    def statistics(self):
+        """
+        Dict with one array of length nz for each of PLANE_COLUMNS, NaN for
+        the columns the file does not have. Version 2 files need a single
+        read of the statistics table.
+        """
+        if self.version > 1:
+            table = self.f['statistics'][()]
+            return {name: table[name] if name in table.dtype.names else np.full(len(table), np.nan) for name in PLANE_COLUMNS}
+
+        v1_keys = {'z': 'z', 'elapsed_time': 'ellapsed time (s)'}
+        stats = {name: np.full(self.nz, np.nan) for name in PLANE_COLUMNS}
+        for i, dset in enumerate(self.plane_names):
+            attrs = self.f[dset].attrs
+            for name in PLANE_COLUMNS:
+                key = v1_keys.get(name, name)
+                if key in attrs:
+                    # version 1 stores the whole get_fwhm output
+                    stats[name][i] = np.ravel(attrs[key])[0]
+        return stats
+
+    def projections(self):
+        """
+        Caustic integrated over y and over x: (nx, nz) and (ny, nz) arrays.
+        """
+        ranges = self.plane_ranges()
+        histoH = np.zeros((int(ranges[0, 4]), self.nz))
+        histoV = np.zeros((int(ranges[0, 5]), self.nz))
+        for start, planes in self.iter_slabs():
+            histoH[:, start:start + len(planes)] = planes.sum(axis=2, dtype=np.float64).transpose()
+            histoV[:, start:start + len(planes)] = planes.sum(axis=1, dtype=np.float64).transpose()
+        return histoH, histoV
+
+    def pyramid_levels(self):
+        """
+        Dict of the resolution levels in the file, factor -> (z points,
+        [xStart, xFin, yStart, yFin, nx, ny]). Factor 1 is the full
+        resolution; the others are the pyramid levels, if any.
+        """
+        levels = {1: (self.z_points(), self.plane_ranges()[0])}
+        if 'pyramid' in self.f:
+            for level in self.f['pyramid'].values():
+                a = level.attrs
+                ranges = np.array([a['xStart'], a['xFin'], a['yStart'], a['yFin'], a['nx'], a['ny']], dtype=float)
+                levels[int(a['factor'])] = (level['z'][()], ranges)
+        return levels
+
+    def read_level(self, factor, index=None):
+        """
+        Cube of the level of a binning factor, (nz, nx, ny), or its plane
+        index. Factor 1 reads the full resolution.
+        """
+        if factor == 1:
+            if index is not None:
+                return self.read_plane(index)
+            if self.version == 1:
+                return np.array([self.read_plane(i) for i in range(self.nz)])
+            return self.f['caustic'][:self.nz]
+        cube = self.f['pyramid'][str(factor)]['caustic']
+        return cube[()] if index is None else cube[index]
+
+
+def pyramid_level(levels, nx=None, ny=None):
+    """
+    Binning factor of the coarsest of levels (see
+    CausticReader.pyramid_levels) with at least nx x ny bins, e.g. the pixels
+    of the display. Axes given as None are not constrained. Falls back to
+    the full resolution.
+    """
+    for factor in sorted(levels, reverse=True):
+        ranges = levels[factor][1]
+        if((nx is None or ranges[4] >= nx) and (ny is None or ranges[5] >= ny)):
+            return factor
+    return 1
+
+def volume_level(levels, resolution):
+    """
+    Binning factor and z step of a volume with about resolution voxels along
+    each axis, each axis chosen on its own: x and y from the coarsest level
+    with at least resolution bins (see pyramid_level), z by averaging groups
+    of z step planes, keeping at least resolution planes.
+    """
+    factor = pyramid_level(levels, nx=resolution, ny=resolution)
+    return factor, max(1, len(levels[1][0]) // resolution)
+
+def read_volume(reader, factor=1, z_step=1, max_voxels=None, reverse_xy=False, allocate=None):
+    """
+    Caustic volume of a CausticReader (or of a LoadedCaustic of the session
+    cache), at the pyramid level of a binning factor with planes averaged in
+    groups of z_step (see volume_level), as a preallocated (nz, ny, nx)
+    array filled slab by slab: its C order is the x-fastest point order of
+    VTK image data, so volume.transpose() is the (nx, ny, nz) volume without
+    a copy.
+
+    With max_voxels, the volume is decimated further while it is read, by
+    the smallest integer step that fits: bins are summed in x and y and
+    groups of z_step x step planes averaged in z. reverse_xy reverses the x
+    and y axes (the orientation of the 3D viewer). allocate(shape, dtype), if
+    given, returns the array to fill instead of np.zeros (e.g. a view of
+    shared memory, see read_shared_volume).
+
+    Returns
+    -------
+    volume, z : the volume and the z of its planes.
+    """
+    z, ranges = reader.pyramid_levels()[factor]
+    nz, nx, ny = len(z), int(ranges[4]), int(ranges[5])
+
+    step = 1
+    if max_voxels:
+        while (-(-nx // step)) * (-(-ny // step)) * (-(-nz // (z_step * step))) > max_voxels:
+            step += 1
+    group = z_step * step
+    mz, mx, my = -(-nz // group), -(-nx // step), -(-ny // step)
+
+    volume = None
+    counts = np.zeros(mz)
+    for start, planes in reader.iter_slabs(factor):
+        if volume is None:
+            if allocate is None:
+                volume = np.zeros((mz, my, mx), dtype=planes.dtype)
+            else:
+                volume = allocate((mz, my, mx), planes.dtype)
+                volume.fill(0)
+        if step > 1:
+            planes = rebin_planes(planes, step)
+        if reverse_xy:
+            planes = planes[:, ::-1, ::-1]
+        for i, plane in enumerate(planes, start=start):
+            volume[i // group] += plane.transpose()
+            counts[i // group] += 1
+
+    if group > 1:
+        volume /= counts[:, np.newaxis, np.newaxis].astype(volume.dtype)
+        z = np.array([np.mean(z[i:i + group]) for i in range(0, nz, group)])
+    return volume, z
+
+def read_shared_volume(reader, factor=1, z_step=1, max_voxels=None, reverse_xy=False):
+    """
+    Same as read_volume, but the volume is filled directly in a new
+    multiprocessing.shared_memory block, so that another process can map it
+    without a copy (see attach_shared_volume).
+
+    Returns
+    -------
+    shm, volume, z : the block, the volume (a view of shm.buf, to be deleted
+    before shm.close()) and the z of its planes.
+    """
+    from multiprocessing import shared_memory
+
+    blocks = []
+    def allocate(shape, dtype):
+        blocks.append(shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*dtype.itemsize, 1)))
+        return np.ndarray(shape, dtype=dtype, buffer=blocks[0].buf)
+
+    try:
+        volume, z = read_volume(reader, factor=factor, z_step=z_step, max_voxels=max_voxels, reverse_xy=reverse_xy, allocate=allocate)
+    except BaseException:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+        raise
+    if not blocks:
+        raise ValueError('Empty caustic: ' + str(reader.filename))
+    return blocks[0], volume, z
+
+def attach_shared_volume(name, shape, dtype):
+    """
+    Maps the volume of a shared memory block made by read_shared_volume in
+    another process, without a copy. The block belongs to its creator: it is
+    not unlinked when this process exits.
+
+    Returns
+    -------
+    shm, volume : the block and the (nz, ny, nx) volume, a view of shm.buf.
+    """
+    from multiprocessing import shared_memory
+
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13, attaching registers the block to be unlinked at exit
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def write_pyramid(filename, factors=PYRAMID_FACTORS):
+    """
+    Writes the pyramid levels of a complete version 2 file, replacing the
+    previous ones. Level f sums f x f bins in x and y (a coarser histogram)
+    and keeps every plane, so that its XY maps are not averaged in z; each
+    factor must divide the next one, since every level is binned from the
+    previous one.
+
+    The cube is read once, and the XZ and YZ projections (see
+    CausticReader.projections) are computed in the same pass and returned.
+    Version 1 files get no pyramid.
+    """
+    if any(f % previous for previous, f in zip((1,) + tuple(factors), factors)):
+        raise ValueError('Each pyramid factor must divide the next one: {0}'.format(factors))
+
+    with CausticReader(filename, mode='a') as reader:
+        if reader.version == 1:
+            return reader.projections()
+
+        z_points = reader.z_points()
+        ranges = reader.plane_ranges()[0]
+        if 'pyramid' in reader.f:
+            del reader.f['pyramid']
+        group = reader.f.create_group('pyramid')
+        levels = [_PyramidLevel(group, factor, z_points, ranges, reader.f['caustic'].dtype) for factor in factors]
+
+        histoH = np.zeros((int(ranges[4]), reader.nz))
+        histoV = np.zeros((int(ranges[5]), reader.nz))
+        for start, planes in reader.iter_slabs():
+            histoH[:, start:start + len(planes)] = planes.sum(axis=2, dtype=np.float64).transpose()
+            histoV[:, start:start + len(planes)] = planes.sum(axis=1, dtype=np.float64).transpose()
+
+            binned, previous = planes, 1
+            for level in levels:
+                binned = rebin_planes(binned, level.factor // previous)
+                previous = level.factor
+                level.add(binned)
+
+        for level in levels:
+            level.flush(final=True)
+
+    return histoH, histoV
+
+
+class _PyramidLevel(object):
+    """
+    A pyramid level being written: planes already binned in x and y arrive in
+    z order and are written by whole chunks.
+    """
+
+    def __init__(self, group, factor, z_points, ranges, dtype):
+        nz, nx, ny = len(z_points), int(ranges[4]), int(ranges[5])
+        mx, my = -(-nx // factor), -(-ny // factor)
+        self.factor = factor
+
+        # bin centers of the coarse bins, which start at the first edge
+        h_step = (ranges[1] - ranges[0]) / (nx - 1) if nx > 1 else 0.0
+        v_step = (ranges[3] - ranges[2]) / (ny - 1) if ny > 1 else 0.0
+        level = group.create_group(str(factor))
+        level.attrs['factor'] = factor
+        level.attrs['xStart'] = ranges[0] + 0.5 * (factor - 1) * h_step
+        level.attrs['xFin'] = level.attrs['xStart'] + (mx - 1) * factor * h_step
+        level.attrs['nx'] = mx
+        level.attrs['yStart'] = ranges[2] + 0.5 * (factor - 1) * v_step
+        level.attrs['yFin'] = level.attrs['yStart'] + (my - 1) * factor * v_step
+        level.attrs['ny'] = my
+        level.create_dataset('z', data=z_points)
+
+        self.cube = level.create_dataset('caustic', shape=(nz, mx, my), dtype=dtype,
+                                         chunks=caustic_chunk_shape(nz, mx, my, itemsize=dtype.itemsize),
+                                         **compression_filters('gzip', GZIP_LEVEL))
+        self._planes = []
+        self._next = 0
+
+    def add(self, binned):
+        self._planes.extend(binned)
+        self.flush()
+
+    def flush(self, final=False):
+        cz = self.cube.chunks[0]
+        n = len(self._planes) if final else (len(self._planes) // cz) * cz
+        if n > 0:
+            self.cube[self._next:self._next + n] = np.array(self._planes[:n])
+            self._next += n
+            self._planes = self._planes[n:]
@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+"""
+Weighted 2D histogram kernel shared by the Caustic and Beam Analysis widgets.
+
+The kernel bins a whole stack of (h, v, weight) batches: for each batch the
+bin indices are computed as flat integers (h bin, v bin) and accumulated by
+a single numpy.bincount, so the integer temporaries never grow with the
+number of batches. The binning convention is the one of
+numpy.histogram2d, which is what Shadow's histo2 uses: bins are closed on the
+left, and the last bin also includes the upper edge.
+
+The module also holds kernels that work on whole stacks of binned data:
+image_statistics (peak, centroid, RMS and integral of 2D histograms),
+fwhm_stack, which runs the half-maximum scan of get_fwhm, the per-profile
+FWHM of the Caustic widget kept as the reference, on every profile at once,
+resample_profiles (profiles with different grids mapped onto a common one)
+and rebin_planes (coarser histograms of a stack of planes).
+"""
+
+import numpy as np
+from scipy.interpolate import interp1d
+
+
+def bin_indices(x, xrange, nbins):
+    """
+    Bin index of every value of x in nbins equal bins spanning xrange.
+    Values outside the range get the index nbins.
+    """
+    xmin, xmax = float(xrange[0]), float(xrange[1])
+    edges = np.linspace(xmin, xmax, nbins + 1)
+
+    idx = np.floor((x - xmin) * (nbins / (xmax - xmin)))
+    # fmax/fmin (unlike clip) also map NaN to a valid index
+    np.fmax(idx, 0, out=idx)
+    np.fmin(idx, nbins - 1, out=idx)
+    idx = idx.astype(np.intp)
+
+    # the index computation may be off by one within ~1 ULP of the edges
+    idx[x < edges[idx]] -= 1
+    idx[(x >= edges[idx + 1]) & (idx != nbins - 1)] += 1
+
+    idx[(x < xmin) | (x > xmax) | np.isnan(x)] = nbins
+    return idx
+
+def histogram2d_stack(h, v, weights, xrange, yrange, nbins_h, nbins_v, dtype=np.float64):
+    """
+    Weighted 2D histograms of a stack of batches.
+
+    Parameters
+    ----------
+    h, v : array
+        Horizontal and vertical coordinates, shape (nbatch, nrays) or (nrays,).
+    weights : array or None
+        Weight of each ray, shape (nrays,) (shared by all batches) or the same
+        shape as h. None counts the rays.
+    xrange, yrange : list
+        [min, max] of the histograms.
+    nbins_h, nbins_v : int
+        Number of bins.
+    dtype : numpy dtype, optional
+        dtype of the returned histogram stack. np.float32 halves its memory;
+        marginals and moments are always computed in float64.
+
+    Returns
+    -------
+    dict
+        'histogram' (nbatch, nbins_h, nbins_v), 'histogram_h' (nbatch, nbins_h),
+        'histogram_v' (nbatch, nbins_v), 'bin_h_edges', 'bin_v_edges',
+        'bin_h_center', 'bin_v_center', 'intensity' (nbatch,) and the first and
+        second binned moments 'mean_h', 'mean_v', 'rms_h', 'rms_v' (nbatch,).
+    """
+    h = np.atleast_2d(h)
+    v = np.atleast_2d(v)
+    nbatch = h.shape[0]
+    nbins = nbins_h * nbins_v
+
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        if(weights.ndim == 1):
+            weights = weights[np.newaxis, :]
+
+    counts = np.empty((nbatch, nbins_h, nbins_v))
+
+    for i in range(nbatch):
+        ih = bin_indices(h[i], xrange, nbins_h)
+        iv = bin_indices(v[i], yrange, nbins_v)
+
+        # flat index of (h bin, v bin); rays out of range go to a dump bin
+        flat = ih * nbins_v
+        flat += iv
+        flat[(ih == nbins_h) | (iv == nbins_v)] = nbins
+
+        row_weights = None if weights is None else weights[i if len(weights) > 1 else 0]
+        counts[i] = np.bincount(flat, weights=row_weights, minlength=nbins + 1)[:nbins].reshape(nbins_h, nbins_v)
+
+    h_edges = np.linspace(xrange[0], xrange[1], nbins_h + 1)
+    v_edges = np.linspace(yrange[0], yrange[1], nbins_v + 1)
+
+    stack = {'histogram': counts.astype(dtype, copy=False),
+             'bin_h_edges': h_edges,
+             'bin_v_edges': v_edges,
+             'bin_h_center': 0.5 * (h_edges[:-1] + h_edges[1:]),
+             'bin_v_center': 0.5 * (v_edges[:-1] + v_edges[1:]),
+             'histogram_h': counts.sum(axis=2),
+             'histogram_v': counts.sum(axis=1)}
+
+    stack['intensity'] = stack['histogram_h'].sum(axis=1)
+    stack['mean_h'], stack['rms_h'] = marginal_moments(stack['bin_h_center'], stack['histogram_h'])
+    stack['mean_v'], stack['rms_v'] = marginal_moments(stack['bin_v_center'], stack['histogram_v'])
+
+    return stack
+
+def histogram1d_stack(x, weights, xrange, nbins):
+    """
+    Weighted 1D histograms of a stack of batches, as a (nbatch, nbins) array.
+    x and weights follow the conventions of histogram2d_stack.
+    """
+    x = np.atleast_2d(x)
+    nbatch = x.shape[0]
+
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        if(weights.ndim == 1):
+            weights = weights[np.newaxis, :]
+
+    counts = np.empty((nbatch, nbins))
+    for i in range(nbatch):
+        row_weights = None if weights is None else weights[i if len(weights) > 1 else 0]
+        counts[i] = np.bincount(bin_indices(x[i], xrange, nbins), weights=row_weights, minlength=nbins + 1)[:nbins]
+    return counts
+
+def marginal_moments(centers, profiles):
+    """
+    Weighted mean and standard deviation of the bin centers for each profile
+    of a (nbatch, nbins) stack. Empty profiles give NaN.
+    """
+    profiles = np.atleast_2d(profiles)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = profiles.sum(axis=1)
+        mean = profiles.dot(centers) / total
+        variance = np.einsum('ij,ij->i', profiles, np.square(centers[np.newaxis, :] - mean[:, np.newaxis])) / total
+    return mean, np.sqrt(variance)
+
+def image_statistics(images, h_centers=None, v_centers=None):
+    """
+    Peak, centroid, RMS, marginal peaks and integral of a 2D histogram or of
+    each image of a (nz, nh, nv) stack, in a few vectorized passes. The first
+    image axis is h and the second v, as in histogram2d_stack.
+
+    Parameters
+    ----------
+    images : array
+        (nh, nv) image or (nz, nh, nv) stack.
+    h_centers, v_centers : array, optional
+        Bin centers. Positions are bin indices and the integral is the plain
+        sum when they are not given.
+
+    Returns
+    -------
+    dict
+        'peak' (maximum), 'peak_h_index', 'peak_v_index' (first maximum in
+        C order), 'peak_h', 'peak_v', 'mean_h', 'mean_v',
+        'rms_h', 'rms_v', 'marginal_peak_h', 'marginal_peak_v' (maximum of
+        the projections) and 'integral'. Scalars for a single image, (nz,)
+        arrays for a stack.
+    """
+    single = (np.ndim(images) == 2)
+    images = np.asarray(images)
+    if single:
+        images = images[np.newaxis]
+    nz, nh, nv = images.shape
+
+    h_centers = np.arange(nh, dtype=np.float64) if h_centers is None else np.asarray(h_centers, dtype=np.float64)
+    v_centers = np.arange(nv, dtype=np.float64) if v_centers is None else np.asarray(v_centers, dtype=np.float64)
+    dh = (h_centers[-1] - h_centers[0]) / (nh - 1) if nh > 1 else 1.0
+    dv = (v_centers[-1] - v_centers[0]) / (nv - 1) if nv > 1 else 1.0
+
+    flat = images.reshape(nz, nh * nv).argmax(axis=1)
+    peak_h_index, peak_v_index = np.divmod(flat, nv)
+
+    profile_h = images.sum(axis=2, dtype=np.float64)
+    profile_v = images.sum(axis=1, dtype=np.float64)
+    mean_h, rms_h = marginal_moments(h_centers, profile_h)
+    mean_v, rms_v = marginal_moments(v_centers, profile_v)
+
+    stats = {'peak': images[np.arange(nz), peak_h_index, peak_v_index].astype(np.float64),
+             'peak_h_index': peak_h_index,
+             'peak_v_index': peak_v_index,
+             'peak_h': h_centers[peak_h_index],
+             'peak_v': v_centers[peak_v_index],
+             'mean_h': mean_h,
+             'mean_v': mean_v,
+             'rms_h': rms_h,
+             'rms_v': rms_v,
+             'marginal_peak_h': h_centers[profile_h.argmax(axis=1)],
+             'marginal_peak_v': v_centers[profile_v.argmax(axis=1)],
+             'integral': profile_h.sum(axis=1) * dh * dv}
+
+    if single:
+        stats = {key: value[0] for key, value in stats.items()}
+    return stats
+
+class _ProfileSamples(object):
+    """
+    Samples of a stack of profiles on the grid scanned by get_fwhm: the
+    profiles themselves, or for oversampling > 1 their linear interpolation on
+    int(nbins*oversampling) points. Only the requested samples are computed,
+    with np.interp as interp1d does, so they are identical to get_fwhm's.
+
+    The samples between two consecutive x form a run on which they are
+    monotonic, so a run holds a sample above (or below) a level exactly when
+    one of its two end samples does.
+    """
+
+    def __init__(self, x, profiles, oversampling):
+        self.fine = oversampling > 1.0
+        if self.fine:
+            # interp1d sorts x (stable sort)
+            order = np.argsort(x, kind='mergesort')
+            x, profiles = x[order], profiles[:, order]
+            self.grid = np.linspace(np.min(x), np.max(x), int(len(x)*oversampling))
+            segment = np.clip(np.searchsorted(x, self.grid, side='right') - 1, 0, len(x) - 2)
+            self.run_start = np.flatnonzero(np.diff(segment, prepend=-1))
+            self.window = int(np.ceil(oversampling)) + 2
+        else:
+            self.grid = x
+            self.run_start = np.arange(len(x))
+            self.window = len(x)
+
+        self.x = x
+        self.profiles = profiles
+        self.size = len(self.grid)
+        self.run_end = np.append(self.run_start[1:] - 1, self.size - 1)
+
+        rows = np.arange(len(profiles))
+        ends = self.values(rows, np.tile(np.concatenate([self.run_start, self.run_end]), (len(rows), 1)))
+        ends = ends.reshape(len(rows), 2, -1)
+        self.run_max = ends.max(axis=1)
+        self.run_min = ends.min(axis=1)
+
+    def values(self, rows, idx):
+        if not self.fine:
+            return self.profiles[rows[:, np.newaxis], idx]
+        values = np.empty(idx.shape)
+        for n, row in enumerate(rows):
+            values[n] = np.interp(self.grid[idx[n]], self.x, self.profiles[row])
+        return values
+
+    def mirror(self):
+        return _MirroredSamples(self)
+
+
+class _MirroredSamples(object):
+    """
+    _ProfileSamples read from the last sample to the first, so that the scan
+    on the right of the peak is the scan on the left of the mirrored profile.
+    """
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.size = samples.size
+        self.window = samples.window
+        self.run_start = self.size - 1 - samples.run_end[::-1]
+        self.run_end = self.size - 1 - samples.run_start[::-1]
+        self.run_max = samples.run_max[:, ::-1]
+        self.run_min = samples.run_min[:, ::-1]
+
+    def values(self, rows, idx):
+        return self.samples.values(rows, self.size - 1 - idx)
+
+    def mirror(self):
+        return self.samples
+
+
+def _first_run_sample(samples, in_run, start):
+    """
+    Start of the first run holding a sample flagged by in_run (nbatch, nruns)
+    at or after start, but not before start; samples.size if there is none.
+    """
+    in_run = in_run & (samples.run_end[np.newaxis, :] >= start[:, np.newaxis])
+    run = in_run.argmax(axis=1)
+    return np.where(in_run.any(axis=1), np.maximum(start, samples.run_start[run]), samples.size)
+
+def _first_true(samples, rows, start, stop, condition, level):
+    """
+    First index i in [start, stop) of each row for which
+    condition(sample i-1, sample i, level) holds, or stop. The samples are
+    computed window by window, for the rows still searching.
+    """
+    found = np.array(stop)
+    position = np.array(start)
+    searching = position < stop
+    steps = np.arange(samples.window + 1) - 1
+
+    while np.any(searching):
+        sel = np.flatnonzero(searching)
+        idx = position[sel, np.newaxis] + steps
+        values = samples.values(rows[sel], np.clip(idx, 0, samples.size - 1))
+
+        hit = condition(values[:, :-1], values[:, 1:], level[sel, np.newaxis]) & (idx[:, 1:] < stop[sel, np.newaxis])
+        has_hit = hit.any(axis=1)
+        found[sel[has_hit]] = idx[has_hit, 1 + hit[has_hit].argmax(axis=1)]
+
+        position[sel] += samples.window
+        searching[sel] = ~has_hit & (position[sel] < stop[sel])
+
+    return found
+
+def _crossed(previous, current, level):
+    # get_fwhm: the previous sample is above the level and closer to it
+    return ((previous - level) > 0) & (np.abs(current - level) > np.abs(previous - level))
+
+def _left_crossing(samples, rows, peak, level, inmost, wrap):
+    """
+    get_fwhm's scan on the left of the peak: the first index i with
+    _crossed(sample i-1, sample i) or, if there is none, peak - 1. With wrap
+    the scan starts at i = 0, whose previous sample is the last one.
+    """
+    if inmost:
+        # after the last sample at or below the level before the peak
+        mirrored = samples.mirror()
+        start = mirrored.size - peak
+        below = _first_true(mirrored, rows, _first_run_sample(mirrored, mirrored.run_min <= level[:, np.newaxis], start),
+                            np.full(len(rows), mirrored.size), lambda previous, current, level: current <= level, level)
+        start = np.maximum(samples.size - below, 1)
+    else:
+        start = np.ones(len(rows), dtype=int)
+
+    # no crossing before the first sample above the level
+    start = np.maximum(start, _first_run_sample(samples, samples.run_max > level[:, np.newaxis], start - 1))
+    left = _first_true(samples, rows, start, peak, _crossed, level)
+    left = np.where(left < peak, left, peak - 1)
+
+    if wrap:
+        ends = samples.values(rows, np.tile([samples.size - 1, 0], (len(rows), 1)))
+        left[_crossed(ends[:, 0], ends[:, 1], level)] = 0
+    left[peak == 0] = 0
+    return left
+
+def fwhm_stack(x, profiles, threshold=0.5, inmost_outmost=1, oversampling=1):
+    """
+    Vectorized get_fwhm: full width at threshold * maximum of each profile of
+    a (nbatch, nbins) stack sampled at x.
+
+    The crossings are found with the scan of get_fwhm, on the same samples:
+    for oversampling > 1 the profiles interpolated on int(nbins*oversampling)
+    points, of which only the runs around the peak and the crossings are
+    computed. With threshold = 0.5 and inmost_outmost = 1 the result is
+    identical to get_fwhm(x, profile, oversampling)[:3], including where
+    get_fwhm fails with a peak on the second last sample (the last sample is
+    then the right crossing). inmost_outmost = 0 starts the scan on each side
+    from the last sample at or below the threshold before the peak, instead
+    of from the edges.
+
+    Returns
+    -------
+    fwhm, x_left, x_right : array
+        Shape (nbatch,).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=np.float64))
+    rows = np.arange(len(profiles))
+    inmost = (inmost_outmost == 0)
+
+    samples = _ProfileSamples(x, profiles, oversampling)
+    mirrored = samples.mirror()
+
+    # first maximum, as idx_peak of get_fwhm
+    y_peak = samples.run_max.max(axis=1)
+    run = (samples.run_max == y_peak[:, np.newaxis]).argmax(axis=1)
+    peak = _first_true(samples, rows, samples.run_start[run], samples.run_end[run] + 1,
+                       lambda previous, current, level: current == level, y_peak)
+
+    level = threshold * y_peak
+    left = _left_crossing(samples, rows, peak, level, inmost, wrap=not inmost)
+    right = samples.size - 1 - _left_crossing(mirrored, rows, samples.size - 1 - peak, level, inmost, wrap=False)
+
+    x_left, x_right = samples.grid[left], samples.grid[right]
+    return x_right - x_left, x_left, x_right
+
+def resample_profiles(profiles, starts, stops, x):
+    """
+    Linear resampling at the points x of profiles sampled on uniform grids
+    linspace(starts[i], stops[i], len(profiles[i])), all profiles at once.
+
+    Outside its own grid a profile decreases linearly to zero at x[0] and
+    x[-1], as when padding it with zeros at the ends of x. When every
+    profile is already sampled at x, they are returned as they are.
+
+    Parameters
+    ----------
+    profiles : array or list of arrays
+        (nprofiles, n) array, or nprofiles arrays of different lengths.
+    starts, stops : array
+        First and last sample of each profile, shape (nprofiles,).
+    x : array
+        Increasing points covering all grids.
+
+    Returns
+    -------
+    array
+        (len(x), nprofiles) array, one resampled profile per column.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.float64)
+    stops = np.asarray(stops, dtype=np.float64)
+    lengths = np.array([len(profile) for profile in profiles])
+    nprofiles = len(lengths)
+
+    if np.all(lengths == len(x)) and np.all(starts == x[0]) and np.all(stops == x[-1]):
+        return np.array(profiles, dtype=np.float64).transpose()
+
+    values = np.zeros((nprofiles, lengths.max()))
+    for i, profile in enumerate(profiles):
+        values[i, :lengths[i]] = profile
+
+    starts, stops, lengths = starts[:, np.newaxis], stops[:, np.newaxis], lengths[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # fractional index of x in each grid
+        u = (x - starts) / (stops - starts) * (lengths - 1)
+        u = np.where(lengths > 1, u, 0.0)
+        k = np.clip(np.floor(u), 0, np.maximum(lengths - 2, 0)).astype(np.intp)
+        t = np.clip(u - k, 0.0, 1.0)
+        k1 = np.minimum(k + 1, lengths - 1)
+        inside = (1.0 - t) * np.take_along_axis(values, k, axis=1) + t * np.take_along_axis(values, k1, axis=1)
+
+        first = values[:, :1]
+        last = np.take_along_axis(values, lengths - 1, axis=1)
+        left = first * (x - x[0]) / (starts - x[0])
+        right = last * (x[-1] - x) / (x[-1] - stops)
+
+    resampled = np.where(x < starts, left, np.where(x > stops, right, inside))
+    return resampled.transpose()
+
+def rebin_planes(planes, factor):
+    """
+    Sums blocks of factor x factor bins of a (n, nx, ny) stack of 2D
+    histograms. When nx or ny is not a multiple of factor, the last blocks
+    are completed with empty bins: the result has ceil(nx/factor) x
+    ceil(ny/factor) bins, the first of which starts at the first bin edge.
+    """
+    planes = np.asarray(planes)
+    n, nx, ny = planes.shape
+    mx, my = -(-nx // factor), -(-ny // factor)
+    if (mx * factor, my * factor) != (nx, ny):
+        padded = np.zeros((n, mx * factor, my * factor), dtype=planes.dtype)
+        padded[:, :nx, :ny] = planes
+        planes = padded
+    return planes.reshape(n, mx, factor, my, factor).sum(axis=(2, 4))
+
+def get_fwhm(x, y, oversampling=1, zero_padding=False, avg_correction=False, debug=False):
+    """
+    FWHM of a single profile by scanning for the half-maximum samples, on an
+    optionally oversampled copy of the profile. Returns [fwhm, x_left,
+    x_right, y_left, y_right]. fwhm_stack is the vectorized version.
+    """
+
+    def add_zeros(array):
+        aux = []
+        aux.append(0)
+        for i in range(len(array)):
+            aux.append(array[i])
+        aux.append(0)
+        return np.array(aux)
+
+    def add_steps(array):
+        aux = []
+        step = (np.max(array)-np.min(array))/(len(array)-1)
+        aux.append(array[0]-step)
+        for i in range(len(array)):
+            aux.append(array[i])
+        aux.append(array[-1]+step)
+        return np.array(aux)
+
+    def interp_distribution(array_x,array_y,oversampling):
+        dist = interp1d(array_x, array_y)
+        x_int = np.linspace(np.min(array_x), np.max(array_x), int(len(x)*oversampling))
+        y_int = dist(x_int)
+        return x_int, y_int
+
+    if(oversampling > 1.0):
+        array_x, array_y = interp_distribution(x, y, oversampling)
+    else:
+        array_x, array_y = x, y
+
+    if(zero_padding):
+        array_x = add_steps(x)
+        array_y = add_zeros(y)
+
+    try:
+        y_peak = np.max(array_y)
+        idx_peak = (np.abs(array_y-y_peak)).argmin()
+        if(idx_peak==0):
+            left_hwhm_idx = 0
+        else:
+            for i in range(0,idx_peak):
+                if np.abs(array_y[i]-y_peak/2)>np.abs(array_y[i-1]-y_peak/2) and (array_y[i-1]-y_peak/2)>0:
+                    break
+            left_hwhm_idx = i
+
+        if(idx_peak==len(array_y)-1):
+            right_hwhm_idx = len(array_y)-1
+        else:
+            for j in range(len(array_y)-2, idx_peak, -1):
+                if np.abs(array_y[j]-y_peak/2)>np.abs(array_y[j+1]-y_peak/2) and (array_y[j+1]-y_peak/2)>0:
+                    break
+            right_hwhm_idx = j
+
+        fwhm = array_x[right_hwhm_idx] - array_x[left_hwhm_idx]
+
+        if(avg_correction):
+            avg_y = (array_y[left_hwhm_idx]+array_y[right_hwhm_idx])/2.0
+            popt_left = np.polyfit(np.array([array_x[left_hwhm_idx-1],array_x[left_hwhm_idx],array_x[left_hwhm_idx+1]]),
+                                   np.array([array_y[left_hwhm_idx-1],array_y[left_hwhm_idx],array_y[left_hwhm_idx+1]]),1)
+            popt_right = np.polyfit(np.array([array_x[right_hwhm_idx-1],array_x[right_hwhm_idx],array_x[right_hwhm_idx+1]]),
+                                   np.array([array_y[right_hwhm_idx-1],array_y[right_hwhm_idx],array_y[right_hwhm_idx+1]]),1)
+            x_left = (avg_y-popt_left[1])/popt_left[0]
+            x_right = (avg_y-popt_right[1])/popt_right[0]
+            fwhm = x_right - x_left
+
+            return [fwhm, x_left, x_right, avg_y, avg_y]
+        else:
+            return [fwhm, array_x[left_hwhm_idx], array_x[right_hwhm_idx], array_y[left_hwhm_idx], array_y[right_hwhm_idx]]
+
+    except ValueError:
+        fwhm = 0.0
+        print("Could not calculate fwhm\n")
+        return [fwhm, 0, 0, 0, 0]
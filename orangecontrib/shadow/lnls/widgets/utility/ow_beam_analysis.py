@@ -2,6 +2,7 @@ import sys
 import time
 
 from orangecontrib.shadow.lnls.widgets.utility.plot import plot_beam
+from orangecontrib.shadow.lnls.widgets.utility.histogram import histogram2d_stack
 
 import numpy
 from PyQt5 import QtGui, QtWidgets
@@ -692,11 +693,22 @@ class PlotXY(AutomaticElement):
      
     def read_shadow_beam(self, beam):   
 
-        histo2D = beam.histo2(col_h=self.x_column_index+1, col_v=self.y_column_index+1, nbins_h=self.number_of_binsX, nbins_v=self.number_of_binsY, nolost=self.rays, ref=self.weight_column_index)
+        col_h = self.x_column_index+1
+        col_v = self.y_column_index+1
+        
+        if(self.weight_column_index == 0):
+            weights = None
+        else:
+            weights = beam.getshonecol(self.weight_column_index, nolost=self.rays)
+        
+        histo2D = histogram2d_stack(beam.getshonecol(col_h, nolost=self.rays), beam.getshonecol(col_v, nolost=self.rays), weights,
+                                    xrange=beam.get_good_range(icol=col_h, nolost=self.rays),
+                                    yrange=beam.get_good_range(icol=col_v, nolost=self.rays),
+                                    nbins_h=self.number_of_binsX, nbins_v=self.number_of_binsY)
         
         x_axis = histo2D['bin_h_center']
         z_axis = histo2D['bin_v_center']
-        xz = histo2D['histogram']
+        xz = histo2D['histogram'][0]
                     
         XZ = numpy.zeros((self.number_of_binsY+1,self.number_of_binsX+1))
         XZ[1:,0] = z_axis
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import importlib.util
 import os
-
+import subprocess
 import sys
+import threading
 import time
 #import numpy
 import h5py
@@ -11,8 +13,6 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
 from matplotlib.colors import LogNorm
 import numpy as np
-from scipy.optimize import curve_fit
-from scipy.interpolate import interp1d
 
 from orangewidget import gui, widget
 from orangewidget.settings import Setting
@@ -20,17 +20,47 @@ from oasys.widgets import gui as oasysgui
 from oasys.util.oasys_util import EmittingStream, TTYGrabber
 from oasys.widgets import congruence
 from silx.gui.plot.Colormap import Colormap
-from PyQt5 import QtWidgets
+from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtGui import QTextCursor
 from PyQt5.QtGui import QPalette, QColor, QFont
 
 import orangecanvas.resources as resources
 from orangecontrib.shadow.lnls.widgets.gui.ow_lnls_shadow_widget_c import LNLSShadowWidgetC
+from orangecontrib.shadow.lnls.widgets.utility.caustic import SecondMomentCaustic, beam_quality_factor, fit_gaussian_beams, gaussian_beam
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import CausticWriter, CausticReader, STORAGE_DTYPES, COMPRESSION_CODECS, \
+    pyramid_level, read_shared_volume, volume_level
+from orangecontrib.shadow.lnls.widgets.utility.caustic_cache import CausticCache, CausticSessionCache
+from orangecontrib.shadow.lnls.widgets.utility.caustic_batch import run_caustic, summarize_caustic, plane_statistics, good_ranges, print_cache_statistics, \
+    storage_options, weighted_avg_and_std
+from orangecontrib.shadow.lnls.widgets.utility.histogram import fwhm_stack, get_fwhm, resample_profiles
 from orangecontrib.shadow.util.shadow_objects import ShadowBeam
 import Shadow.ShadowTools as st
 from orangecontrib.shadow.util.shadow_util import ShadowCongruence
 
 
+class CausticTask(QtCore.QThread):
+    """
+    Runs function(**kwargs) out of the GUI thread. The function reports
+    progress through self.progress.emit; its result or exception is delivered
+    by the done or failed signals, in the GUI thread.
+    """
+    progress = QtCore.pyqtSignal(object)
+    done = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(object)
+
+    def __init__(self, function, **kwargs):
+        super().__init__()
+        self.function = function
+        self.kwargs = kwargs
+
+    def run(self):
+        try:
+            result = self.function(**self.kwargs)
+        except Exception as exception:
+            self.failed.emit(exception)
+        else:
+            self.done.emit(result)
+
     
 class CausticWidget(LNLSShadowWidgetC):
     name = "Caustic"
@@ -66,6 +96,20 @@ class CausticWidget(LNLSShadowWidgetC):
     z_step = Setting(0.1)
     nz = Setting(101)
     z_offset = Setting(0.0)
+    n_processes = Setting(1)
+    resume = Setting(0)
+    caustic_mode = Setting(0)
+    z_sampling = Setting(0)
+    z_tolerance = Setting(0.01)
+    z_max_planes = Setting(301)
+    storage_dtype = Setting(0)
+    compression_codec = Setting(1)
+    compression_level = Setting(4)
+    shuffle = Setting(0)
+    chunk_shape = Setting('auto')
+    use_cache = Setting(1)
+    cache_size = Setting(2000)
+    cache_directory = Setting('')
     save_filename = Setting('caustic_to_save.h5')
     load_filename = Setting('caustic_to_load.h5')
     
@@ -87,10 +131,20 @@ class CausticWidget(LNLSShadowWidgetC):
     plot2D_z_range_maxYZ = Setting(0.0)    
     scale = Setting(0)
     quick_preview = Setting(1)
+    memory_cache_size = Setting(1000)
+    fit_refine = Setting(0)
+    volume_resolution = Setting(512)
     
     def __init__(self):
         super().__init__()
         
+        # files loaded for plotting, kept in memory between refreshes
+        self.session_cache = CausticSessionCache(max_bytes=self.memory_cache_size*1024**2)
+        
+        # scan or file loading running in the background (one at a time)
+        self.task = None
+        self.cancel_event = threading.Event()
+        
         ############### CONTROL AREA #####################        
         self.controlArea.setFixedWidth(self.CONTROL_AREA_WIDTH)
         
@@ -102,12 +156,15 @@ class CausticWidget(LNLSShadowWidgetC):
         
 
         ### Tabs inside control area ###
-        tab1 = oasysgui.createTabPage(self.tabs_setting, "Run Options", height=840)
+        tab1 = oasysgui.createTabPage(self.tabs_setting, "Run Options", height=1130)
         tab2 = oasysgui.createTabPage(self.tabs_setting, "Plot Options" )
 
 
         ### Run Options Tab
-        gui.button(tab1, self, "Run Caustic", callback=self.run_caustic, height=35,width=100)
+        run_box = oasysgui.widgetBox(tab1, "", addSpace=False, orientation="horizontal")
+        self.run_button = gui.button(run_box, self, "Run Caustic", callback=self.run_caustic, height=35,width=100)
+        self.cancel_button = gui.button(run_box, self, "Cancel", callback=self.cancel_task, height=35,width=100)
+        self.cancel_button.setEnabled(False)
         general_box = oasysgui.widgetBox(tab1, "Variables Settings", addSpace=True, orientation="vertical", height=380)
 
         gui.checkBox(general_box, self, "auto_xy_ranges", "Internal Calculated X,Y Ranges", callback=self.calc_rangesXY)
@@ -246,15 +303,41 @@ class CausticWidget(LNLSShadowWidgetC):
                                          ],
                                          sendSelectedValue=False, orientation="horizontal")
        
-        caustic_box = oasysgui.widgetBox(tab1, "Caustic Settings", addSpace=True, orientation="vertical", height=220)        
+        caustic_box = oasysgui.widgetBox(tab1, "Caustic Settings", addSpace=True, orientation="vertical", height=400)        
+
+        gui.comboBox(caustic_box, self, "caustic_mode", label="Caustic Mode", labelWidth=120,
+                     items=["Histograms (HDF5 file)", "Second moments (analytic)"], sendSelectedValue=False, orientation="horizontal")
 
-        self.zrange_box = oasysgui.widgetBox(caustic_box, "", addSpace=True, orientation="vertical", height=180)
+        self.zrange_box = oasysgui.widgetBox(caustic_box, "", addSpace=True, orientation="vertical", height=330)
         oasysgui.lineEdit(self.zrange_box, self, "z_range_min", "Z Min [mm]", callback=self.step_and_nz, labelWidth=260, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(self.zrange_box, self, "z_range_max", "Z Max [mm]", callback=self.step_and_nz, labelWidth=260, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(self.zrange_box, self, "z_step", "Z Step [mm]", callback=self.step_to_nz, labelWidth=260, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(self.zrange_box, self, "nz", "Z Number of Points", callback=self.nz_to_step, labelWidth=260, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(self.zrange_box, self, "z_offset", "Z Offset", labelWidth=260, valueType=float, orientation="horizontal")
+        gui.comboBox(self.zrange_box, self, "z_sampling", label="Z Sampling", labelWidth=260,
+                     items=["Uniform", "Adaptive"], callback=self.set_z_sampling, sendSelectedValue=False, orientation="horizontal")
+        self.le_z_tolerance = oasysgui.lineEdit(self.zrange_box, self, "z_tolerance", "Refinement Tolerance (relative)", labelWidth=260, valueType=float, orientation="horizontal")
+        self.le_z_max_planes = oasysgui.lineEdit(self.zrange_box, self, "z_max_planes", "Maximum Number of Z Points", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(self.zrange_box, self, "n_processes", "Number of Processes", labelWidth=260, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(self.zrange_box, self, "save_filename", "HDF5 File Name", labelWidth=120, valueType=str, orientation="horizontal")
+        gui.checkBox(self.zrange_box, self, "resume", "Resume interrupted run (same file and settings)")
+        
+        self.set_z_sampling()
+        
+        storage_box = oasysgui.widgetBox(tab1, "Storage Settings", addSpace=True, orientation="vertical", height=160)
+        gui.comboBox(storage_box, self, "storage_dtype", label="Data Type", labelWidth=260,
+                     items=STORAGE_DTYPES, sendSelectedValue=False, orientation="horizontal")
+        gui.comboBox(storage_box, self, "compression_codec", label="Compression", labelWidth=260,
+                     items=COMPRESSION_CODECS, sendSelectedValue=False, orientation="horizontal")
+        oasysgui.lineEdit(storage_box, self, "compression_level", "Compression Level (gzip, blosc)", labelWidth=260, valueType=int, orientation="horizontal")
+        gui.checkBox(storage_box, self, "shuffle", "Shuffle Filter")
+        oasysgui.lineEdit(storage_box, self, "chunk_shape", "Chunk Shape (z, x, y or 'auto')", labelWidth=220, valueType=str, orientation="horizontal")
+        
+        cache_box = oasysgui.widgetBox(tab1, "Result Cache", addSpace=True, orientation="vertical", height=120)
+        gui.checkBox(cache_box, self, "use_cache", "Reuse caustics of unchanged beams and settings")
+        oasysgui.lineEdit(cache_box, self, "cache_size", "Maximum Cache Size [MB]", labelWidth=260, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(cache_box, self, "cache_directory", "Cache Directory (empty: default)", labelWidth=200, valueType=str, orientation="horizontal")
+        self.clear_cache_button = gui.button(cache_box, self, "Clear Cache", callback=self.clear_cache)
         
         ### 2D Plot Options Tab
 #        button_box1 = oasysgui.widgetBox(tab2, "", addSpace=True, orientation="vertical", height=68, width=150)
@@ -262,7 +345,7 @@ class CausticWidget(LNLSShadowWidgetC):
 #        gui.button(button_box1, self, "Load and Refresh", callback=self.load_and_refresh, height=28, width=140)
 #        gui.button(button_box2, self, "Save 2D Plots", callback=self.save_2D_plots, height=28, width=140)
 
-        self.options2D_box = oasysgui.widgetBox(tab2, "Read File", addSpace=True, orientation="vertical", height=160)
+        self.options2D_box = oasysgui.widgetBox(tab2, "Read File", addSpace=True, orientation="vertical", height=215)
 
         gui.checkBox(self.options2D_box, self, "quick_preview", "Plot Quick Preview")
 
@@ -272,9 +355,12 @@ class CausticWidget(LNLSShadowWidgetC):
         button_file = gui.button(button_file_box, self, u"\U0001F50D", callback=self.selectOptimizeFile)
         button_file.setFixedWidth(40)
         
+        oasysgui.lineEdit(self.options2D_box, self, "memory_cache_size", "Memory for Loaded Files [MB]", labelWidth=260, valueType=float, orientation="horizontal")
+        
         button_box = oasysgui.widgetBox(self.options2D_box, "", addSpace=False, orientation="horizontal")
 
         button1 = gui.button(button_box, self, "Load and Refresh", callback=self.load_and_refresh)
+        self.load_button = button1
         font = QFont(button1.font())
         font.setBold(True)
         button1.setFont(font)
@@ -305,6 +391,8 @@ class CausticWidget(LNLSShadowWidgetC):
         button3.setPalette(palette) # assign new palette
         button3.setFixedHeight(28)
         button3.setFixedWidth(364)
+        
+        oasysgui.lineEdit(self.options2D_box, self, "volume_resolution", "3D Voxels per Axis (0: full resolution)", labelWidth=260, valueType=int, orientation="horizontal")
 
 
         
@@ -346,7 +434,7 @@ class CausticWidget(LNLSShadowWidgetC):
 #        gui.separator(self.options2D_box2, 10)
 #        gui.separator(self.options2D_box2, 10)
         
-        self.options2D_box3 = oasysgui.widgetBox(tab2, "Ranges for fitting (in User Units)", addSpace=True, orientation="vertical", height=95)
+        self.options2D_box3 = oasysgui.widgetBox(tab2, "Ranges for fitting (in User Units)", addSpace=True, orientation="vertical", height=120)
         
         zrange_box2 = oasysgui.widgetBox(self.options2D_box3, "", addSpace=False, orientation="horizontal")
         oasysgui.lineEdit(zrange_box2, self, "plot2D_z_range_minXZ", "Z Min (XZ fit)", labelWidth=100, controlWidth=60, valueType=float, orientation="horizontal")
@@ -356,6 +444,8 @@ class CausticWidget(LNLSShadowWidgetC):
         zrange_box3 = oasysgui.widgetBox(self.options2D_box3, "", addSpace=False, orientation="horizontal")
         oasysgui.lineEdit(zrange_box3, self, "plot2D_z_range_minYZ", "Z Min (YZ fit)", labelWidth=100, controlWidth=60, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(zrange_box3, self, "plot2D_z_range_maxYZ", "Z Max (YZ fit)", labelWidth=100, controlWidth=60, valueType=float, orientation="horizontal")
+
+        gui.checkBox(self.options2D_box3, self, "fit_refine", "Refine fits (nonlinear, from the linear solution)")
         
         
         ############### MAIN AREA #####################
@@ -547,6 +637,41 @@ class CausticWidget(LNLSShadowWidgetC):
         if self.auto_xy_ranges:
             self.calc_rangesXY()
 
+    def get_storage_options(self):
+        """
+        Keyword arguments of CausticWriter for the storage settings.
+        """
+        compression = COMPRESSION_CODECS[self.compression_codec]
+        if(compression == 'gzip'):
+            congruence.checkPositiveNumber(self.compression_level, "Compression Level")
+            congruence.checkLessOrEqualThan(self.compression_level, 9, "Compression Level", "9")
+        
+        return storage_options(STORAGE_DTYPES[self.storage_dtype], compression, self.compression_level, self.shuffle, self.chunk_shape)
+
+    def get_session_cache(self):
+        self.session_cache.max_bytes = self.memory_cache_size*1024**2
+        return self.session_cache
+    
+    def get_cache(self):
+        return CausticCache(directory=self.cache_directory.strip() or None, max_bytes=self.cache_size*1024**2)
+    
+    def clear_cache(self):
+        sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+        try:
+            cache = self.get_cache()
+            cache.clear()
+            self.session_cache.clear()
+            sys.stdout.write('\nCaustic cache cleared ({0})\n'.format(cache.directory))
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error", str(exception), QtWidgets.QMessageBox.Ok)
+    
+    def print_cache_statistics(self, cache):
+        print_cache_statistics(cache)
+
+    def set_z_sampling(self):
+        self.le_z_tolerance.setDisabled(self.z_sampling == 0)
+        self.le_z_max_planes.setDisabled(self.z_sampling == 0)
+
     def load_and_refresh(self):
         sys.stdout = EmittingStream(textWritten=self.writeStdOut)
 
@@ -556,51 +681,156 @@ class CausticWidget(LNLSShadowWidgetC):
             congruence.checkLessOrEqualThan(self.plot2D_z_range_min, self.plot2D_z_range_max, "Plot Z range min", "Plot Z range max")        
             congruence.checkLessOrEqualThan(self.plot2D_z_range_minXZ, self.plot2D_z_range_maxXZ, "Fit Z range min", "Fit Z range max")   
             congruence.checkLessOrEqualThan(self.plot2D_z_range_minYZ, self.plot2D_z_range_maxYZ, "Fit Z range min", "Fit Z range max")               
+            congruence.checkPositiveNumber(self.memory_cache_size, "Memory for Loaded Files")
             good_to_plot = 1
         
         except Exception as exception:
             good_to_plot = 0
             QtWidgets.QMessageBox.critical(self, "Error", str(exception), QtWidgets.QMessageBox.Ok)      
             
-        if(good_to_plot):
+        if(good_to_plot and self.task is not None):
+            QtWidgets.QMessageBox.critical(self, "Error", "Please wait for the running caustic or cancel it.", QtWidgets.QMessageBox.Ok)
+            
+        elif(good_to_plot):
             try:
                 congruence.checkDir(self.load_filename)
             except Exception:
                 sys.stdout.write('Failed (File not found in this directory)\n')
                 QtWidgets.QMessageBox.critical(self, "Error", 'Please enter a valid file name', QtWidgets.QMessageBox.Ok)
                 
-            try:
-                self.print_date_i
-
-                sys.stdout.write('\nLoading Caustic and Running Analysis...\n')
-                
-                if(self.quick_preview):
-                    self.plot_quick_preview(self.load_filename,
-                                            scale=self.scale,
-                                            xrange=[self.plot2D_x_range_min, self.plot2D_x_range_max],
-                                            yrange=[self.plot2D_y_range_min, self.plot2D_y_range_max],
-                                            zrange=[self.plot2D_z_range_min, self.plot2D_z_range_max],
-                                            zrangeXZ=[self.plot2D_z_range_minXZ, self.plot2D_z_range_maxXZ],
-                                            zrangeYZ=[self.plot2D_z_range_minYZ, self.plot2D_z_range_maxYZ],
-                                            xunits=self.x_units, yunits=self.y_units, zunits=self.z_units)
-                
-                else:
-                    self.outdict = self.plot_shadow_caustic(self.load_filename, self.x_cut_position, self.y_cut_position, self.z_cut_position, 
-                                                            0, 0, scale=self.scale,
-                                                            xrange=[self.plot2D_x_range_min, self.plot2D_x_range_max],
-                                                            yrange=[self.plot2D_y_range_min, self.plot2D_y_range_max],
-                                                            zrange=[self.plot2D_z_range_min, self.plot2D_z_range_max],
-                                                            zrangeXZ=[self.plot2D_z_range_minXZ, self.plot2D_z_range_maxXZ],
-                                                            zrangeYZ=[self.plot2D_z_range_minYZ, self.plot2D_z_range_maxYZ],
-                                                            xunits=self.x_units, yunits=self.y_units, zunits=self.z_units)
-                self.print_date_f
-            except Exception as exception:
-                good_to_plot = 0
-                QtWidgets.QMessageBox.critical(self, "Error", str(exception), QtWidgets.QMessageBox.Ok)  
+            sys.stdout.write('\nLoading Caustic and Running Analysis...\n')
+            
+            # the file is read in the background, then plotted from memory
+            self.get_session_cache()
+            self.start_task(self.prefetch_caustic, self.refresh_plots,
+                            filename=self.load_filename, quick_preview=bool(self.quick_preview),
+                            cut_pos_x=self.x_cut_position, cut_pos_y=self.y_cut_position, cut_pos_z=self.z_cut_position,
+                            xunits=self.x_units, yunits=self.y_units, zunits=self.z_units, display=self.display_resolution())
         
         else:
             sys.stdout.write('Failed to Run Caustic.\n')
 
+    def prefetch_caustic(self, filename, quick_preview=False, cut_pos_x=0.0, cut_pos_y=0.0, cut_pos_z=0.0, xunits=0, yunits=0, zunits=0,
+                         display=None):
+        """
+        Reads into the session cache what the plots of filename need, so that
+        plot_quick_preview or plot_shadow_caustic find it in memory. display
+        is the display_resolution the XY map is read for.
+        """
+        reader = self.session_cache.load(filename)
+        xf = [1.0, 1e3, 1e6][xunits]
+        yf = [1.0, 1e3, 1e6][yunits]
+        zf = [1e-3, 1.0, 1e3, 1e6][zunits]
+        levels = reader.pyramid_levels()
+        factor = pyramid_level(levels, **(display or {}))
+        if(quick_preview):
+            if(len(levels) > 1):
+                reader.read_level(factor, np.abs(levels[factor][0] - cut_pos_z/zf).argmin())
+        else:
+            x_cut_indices, y_cut_indices = self.cut_indices(reader.plane_ranges(), cut_pos_x/xf, cut_pos_y/yf)
+            reader.peak_positions()
+            reader.read_cuts(x_cut_indices, y_cut_indices)
+            reader.read_level(factor, np.abs(reader.z_points() - cut_pos_z/zf).argmin())
+
+    def display_resolution(self):
+        """
+        Pixels of the XY map along x and y: the resolution that the pyramid
+        level of the XY map has to fill.
+        """
+        xy = self.axXY.get_window_extent()
+        return {'nx': int(np.ceil(xy.width)), 'ny': int(np.ceil(xy.height))}
+
+    def cut_indices(self, xy_range, x, y):
+        """
+        Nearest bin to the cut positions x, y in each plane.
+        """
+        x_cut_indices = np.array([np.abs(np.linspace(r[0], r[1], int(r[4])) - x).argmin() for r in xy_range])
+        y_cut_indices = np.array([np.abs(np.linspace(r[2], r[3], int(r[5])) - y).argmin() for r in xy_range])
+        return x_cut_indices, y_cut_indices
+
+    def refresh_plots(self, result=None):
+        try:
+            if(self.quick_preview):
+                self.plot_quick_preview(self.load_filename,
+                                        scale=self.scale,
+                                        xrange=[self.plot2D_x_range_min, self.plot2D_x_range_max],
+                                        yrange=[self.plot2D_y_range_min, self.plot2D_y_range_max],
+                                        zrange=[self.plot2D_z_range_min, self.plot2D_z_range_max],
+                                        zrangeXZ=[self.plot2D_z_range_minXZ, self.plot2D_z_range_maxXZ],
+                                        zrangeYZ=[self.plot2D_z_range_minYZ, self.plot2D_z_range_maxYZ],
+                                        xunits=self.x_units, yunits=self.y_units, zunits=self.z_units,
+                                        cut_pos_z=self.z_cut_position)
+            
+            else:
+                self.outdict = self.plot_shadow_caustic(self.load_filename, self.x_cut_position, self.y_cut_position, self.z_cut_position, 
+                                                        0, 0, scale=self.scale,
+                                                        xrange=[self.plot2D_x_range_min, self.plot2D_x_range_max],
+                                                        yrange=[self.plot2D_y_range_min, self.plot2D_y_range_max],
+                                                        zrange=[self.plot2D_z_range_min, self.plot2D_z_range_max],
+                                                        zrangeXZ=[self.plot2D_z_range_minXZ, self.plot2D_z_range_maxXZ],
+                                                        zrangeYZ=[self.plot2D_z_range_minYZ, self.plot2D_z_range_maxYZ],
+                                                        xunits=self.x_units, yunits=self.y_units, zunits=self.z_units,
+                                                        refine_fits=self.fit_refine)
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error", str(exception), QtWidgets.QMessageBox.Ok)  
+
+    def start_task(self, function, on_done, report_progress=False, **kwargs):
+        """
+        Runs function(**kwargs) in a CausticTask; on_done(result) is then
+        called in the GUI thread. Run, Load and Clear Cache (the task may be
+        reading or writing the caches) are disabled meanwhile. With
+        report_progress, function gets a progress callback that updates the
+        progress bar and the status message.
+        """
+        self.cancel_event.clear()
+        self.task = CausticTask(function, **kwargs)
+        if report_progress:
+            self.task.kwargs['progress'] = self.task.progress.emit
+        self.task.progress.connect(self.show_progress)
+        self.task.done.connect(on_done)
+        self.task.failed.connect(self.task_failed)
+        self.task.finished.connect(self.task_finished)
+        
+        self.run_button.setEnabled(False)
+        self.load_button.setEnabled(False)
+        self.clear_cache_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progressBarInit()
+        self.task.start()
+
+    def show_progress(self, info):
+        eta = int(round(info['eta']))
+        self.progressBarSet(100.0*info['done']/info['total'])
+        self.setStatusMessage('{0}/{1} planes, {2:.3g} rays/s, ETA {3}:{4:02d}'.format(info['done'], info['total'], info['rays_per_s'],
+                                                                                     eta // 60, eta % 60))
+
+    def task_failed(self, exception):
+        QtWidgets.QMessageBox.critical(self, "Error", str(exception), QtWidgets.QMessageBox.Ok)
+
+    def task_finished(self):
+        self.progressBarFinished()
+        self.setStatusMessage('')
+        self.run_button.setEnabled(True)
+        self.load_button.setEnabled(True)
+        self.clear_cache_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.task.deleteLater()
+        self.task = None
+
+    def cancel_task(self):
+        """
+        Stops the running caustic after its current plane.
+        """
+        if self.task is not None:
+            self.cancel_event.set()
+            self.setStatusMessage('Cancelling...')
+
+    def onDeleteWidget(self):
+        if self.task is not None:
+            self.cancel_event.set()
+            self.task.wait()
+        super().onDeleteWidget()
+
 
     ### Colect input beam ###
     def set_beam(self, beam):
@@ -626,32 +856,53 @@ class CausticWidget(LNLSShadowWidgetC):
 
             sys.stdout = EmittingStream(textWritten=self.writeStdOut)
 
+            if self.task is not None:
+                raise Exception("A caustic is already running: please wait for it or cancel it.")
+
             if ShadowCongruence.checkEmptyBeam(self.input_beam):
                 self.x_nbins = congruence.checkStrictlyPositiveNumber(self.x_nbins, "Number of Bins X")
                 self.y_nbins = congruence.checkStrictlyPositiveNumber(self.y_nbins, "Number of Bins Y")
                 self.nz = congruence.checkStrictlyPositiveNumber(self.nz, "Number of Z Points")
+                self.n_processes = congruence.checkStrictlyPositiveNumber(self.n_processes, "Number of Processes")
+                if(self.z_sampling == 1):
+                    self.z_tolerance = congruence.checkStrictlyPositiveNumber(self.z_tolerance, "Refinement Tolerance")
+                    self.z_max_planes = congruence.checkStrictlyPositiveNumber(self.z_max_planes, "Maximum Number of Z Points")
                 congruence.checkLessThan(self.x_range_min, self.x_range_max, "X range min", "X range max")
                 congruence.checkLessThan(self.y_range_min, self.y_range_max, "Y range min", "Y range max")
                 congruence.checkLessThan(self.z_range_min, self.z_range_max, "Z range min", "Z range max")                
+                storage = self.get_storage_options()
+                if(self.use_cache):
+                    self.cache_size = congruence.checkStrictlyPositiveNumber(self.cache_size, "Maximum Cache Size")
                 
 #                self.getConversion()
 #                self.plot_xy()
 
                 self.print_date_i()
+                
+                if(self.caustic_mode == 1):
+                    self.analytic_caustic = self.run_analytic_caustic(beam=self.input_beam._beam,
+                                                                      zStart=self.z_range_min, zFin=self.z_range_max, nz=self.nz,
+                                                                      colh=self.x_column_index+1, colv=self.y_column_index+1, colref=self.weight_column_index)
+                    self.print_date_f()
+                    return True
+                
                 sys.stdout.write("Running Caustic... ")
                 sys.stdout.flush()
-                self.run_shadow_caustic(filename=self.save_filename, beam=self.input_beam._beam.duplicate(), 
-                                        zStart=self.z_range_min, zFin=self.z_range_max, nz=self.nz, zOffset=self.z_offset,
-                                        colh=self.x_column_index+1, colv=self.y_column_index+1, colref=self.weight_column_index,
-                                        nbinsh=self.x_nbins, nbinsv=self.y_nbins, 
-                                        xrange=[self.x_range_min, self.x_range_max],
-                                        yrange=[self.y_range_min, self.y_range_max])
-                sys.stdout.write('...finished!')
-                self.print_date_f()
+                # the scan runs in the background; Cancel stops it after the current plane
+                self.start_task(self.run_shadow_caustic, self.caustic_finished,
+                                filename=self.save_filename, beam=self.input_beam._beam, 
+                                zStart=self.z_range_min, zFin=self.z_range_max, nz=self.nz, zOffset=self.z_offset,
+                                colh=self.x_column_index+1, colv=self.y_column_index+1, colref=self.weight_column_index,
+                                nbinsh=self.x_nbins, nbinsv=self.y_nbins, 
+                                xrange=[self.x_range_min, self.x_range_max],
+                                yrange=[self.y_range_min, self.y_range_max],
+                                n_processes=self.n_processes,
+                                adaptive=(self.z_sampling == 1), tolerance=self.z_tolerance, max_planes=self.z_max_planes,
+                                storage=storage, resume=bool(self.resume),
+                                cache=self.get_cache() if self.use_cache else None,
+                                cancel=self.cancel_event, report_progress=True)
                 plotted = True
 
-            time.sleep(0.5)  # prevents a misterious dead lock in the Orange cycle when refreshing the histogram
-
             return plotted
         
         except Exception as exception:
@@ -660,6 +911,10 @@ class CausticWidget(LNLSShadowWidgetC):
                                        QtWidgets.QMessageBox.Ok)
             return False
 
+    def caustic_finished(self, complete):
+        sys.stdout.write('...finished!' if complete else '...cancelled!')
+        self.print_date_f()
+
     def save_2D_plots(self):
 #        sys.stdout = EmittingStream(textWritten=self.writeStdOut)
         filename, ext = os.path.splitext(self.load_filename)
@@ -678,30 +933,93 @@ class CausticWidget(LNLSShadowWidgetC):
         
   
     def launch_pyvista(self):
-#       axXZ
+        """
+        Reads the caustic volume (at the pyramid level of "3D Voxels per
+        Axis") into shared memory in the background, then starts the viewer
+        as a subprocess that maps it without a copy.
+        """
+        launch_time = time.time()
+        sys.stdout = EmittingStream(textWritten=self.writeStdOut)
         
         try:
             congruence.checkDir(self.load_filename)
         except Exception:
             sys.stdout.write('3D visualization failed (File not found in this directory)\n')
             QtWidgets.QMessageBox.critical(self, "Error", 'Please enter a valid file name', QtWidgets.QMessageBox.Ok)
+            return
 
-        try:
-            import pyvista
-            import pyvistaqt
-            import platform
-            
-            pyvista_path = os.path.split(__file__)[0] 
-                                    
-            if platform.system() == 'Linux':
-                command_str = "gnome-terminal -e 'bash -c \" python {0} -f {1} ; exec bash\"'".format(os.path.join(pyvista_path, 'volume_slicer_pyvista.py'), os.path.join(os.getcwd(), self.load_filename))
-            if platform.system() == 'Windows':
-                command_str = "cmd /c python {0} -f {1} ".format(os.path.join(pyvista_path, 'volume_slicer_pyvista.py'), os.path.join(os.getcwd(), self.load_filename))
-            os.system(command_str)
-
-        except ImportError:
+        # checked without importing them: the viewer process does
+        if(importlib.util.find_spec('pyvista') is None or importlib.util.find_spec('pyvistaqt') is None):
             raise ImportError("For 3D visualization, please 'pip install pyvista pyvistaqt' in the oasys environment")
         
+        if(self.task is not None):
+            QtWidgets.QMessageBox.critical(self, "Error", "Please wait for the running caustic or cancel it.", QtWidgets.QMessageBox.Ok)
+            return
+        
+        self.get_session_cache()
+        self.start_task(self.share_volume, self.start_viewer,
+                        filename=os.path.join(os.getcwd(), self.load_filename), resolution=int(self.volume_resolution), launch_time=launch_time)
+
+    def share_volume(self, filename, resolution=0, launch_time=None):
+        """
+        Fills a shared memory block with the volume of filename, read through
+        the session cache, with about resolution voxels along each axis (see
+        volume_level; 0: full resolution).
+        """
+        reader = self.session_cache.load(filename)
+        factor, z_step = 1, 1
+        if(resolution > 0):
+            factor, z_step = volume_level(reader.pyramid_levels(), resolution)
+        # the viewer shows x and y reversed
+        shm, volume, z = read_shared_volume(reader, factor=factor, z_step=z_step, reverse_xy=True)
+        shared = {'shm': shm, 'shape': volume.shape, 'dtype': volume.dtype.str, 'factor': factor, 'z_step': z_step, 'launch_time': launch_time}
+        # the block cannot be closed while a view of it exists
+        del volume
+        return shared
+
+    def start_viewer(self, shared):
+        shm = shared['shm']
+        nz, ny, nx = shared['shape']
+        sys.stdout.write('3D volume: {0} x {1} x {2} voxels (pyramid level {3}, planes averaged by {4}) shared in {5:.2f} s\n'.format(
+                         nx, ny, nz, shared['factor'], shared['z_step'], time.time() - shared['launch_time']))
+        
+        command = [sys.executable, '-u', os.path.join(os.path.split(__file__)[0], 'volume_slicer_pyvista.py'),
+                   '--shm', shm.name, '--shape', '{0},{1},{2}'.format(nz, ny, nx), '--dtype', shared['dtype'],
+                   '--t0', repr(shared['launch_time'])]
+        env = dict(os.environ)
+        if(sys.platform.startswith('linux') and not env.get('DISPLAY') and not env.get('WAYLAND_DISPLAY')):
+            # headless machine: no window, the viewer renders off screen
+            env['QT_QPA_PLATFORM'] = 'offscreen'
+        
+        try:
+            viewer = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, env=env)
+        except Exception as exception:
+            shm.close()
+            shm.unlink()
+            QtWidgets.QMessageBox.critical(self, "Error", '3D visualization failed: ' + str(exception), QtWidgets.QMessageBox.Ok)
+            return
+        
+        threading.Thread(target=self.relay_viewer, args=(viewer, shm), daemon=True).start()
+
+    def relay_viewer(self, viewer, shm):
+        """
+        Copies the output of the viewer process to the widget output. The
+        shared memory is released once the viewer has mapped it, or when it
+        exits before.
+        """
+        released = False
+        for line in viewer.stdout:
+            if(line.strip() == 'VIEWER READY'):
+                shm.close()
+                shm.unlink()
+                released = True
+            else:
+                sys.stdout.write(line)
+        viewer.wait()
+        if not released:
+            shm.close()
+            shm.unlink()
+        
     def writeStdOut(self, text):        
         cursor = self.shadow_output.textCursor()
         cursor.movePosition(QTextCursor.End)
@@ -714,147 +1032,26 @@ class CausticWidget(LNLSShadowWidgetC):
             return np.sqrt(np.sum(f_x*np.square(x))/np.sum(f_x) - (np.sum(f_x*x)/np.sum(f_x))**2)
     
     def get_fwhm(self, x, y, oversampling=1, zero_padding=False, avg_correction=False, debug=False):
-       
-       
-        def add_zeros(array):
-            aux = []
-            aux.append(0)
-            for i in range(len(array)):
-                aux.append(array[i])
-            aux.append(0)
-            return np.array(aux)
-        
-        def add_steps(array):
-            aux = []
-            step = (np.max(array)-np.min(array))/(len(array)-1)
-            aux.append(array[0]-step)
-            for i in range(len(array)):
-                aux.append(array[i])
-            aux.append(array[-1]+step)
-            return np.array(aux)
-        
-        def interp_distribution(array_x,array_y,oversampling):
-            dist = interp1d(array_x, array_y)
-            x_int = np.linspace(np.min(array_x), np.max(array_x), int(len(x)*oversampling))
-            y_int = dist(x_int)
-            return x_int, y_int 
-        
-        if(oversampling > 1.0):
-            array_x, array_y = interp_distribution(x, y, oversampling)
-        else:
-            array_x, array_y = x, y
-            
-        if(zero_padding):
-            array_x = add_steps(x)
-            array_y = add_zeros(y)
-            
-        try:    
-            y_peak = np.max(array_y)
-            idx_peak = (np.abs(array_y-y_peak)).argmin()
-            #x_peak = array_x[idx_peak]
-            if(idx_peak==0):
-                left_hwhm_idx = 0
-            else:
-                #left_hwhm_idx = (np.abs(array_y[:idx_peak]-y_peak/2)).argmin()
-    #            for i in range(idx_peak,0,-1):
-                for i in range(0,idx_peak):
-    #                if np.abs(array_y[i]-y_peak/2)<np.abs(array_y[i-1]-y_peak/2) and (array_y[i-1]-y_peak/2)<0:
-                    if np.abs(array_y[i]-y_peak/2)>np.abs(array_y[i-1]-y_peak/2) and (array_y[i-1]-y_peak/2)>0:
-                        break                
-                left_hwhm_idx = i     
-                
-            if(idx_peak==len(array_y)-1):
-                right_hwhm_idx = len(array_y)-1
-            else:
-                #right_hwhm_idx = (np.abs(array_y[idx_peak:]-y_peak/2)).argmin() + idx_peak
-    #            for j in range(idx_peak,len(array_y)):
-                for j in range(len(array_y)-2, idx_peak, -1):
-    #                if np.abs(array_y[j]-y_peak/2)<np.abs(array_y[j+1]-y_peak/2) and (array_y[j+1]-y_peak/2)<0:
-                    if np.abs(array_y[j]-y_peak/2)>np.abs(array_y[j+1]-y_peak/2) and (array_y[j+1]-y_peak/2)>0:
-                        break              
-                right_hwhm_idx = j
-                
-            fwhm = array_x[right_hwhm_idx] - array_x[left_hwhm_idx]               
-                
-            if(avg_correction):
-                avg_y = (array_y[left_hwhm_idx]+array_y[right_hwhm_idx])/2.0
-                popt_left = np.polyfit(np.array([array_x[left_hwhm_idx-1],array_x[left_hwhm_idx],array_x[left_hwhm_idx+1]]),
-                                       np.array([array_y[left_hwhm_idx-1],array_y[left_hwhm_idx],array_y[left_hwhm_idx+1]]),1)                                   
-                popt_right = np.polyfit(np.array([array_x[right_hwhm_idx-1],array_x[right_hwhm_idx],array_x[right_hwhm_idx+1]]),
-                                       np.array([array_y[right_hwhm_idx-1],array_y[right_hwhm_idx],array_y[right_hwhm_idx+1]]),1)
-                x_left = (avg_y-popt_left[1])/popt_left[0]
-                x_right = (avg_y-popt_right[1])/popt_right[0]
-                fwhm = x_right - x_left
-                
-                return [fwhm, x_left, x_right, avg_y, avg_y]
-            else:
-                return [fwhm, array_x[left_hwhm_idx], array_x[right_hwhm_idx], array_y[left_hwhm_idx], array_y[right_hwhm_idx]]
-                
-            if(debug):
-                print(y_peak)
-                print(idx_peak)
-                print(left_hwhm_idx, right_hwhm_idx)
-                print(array_x[left_hwhm_idx], array_x[right_hwhm_idx])            
-            
-        except ValueError:
-            fwhm = 0.0        
-            print("Could not calculate fwhm\n")   
-            return [fwhm, 0, 0, 0, 0]
-    
-    def find_peak(self, xz):
-        zmax = [0, 0]; xmax = [0, 0]
-    
-        for i in range(len(xz[:,0])):
-            for j in range(len(xz[0,:])):
-                
-                if(xz[i,j] > zmax[1]):
-                    zmax[0] = j
-                    zmax[1] = xz[i,j]
-                                    
-                if(xz[i,j] > xmax[1]):
-                    xmax[0] = i
-                    xmax[1] = xz[i,j]
-                    
-        return zmax, xmax
+        return get_fwhm(x, y, oversampling, zero_padding, avg_correction, debug)
+
+    def get_fwhm_of_cuts(self, grids, cuts):
+        """
+        get_fwhm of each cut (oversampling 200), in one fwhm_stack call when
+        all cuts share the same grid (the usual case) and one call per cut
+        otherwise.
+        """
+        if all(np.array_equal(grid, grids[0]) for grid in grids):
+            return fwhm_stack(grids[0], np.array(cuts), oversampling=200)[0]
+        return np.array([fwhm_stack(grid, cut, oversampling=200)[0][0] for grid, cut in zip(grids, cuts)])
     
     def gaussian_beam(self, z, s0, z0, beta):
-        return s0*np.sqrt(1 + ((z-z0)/beta)**2)
+        return gaussian_beam(z, s0, z0, beta)
     
     def weighted_avg_and_std(self, values, weights):
-        """
-        By EOL - stackoverflow - 10/03/2010
-        Return the weighted average and standard deviation.
-        values, weights -- Numpy ndarrays with the same shape.
-        """
-        try:
-            average = np.average(values, weights=weights)
-            variance = np.average((values-average)**2, weights=weights)  # Fast and numerically precise
-            return (average, np.sqrt(variance))
-        except:
-            print('   Mean and RMS values could not be calculated.')
-            return (np.nan, np.nan)
+        return weighted_avg_and_std(values, weights)
 
     def get_good_ranges(self, beam, zStart, zFin, colh, colv):
-        
-        r_z0h = beam.get_good_range(icol=colh, nolost=1)
-        r_z0v = beam.get_good_range(icol=colv, nolost=1)
-        
-        beam_copy = beam.duplicate()
-        beam_copy.retrace(zStart)
-        r_zStarth = beam_copy.get_good_range(icol=colh, nolost=1)
-        r_zStartv = beam_copy.get_good_range(icol=colv, nolost=1)
-        
-        beam_copy = beam.duplicate()
-        beam_copy.retrace(zFin)
-        r_zFinh = beam_copy.get_good_range(icol=colh, nolost=1)
-        r_zFinv = beam_copy.get_good_range(icol=colv, nolost=1)
-        
-        rh_min = np.min(r_z0h + r_zStarth + r_zFinh)
-        rh_max = np.max(r_z0h + r_zStarth + r_zFinh)
-        rv_min = np.min(r_z0v + r_zStartv + r_zFinv)
-        rv_max = np.max(r_z0v + r_zStartv + r_zFinv)
-    
-        return [rh_min, rh_max, rv_min, rv_max] 
+        return good_ranges(beam, zStart, zFin, colh, colv)
     
 #    def initialize_hdf5(self, h5_filename, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, good_rays, offsets=None):
 #        with h5py.File(h5_filename, 'w') as f:
@@ -916,183 +1113,29 @@ class CausticWidget(LNLSShadowWidgetC):
 
     #def append_dataset_hdf5(self, filename, data, z, zOffset, nz, tag, t0, ndigits):
 
-    def initialize_hdf5(self, h5_filename, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, good_rays, offsets=None):
-        with h5py.File(h5_filename, 'w') as f:
-            f.attrs['begin time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            f.attrs['zStart'] = zStart
-            f.attrs['zFin'] = zFin
-            f.attrs['nz'] = nz
-            f.attrs['zOffset'] = zOffset
-            f.attrs['zStep'] = int((zFin - zStart) / (nz - 1))
-            f.attrs['col_h'] = colh
-            f.attrs['col_v'] = colv
-            f.attrs['col_ref'] = colref
-            f.attrs['nbins_h'] = nbinsh
-            f.attrs['nbins_v'] = nbinsv
-            f.attrs['good_rays'] = good_rays
-            if offsets is not None:
-                f.attrs['offsets'] = offsets
-            
+    def initialize_hdf5(self, h5_filename, z_points, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, good_rays, offsets=None, storage=None,
+                        resume=False, fingerprint=None, wavelength=None):
+        return CausticWriter(h5_filename, z_points, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, good_rays, offsets=offsets, background=True,
+                             resume=resume, fingerprint=fingerprint, wavelength=wavelength, **(storage or {}))
     
-    def append_dataset_hdf5(self, filename, data, z, zOffset, nz, tag, t0, ndigits):
-        
-        mean_h, rms_h = self.weighted_avg_and_std(data['bin_h_center'], data['histogram_h']) 
-        mean_v, rms_v = self.weighted_avg_and_std(data['bin_v_center'], data['histogram_v'])
-        fwhm_h = self.get_fwhm(data['bin_h_center'], data['histogram_h'])
-        fwhm_v = self.get_fwhm(data['bin_v_center'], data['histogram_v'])
-        
-        with h5py.File(filename, 'a') as f:
-            dset = f.create_dataset('step_{0:0{ndigits}d}'.format(tag, ndigits=ndigits),
-                                    data=np.array(data['histogram'], dtype=float), compression="gzip")
-            dset.attrs['z'] = z + zOffset
-            dset.attrs['xStart'] = data['bin_h_center'].min()
-            dset.attrs['xFin'] = data['bin_h_center'].max()
-            dset.attrs['nx'] = data['nbins_h']
-            dset.attrs['yStart'] = data['bin_v_center'].min()
-            dset.attrs['yFin'] = data['bin_v_center'].max()
-            dset.attrs['ny'] = data['nbins_v']
-            dset.attrs['mean_h'] = mean_h
-            dset.attrs['mean_v'] = mean_v
-            dset.attrs['rms_h'] = rms_h
-            dset.attrs['rms_v'] = rms_v
-            dset.attrs['fwhm_h'] = fwhm_h
-            dset.attrs['fwhm_v'] = fwhm_v
-            dset.attrs['ellapsed time (s)'] = round(time.time() - t0, 3)
-            
-            try:
-                dset.attrs['fwhm_h_shadow'] = data['fwhm_h']
-                dset.attrs['center_h_shadow'] = (data['fwhm_coordinates_h'][0] + data['fwhm_coordinates_h'][1]) / 2.0
-            except:
-                print('CAUSTIC WARNING: FWHM X could not be calculated by Shadow')
-                dset.attrs['fwhm_h_shadow'] = np.nan
-                dset.attrs['center_h_shadow'] = np.nan
-            try:
-                dset.attrs['fwhm_v_shadow'] = data['fwhm_v']
-                dset.attrs['center_v_shadow'] = (data['fwhm_coordinates_v'][0] + data['fwhm_coordinates_v'][1]) / 2.0
-            except:
-                print('CAUSTIC WARNING: FWHM Y could not be calculated by Shadow')
-                dset.attrs['fwhm_v_shadow'] = np.nan
-                dset.attrs['center_v_shadow'] = np.nan
-                
-            if (tag == nz - 1):
-                f.attrs['end time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    def append_dataset_hdf5(self, writer, data, z, zOffset, t0):
+        writer.append_plane(data['histogram'], plane_statistics(data, z, zOffset, t0))
 
     def read_caustic(self, filename, write_attributes=False, plot=False, plot2D=False, print_minimum=False):
         
-        with h5py.File(filename, 'r+') as f:
+        outdict, histoH, histoV = summarize_caustic(filename, write_attributes=write_attributes)
         
-            dset_names = list(f.keys())
-            
-            center_shadow = np.zeros((len(dset_names), 2), dtype=float)
-            center = np.zeros((len(dset_names), 2), dtype=float)
-            rms = np.zeros((len(dset_names), 2), dtype=float)
-            fwhm = np.zeros((len(dset_names), 2), dtype=float)
-            fwhm_shadow = np.zeros((len(dset_names), 2), dtype=float)
-            
-            ###### READ DATA #######################
-            
-            zStart = f.attrs['zStart']
-            zFin = f.attrs['zFin']
-            nz = f.attrs['nz']
-                    
-            #if(plot2D): 
-            xStart = f[dset_names[0]].attrs['xStart']
-            xFin = f[dset_names[0]].attrs['xFin']
-            nx = f[dset_names[0]].attrs['nx']
-            yStart = f[dset_names[0]].attrs['yStart']
-            yFin = f[dset_names[0]].attrs['yFin']
-            ny = f[dset_names[0]].attrs['ny']
-                
-            histoH = np.zeros((nx, nz))
-            histoV = np.zeros((ny, nz))
-            
-            z_points = np.linspace(zStart, zFin, nz)
-            
-            for i, dset in enumerate(dset_names):
-                #dset_keys = list(f[dset].attrs.keys())
-            
-                center_shadow[i,0] = f[dset].attrs['center_h_shadow']
-                center_shadow[i,1] = f[dset].attrs['center_v_shadow']
-                center[i,0] = f[dset].attrs['mean_h']    
-                center[i,1] = f[dset].attrs['mean_v']
-                rms[i,0] = f[dset].attrs['rms_h']    
-                rms[i,1] = f[dset].attrs['rms_v']
-                fwhm[i,0] = f[dset].attrs['fwhm_h'][0]
-                fwhm[i,1] = f[dset].attrs['fwhm_v'][0]
-                fwhm_shadow[i,0] = f[dset].attrs['fwhm_h_shadow']    
-                fwhm_shadow[i,1] = f[dset].attrs['fwhm_v_shadow']
-                
-                #if(plot2D):
-                histo2D = np.array(f[dset])
-                histoH[:,i] = histo2D.sum(axis=1)
-                histoV[:,i] = histo2D.sum(axis=0)
-                    
-        #### FIND MINIMUMS AND ITS Z POSITIONS
-    
-        rms_min = [np.min(rms[:,0]), np.min(rms[:,1])]
-        fwhm_min = [np.min(fwhm[:,0]), np.min(fwhm[:,1])]
-        fwhm_shadow_min = [np.min(fwhm_shadow[:,0]), np.min(fwhm_shadow[:,1])]
-    
-        rms_min_z=np.array([z_points[np.abs(rms[:,0]-rms_min[0]).argmin()],
-                            z_points[np.abs(rms[:,1]-rms_min[1]).argmin()]])
-    
-        fwhm_min_z=np.array([z_points[np.abs(fwhm[:,0]-fwhm_min[0]).argmin()],
-                             z_points[np.abs(fwhm[:,1]-fwhm_min[1]).argmin()]])
-    
-        fwhm_shadow_min_z=np.array([z_points[np.abs(fwhm_shadow[:,0]-fwhm_shadow_min[0]).argmin()],
-                                    z_points[np.abs(fwhm_shadow[:,1]-fwhm_shadow_min[1]).argmin()]])
-    
-        center_rms = np.array([center[:,0][np.abs(z_points-rms_min_z[0]).argmin()],
-                               center[:,1][np.abs(z_points-rms_min_z[1]).argmin()]])
-    
-        center_fwhm = np.array([center[:,0][np.abs(z_points-fwhm_min_z[0]).argmin()],
-                                center[:,1][np.abs(z_points-fwhm_min_z[1]).argmin()]])
-    
-        center_fwhm_shadow = np.array([center[:,0][np.abs(z_points-fwhm_shadow_min_z[0]).argmin()],
-                                       center[:,1][np.abs(z_points-fwhm_shadow_min_z[1]).argmin()]])
-     
-        
-        outdict = {'zStart': zStart,
-                   'zFin': zFin,
-                   'nz': nz,
-                   'center_h_array': center[:,0], 
-                   'center_v_array': center[:,1],
-                   'center_shadow_h_array': center_shadow[:,0], 
-                   'center_shadow_v_array': center_shadow[:,1],
-                   'rms_h_array': rms[:,0], 
-                   'rms_v_array': rms[:,1],
-                   'fwhm_h_array': fwhm[:,0], 
-                   'fwhm_v_array': fwhm[:,1],
-                   'fwhm_shadow_h_array': fwhm_shadow[:,0], 
-                   'fwhm_shadow_v_array': fwhm_shadow[:,1],
-                   'rms_min_h': rms_min[0],
-                   'rms_min_v': rms_min[1],
-                   'fwhm_min_h': fwhm_min[0],
-                   'fwhm_min_v': fwhm_min[1],
-                   'fwhm_shadow_min_h': fwhm_shadow_min[0],
-                   'fwhm_shadow_min_v': fwhm_shadow_min[1],
-                   'z_rms_min_h': rms_min_z[0],
-                   'z_rms_min_v': rms_min_z[1],
-                   'z_fwhm_min_h': fwhm_min_z[0],
-                   'z_fwhm_min_v': fwhm_min_z[1],
-                   'z_fwhm_shadow_min_h': fwhm_shadow_min_z[0],
-                   'z_fwhm_shadow_min_v': fwhm_shadow_min_z[1],
-                   'center_rms_h': center_rms[0],
-                   'center_rms_v': center_rms[1],
-                   'center_fwhm_h': center_fwhm[0],
-                   'center_fwhm_v': center_fwhm[1],
-                   'center_fwhm_shadow_h': center_fwhm_shadow[0],
-                   'center_fwhm_shadow_v': center_fwhm_shadow[1]}#,
-                   #'histoHZ': histoH,
-                   #'histoVZ': histoV}
-        
-        if(write_attributes):
-            with h5py.File(filename, 'a') as f:
-                for key in list(outdict.keys()):
-                    f.attrs[key] = outdict[key]
-                    
-                f.create_dataset('histoXZ', data=histoH, dtype=float, compression="gzip")
-                f.create_dataset('histoYZ', data=histoV, dtype=float, compression="gzip")
+        with CausticReader(filename) as reader:
+            xStart, xFin, nx, yStart, yFin, ny = reader.plane_ranges()[0][[0, 1, 4, 2, 3, 5]]
+            z_points = reader.z_points()
+        
+        zStart, zFin = outdict['zStart'], outdict['zFin']
+        center_shadow = np.array([outdict['center_shadow_h_array'], outdict['center_shadow_v_array']]).transpose()
+        center = np.array([outdict['center_h_array'], outdict['center_v_array']]).transpose()
+        rms = np.array([outdict['rms_h_array'], outdict['rms_v_array']]).transpose()
+        fwhm = np.array([outdict['fwhm_h_array'], outdict['fwhm_v_array']]).transpose()
+        fwhm_shadow = np.array([outdict['fwhm_shadow_h_array'], outdict['fwhm_shadow_v_array']]).transpose()
+        rms_min_z = [outdict['z_rms_min_h'], outdict['z_rms_min_v']]
                 
         if(print_minimum):
             print('\n   ****** \n' + '   Z min (rms-hor): {0:.3e}'.format(rms_min_z[0]))
@@ -1175,20 +1218,77 @@ class CausticWidget(LNLSShadowWidgetC):
         
         return outdict
                 
-    def run_shadow_caustic(self, filename, beam, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange):
+    def run_shadow_caustic(self, filename, beam, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes=1,
+                           adaptive=False, tolerance=0.01, max_planes=301, storage=None, resume=False, cache=None, progress=None, cancel=None):
+        """
+        Computes the caustic and writes it to filename (see
+        caustic_batch.run_caustic). Returns True when the file is complete.
+        """
+        return run_caustic(filename, beam, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, n_processes=n_processes,
+                           adaptive=adaptive, tolerance=tolerance, max_planes=max_planes, storage=storage, resume=resume, cache=cache,
+                           progress=progress, cancel=cancel)
     
+    def run_analytic_caustic(self, beam, zStart, zFin, nz, colh, colv, colref):
+        """
+        Caustic from the second moments of the rays: no histograms and no file.
+        Plots the RMS curves and prints the waist parameters of both planes.
+        """
         t0 = time.time()
-        good_rays = beam.nrays(nolost=1)
-        self.initialize_hdf5(filename, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, good_rays)
+        analytic = SecondMomentCaustic(beam, colh, colv, colref)
         z_points = np.linspace(zStart, zFin, nz)
-        for i in range(nz):        
-            beam.retrace(z_points[i]);
-            histo = beam.histo2(col_h=colh, col_v=colv, nbins_h=nbinsh, nbins_v=nbinsv, nolost=1, ref=colref, xrange=xrange, yrange=yrange);
-            self.append_dataset_hdf5(filename, data=histo, z=z_points[i], zOffset=zOffset, nz=nz, tag=i+1, t0=t0, ndigits=len(str(nz)))
-        self.read_caustic(filename, write_attributes=True)
+        curves = analytic.caustic(z_points)
+        summary = analytic.summary()
+        
+        sys.stdout.write('\nAnalytic caustic ({0} rays, {1:.3f} s)\n'.format(analytic.nrays, time.time() - t0))
+        for plane, name in [('h', 'X'), ('v', 'Y')]:
+            sys.stdout.write('   {0} waist: z = {1:.6e}, rms = {2:.6e}, center = {3:.6e}\n'.format(name, summary['z_waist_' + plane], 
+                                                                                                      summary['rms_waist_' + plane],
+                                                                                                      summary['center_waist_' + plane]))
+            sys.stdout.write('   {0} divergence (rms) = {1:.6e}, emittance = {2:.6e}, rayleigh = {3:.6e}\n'.format(name, summary['divergence_' + plane],
+                                                                                                                  summary['emittance_' + plane],
+                                                                                                                  summary['rayleigh_' + plane]))
+        
+        xf = [1.0, 1e3, 1e6][self.x_units]
+        yf = [1.0, 1e3, 1e6][self.y_units]
+        zf = [1e-3, 1.0, 1e3, 1e6][self.z_units]
+        xlabel = ['mm', '\u00B5m', 'nm'][self.x_units]
+        ylabel = ['mm', '\u00B5m', 'nm'][self.y_units]
+        zlabel = ['m', 'mm', '\u00B5m', 'nm'][self.z_units]
+        
+        for ax, plane, name, f, label in [(self.ax21, 'h', 'X', xf, xlabel), (self.ax22, 'v', 'Y', yf, ylabel)]:
+            ax.clear()
+            ax.plot(z_points*zf, curves['rms_' + plane]*f, '-', alpha=0.8, label='second moments')
+            if np.isfinite(summary['z_waist_' + plane]):
+                ax.plot(summary['z_waist_' + plane]*zf, summary['rms_waist_' + plane]*f, 'ko', alpha=0.6, label='waist')
+            ax.set_xlabel('Z ' + '[' + zlabel + ']')
+            ax.set_ylabel(name + ' RMS ' + '[' + label + ']')
+            ax.set_title('Analytic (ray second moments)')
+            ax.minorticks_on()
+            ax.tick_params(which='both', axis='both', direction='in', right=True, top=True)
+            ax.grid(which='both', alpha=0.1)
+            ax.legend(loc='best', fontsize=8)
+        
+        self.figure21.canvas.draw()
+        self.figure22.canvas.draw()
+        
+        return {'z_points': z_points, 'curves': curves, 'summary': summary}
+    
+    def plot_caustic_map(self, ax, data, z_points, zf, vmin, vmax, norm=None):
+        """
+        Draws a (n, nz) caustic map with each plane at its real z. Uniform grids
+        use imshow; non-uniform (adaptive) grids need pcolormesh.
+        """
+        dz = np.diff(z_points)
+        if(len(z_points) < 3 or np.allclose(dz, dz[0], rtol=1e-6, atol=0)):
+            ax.imshow(data, extent=[z_points[0]*zf, z_points[-1]*zf, vmin, vmax], aspect='auto', origin='lower', norm=norm)
+        else:
+            z_edges = np.concatenate([[z_points[0] - dz[0]/2.0], (z_points[1:] + z_points[:-1])/2.0, [z_points[-1] + dz[-1]/2.0]])
+            v_edges = np.linspace(vmin, vmax, data.shape[0] + 1)
+            ax.pcolormesh(z_edges*zf, v_edges, data, norm=norm, shading='flat')
     
     def plot_quick_preview(self, filename, scale=0, 
-                            xrange=[0,0], yrange=[0,0], zrange=[0,0], zrangeXZ=[0,0], zrangeYZ=[0,0], xunits=0, yunits=0, zunits=0):
+                            xrange=[0,0], yrange=[0,0], zrange=[0,0], zrangeXZ=[0,0], zrangeYZ=[0,0], xunits=0, yunits=0, zunits=0,
+                            cut_pos_z=0.0):
     
         self.print_date_i()     
         
@@ -1235,38 +1335,54 @@ class CausticWidget(LNLSShadowWidgetC):
             xlabelXZ = 'nm'
             zf=1e6
             
-        with h5py.File(filename, 'r+') as f:
+        with self.get_session_cache().load(filename) as reader:
             
-            dset_names = list(f.keys())
+            attrs = reader.attrs
             
-            if not 'histoXZ' in dset_names:
+            if reader.histoXZ is None:
                 
                 QtWidgets.QMessageBox.critical(self, "Error",
                                            "This caustic hdf5 file is not compatible with quick preview.",
                                            QtWidgets.QMessageBox.Ok) 
                 return 0
             
-            zStart = f.attrs['zStart']
-            zFin = f.attrs['zFin']
-            nz = f.attrs['nz']
-            z_points = np.linspace(zStart, zFin, nz)
+            zStart = attrs['zStart']
+            zFin = attrs['zFin']
+            nz = attrs['nz']
+            z_points = reader.z_points()
 
             
-            xmin = f[dset_names[3]].attrs['xStart'] # [3] is because [0] is a histogram 2D
-            xmax = f[dset_names[3]].attrs['xFin']
-            ymin = f[dset_names[3]].attrs['yStart']
-            ymax = f[dset_names[3]].attrs['yFin']
+            xmin, xmax, ymin, ymax = reader.plane_ranges()[0][:4]
             
-            rms_h_array = f.attrs['rms_h_array']
-            rms_v_array = f.attrs['rms_v_array']
-            fwhm_h_array = f.attrs['fwhm_h_array']            
-            fwhm_v_array = f.attrs['fwhm_v_array']        
-            fwhm_shadow_h_array = f.attrs['fwhm_shadow_h_array']            
-            fwhm_shadow_v_array = f.attrs['fwhm_shadow_v_array']
-            histoHZ = np.array(f['histoXZ'])
-            histoVZ = np.array(f['histoYZ'])
+            if(reader.version > 1):
+                # a single read of the statistics table
+                stats = reader.statistics()
+                rms_h_array, rms_v_array = stats['rms_h'], stats['rms_v']
+                fwhm_h_array, fwhm_v_array = stats['fwhm_h'], stats['fwhm_v']
+                fwhm_shadow_h_array, fwhm_shadow_v_array = stats['fwhm_h_shadow'], stats['fwhm_v_shadow']
+            else:
+                rms_h_array = attrs['rms_h_array']
+                rms_v_array = attrs['rms_v_array']
+                fwhm_h_array = attrs['fwhm_h_array']            
+                fwhm_v_array = attrs['fwhm_v_array']        
+                fwhm_shadow_h_array = attrs['fwhm_shadow_h_array']            
+                fwhm_shadow_v_array = attrs['fwhm_shadow_v_array']
+            histoHZ = reader.histoXZ.copy()
+            histoVZ = reader.histoYZ.copy()
+            
+            # XY slice from the coarsest pyramid level that fills the display (files without levels have none)
+            levels = reader.pyramid_levels()
+            if(len(levels) > 1):
+                factor = pyramid_level(levels, **self.display_resolution())
+                level_z, level_ranges = levels[factor]
+                z_idx = np.abs(level_z - cut_pos_z/zf).argmin()
+                z_to_plot = level_z[z_idx]
+                mtx_to_plot = reader.read_level(factor, z_idx).transpose()
+                xy_extent = level_ranges[:4]
+            else:
+                mtx_to_plot = None
             
-            self.time_string = f.attrs['end time']
+            self.time_string = attrs['end time']
             
         self.axXZ.clear()
         self.axXZ.set_xlabel('Z ' + '[' + xlabelXZ + ']')
@@ -1283,33 +1399,37 @@ class CausticWidget(LNLSShadowWidgetC):
         self.axYZ.tick_params(which='both', axis='both', direction='out', right=True, top=True)
         
         self.axXY.clear()
-        #self.axXY.set_xlabel('X ' + '[' + xlabelXY + ']')
-        #self.axXY.set_ylabel('Y ' + '[' + ylabelXY + ']')
-        #self.axXY.set_title('Slice at Z = {0:.6f} '.format(z_to_plot) + xlabelXZ)
-        #self.axXY.minorticks_on()
-        #self.axXY.tick_params(which='both', axis='both', direction='out', right=True, top=True)
+        if mtx_to_plot is not None:
+            self.axXY.set_xlabel('X ' + '[' + xlabelXY + ']')
+            self.axXY.set_ylabel('Y ' + '[' + ylabelXY + ']')
+            self.axXY.set_title('Slice at Z = {0:.6f} '.format(z_to_plot*zf) + xlabelXZ)
+            self.axXY.minorticks_on()
+            self.axXY.tick_params(which='both', axis='both', direction='out', right=True, top=True)
         #self.axXY.hlines(y=y_pts_local[y_cut_idx]*yf, xmin=ranges_to_plot[0]*xf, xmax=ranges_to_plot[1]*xf, alpha=0.4, color='white', linestyle='--')
         #self.axXY.vlines(x=x_pts_local[x_cut_idx]*xf, ymin=ranges_to_plot[2]*yf, ymax=ranges_to_plot[3]*yf, alpha=0.4, color='white', linestyle='--')
         
         if(scale==0):
 
-            self.axXZ.imshow(histoHZ, extent=[zStart*zf, zFin*zf, xmin*xf, xmax*xf], aspect='auto', origin='lower')        
-            self.axYZ.imshow(histoVZ, extent=[zStart*zf, zFin*zf, ymin*yf, ymax*yf], aspect='auto', origin='lower')
-            #self.axXY.imshow(mtx_to_plot, extent=[xmin*xf, xmax*xf, ymin*yf, ymax*yf], aspect='auto', origin='lower')
+            self.plot_caustic_map(self.axXZ, histoHZ, z_points, zf, xmin*xf, xmax*xf)        
+            self.plot_caustic_map(self.axYZ, histoVZ, z_points, zf, ymin*yf, ymax*yf)
+            if mtx_to_plot is not None:
+                self.axXY.imshow(mtx_to_plot, extent=[xy_extent[0]*xf, xy_extent[1]*xf, xy_extent[2]*yf, xy_extent[3]*yf], aspect='auto', origin='lower')
             
         elif(scale==1):
 
             xc_min_except_0 = np.min(histoHZ[histoHZ>0])
             histoHZ[histoHZ<=0.0] = xc_min_except_0/2.0
-            self.axXZ.imshow(histoHZ, extent=[zStart*zf, zFin*zf, xmin*xf, xmax*xf], aspect='auto', origin='lower', norm=LogNorm(vmin=xc_min_except_0/2.0, vmax=np.max(histoHZ)))
+            self.plot_caustic_map(self.axXZ, histoHZ, z_points, zf, xmin*xf, xmax*xf, norm=LogNorm(vmin=xc_min_except_0/2.0, vmax=np.max(histoHZ)))
     
             yc_min_except_0 = np.min(histoVZ[histoVZ>0])
             histoVZ[histoVZ<=0.0] = yc_min_except_0/2.0
-            self.axYZ.imshow(histoVZ, extent=[zStart*zf, zFin*zf, ymin*yf, ymax*yf], aspect='auto', origin='lower', norm=LogNorm(vmin=yc_min_except_0/2.0, vmax=np.max(histoVZ)))
+            self.plot_caustic_map(self.axYZ, histoVZ, z_points, zf, ymin*yf, ymax*yf, norm=LogNorm(vmin=yc_min_except_0/2.0, vmax=np.max(histoVZ)))
 
-            #xy_min_except_0 = np.min(mtx_to_plot[mtx_to_plot>0])
-            #mtx_to_plot[mtx_to_plot<=0.0] = xy_min_except_0/2.0
-            #self.axXY.imshow(mtx_to_plot, extent=[xmin*xf, xmax*xf, ymin*yf, ymax*yf], aspect='auto', origin='lower', norm=LogNorm(vmin=xy_min_except_0/2.0, vmax=np.max(mtx_to_plot)))
+            if mtx_to_plot is not None:
+                xy_min_except_0 = np.min(mtx_to_plot[mtx_to_plot>0])
+                mtx_to_plot[mtx_to_plot<=0.0] = xy_min_except_0/2.0
+                self.axXY.imshow(mtx_to_plot, extent=[xy_extent[0]*xf, xy_extent[1]*xf, xy_extent[2]*yf, xy_extent[3]*yf], aspect='auto', origin='lower', 
+                                 norm=LogNorm(vmin=xy_min_except_0/2.0, vmax=np.max(mtx_to_plot)))
                         
         ##############
         ## 2D Analysis
@@ -1400,7 +1520,8 @@ class CausticWidget(LNLSShadowWidgetC):
 
     
     def plot_shadow_caustic(self, filename, cut_pos_x=0.0, cut_pos_y=0.0, cut_pos_z=0.0, nx=0, ny=0, scale=0, 
-                            xrange=[0,0], yrange=[0,0], zrange=[0,0], zrangeXZ=[0,0], zrangeYZ=[0,0], xunits=0, yunits=0, zunits=0):
+                            xrange=[0,0], yrange=[0,0], zrange=[0,0], zrangeXZ=[0,0], zrangeYZ=[0,0], xunits=0, yunits=0, zunits=0,
+                            refine_fits=False):
         
         self.print_date_i()     
         
@@ -1447,28 +1568,22 @@ class CausticWidget(LNLSShadowWidgetC):
             xlabelXZ = 'nm'
             zf=1e6
         
-        with h5py.File(filename, 'r+') as f:
+        with self.get_session_cache().load(filename) as reader:
             
-            zStart = f.attrs['zStart']
-            zFin = f.attrs['zFin']
-            nz = f.attrs['nz']
-            z_points = np.linspace(zStart, zFin, nz)
-            dset_names = list(f.keys())
-            del dset_names[0:2] # bug correction for new caustic
-            z_to_plot = z_points[np.abs(z_points - cut_pos_z/zf).argmin()]
-            self.time_string = f.attrs['end time']
+            zStart = reader.attrs['zStart']
+            zFin = reader.attrs['zFin']
+            nz = reader.nz
+            z_points = reader.z_points()
+            z_idx = np.abs(z_points - cut_pos_z/zf).argmin()
+            z_to_plot = z_points[z_idx]
+            self.time_string = reader.attrs['end time']
+            stats = reader.statistics()
+            wavelength = reader.attrs.get('wavelength') # Angstroms
             
             #####################
             # find maximum ranges
             #####################
-            xy_range = np.zeros((len(dset_names), 6))
-            
-            for i in range(len(dset_names)):
-            
-                dset = dset_names[i]
-                xy_range[i] = np.array([f[dset].attrs['xStart'], f[dset].attrs['xFin'], 
-                                        f[dset].attrs['yStart'], f[dset].attrs['yFin'],
-                                        f[dset].attrs['nx'], f[dset].attrs['ny']])
+            xy_range = reader.plane_ranges()
             
             xmin = np.min(xy_range[:,0])
             xmax = np.max(xy_range[:,1])
@@ -1484,121 +1599,95 @@ class CausticWidget(LNLSShadowWidgetC):
             x_pts_global = np.linspace(xmin, xmax, nx)
             y_pts_global = np.linspace(ymin, ymax, ny)
             
-            x_caustic = np.zeros((nx, len(dset_names)))
-            y_caustic = np.zeros((ny, len(dset_names)))
-            x_properties = np.zeros((5, len(dset_names)))
-            y_properties = np.zeros((5, len(dset_names)))    
+            x_properties = np.zeros((6, nz))
+            y_properties = np.zeros((6, nz))    
+            x_properties[5], y_properties[5] = reader.peak_positions()
+            x_properties[4] = stats['fwhm_h_shadow']
+            y_properties[4] = stats['fwhm_v_shadow']
+            x_grids, y_grids = [], []
 
             #####################
-            # do caustic
+            # read cuts
             #####################
             
-            for i in range(len(dset_names)):
-                
-                dset = dset_names[i]
-                mtx = np.array(f[dset]).transpose()
-                if(f[dset].attrs['z']==z_to_plot):
-                    mtx_to_plot = mtx
-                    ranges_to_plot = [f[dset].attrs['xStart'], f[dset].attrs['xFin'], f[dset].attrs['yStart'], f[dset].attrs['yFin']]
-                x_pts_local = np.linspace(f[dset].attrs['xStart'], f[dset].attrs['xFin'], f[dset].attrs['nx'])
-                y_pts_local = np.linspace(f[dset].attrs['yStart'], f[dset].attrs['yFin'], f[dset].attrs['ny'])
-                x_cut_idx = np.abs(x_pts_local - cut_pos_x/xf).argmin()
-                y_cut_idx = np.abs(y_pts_local - cut_pos_y/yf).argmin() 
-                x_cut = mtx[y_cut_idx, :]
-                y_cut = mtx[:, x_cut_idx]
-                
-                #### correct ranges for each dataset 
-                
-                if(x_pts_local[0] > xmin):
-                    x_pts_local = np.insert(x_pts_local, 0, xmin)
-                    x_cut = np.insert(x_cut, 0, 0)
+            # nearest bin to the cut positions in each plane
+            x_cut_indices, y_cut_indices = self.cut_indices(xy_range, cut_pos_x/xf, cut_pos_y/yf)
             
-                if(x_pts_local[-1] < xmax):
-                    x_pts_local = np.insert(x_pts_local, -1, xmax)
-                    x_cut = np.insert(x_cut, -1, 0)
-        
-                if(y_pts_local[0] > ymin):
-                    y_pts_local = np.insert(y_pts_local, 0, ymin)
-                    y_cut = np.insert(y_cut, 0, 0)
+            # only the cut rows and columns and the plane at z_cut_position are read
+            x_cuts, y_cuts = reader.read_cuts(x_cut_indices, y_cut_indices)
+            ranges_to_plot = xy_range[z_idx][:4]
             
-                if(y_pts_local[-1] < ymax):
-                    y_pts_local = np.insert(y_pts_local, -1, ymax)
-                    y_cut = np.insert(y_cut, -1, 0)    
-                    
-                #### interpolate and sample at global coordinates
-                
-                x_cut_interp = interp1d(x=x_pts_local, y=x_cut, kind='linear')
-                y_cut_interp = interp1d(x=y_pts_local, y=y_cut, kind='linear')
-                
-                x_cut_global = x_cut_interp(x_pts_global)
-                y_cut_global = y_cut_interp(y_pts_global)
+            # the XY map is read from the coarsest pyramid level that fills the display
+            levels = reader.pyramid_levels()
+            factor = pyramid_level(levels, **self.display_resolution())
+            mtx_to_plot = reader.read_level(factor, z_idx).transpose()
+            xy_extent = [xmin, xmax, ymin, ymax] if factor == 1 else levels[factor][1][:4]
+
+            #### sample all cuts at global coordinates (a copy when all planes share the ranges)
+            
+            x_caustic = resample_profiles(x_cuts, xy_range[:,0], xy_range[:,1], x_pts_global)
+            y_caustic = resample_profiles(y_cuts, xy_range[:,2], xy_range[:,3], y_pts_global)
+
+            #####################
+            # do caustic
+            #####################
+            
+            for i in range(nz):
                 
-                x_caustic[:, i] = x_cut_global 
-                y_caustic[:, i] = y_cut_global
+                x_pts_local = np.linspace(xy_range[i][0], xy_range[i][1], int(xy_range[i][4]))
+                y_pts_local = np.linspace(xy_range[i][2], xy_range[i][3], int(xy_range[i][5]))
+                x_cut_idx = x_cut_indices[i]
+                y_cut_idx = y_cut_indices[i]
+                x_cut = np.asarray(x_cuts[i], dtype=np.float64)
+                y_cut = np.asarray(y_cuts[i], dtype=np.float64)
                 
                 #### calculate properties
                 
-                x_properties[0][i] = self.get_fwhm(x_pts_local, x_cut, oversampling=200, zero_padding=False)[0]
+                x_grids.append(x_pts_local)
                 x_properties[1][i] = self.calc_rms(x_pts_local, x_cut)
                 x_properties[2][i] = np.max(x_cut)
                 x_properties[3][i] = x_pts_local[np.abs(x_cut - np.max(x_cut)).argmin()]
-                x_properties[4][i] = f[dset].attrs['fwhm_h_shadow'] 
         
-                y_properties[0][i] = self.get_fwhm(y_pts_local, y_cut, oversampling=200, zero_padding=False)[0]
+                y_grids.append(y_pts_local)
                 y_properties[1][i] = self.calc_rms(y_pts_local, y_cut)
                 y_properties[2][i] = np.max(y_cut)
                 y_properties[3][i] = y_pts_local[np.abs(y_cut - np.max(y_cut)).argmin()]
-                y_properties[4][i] = f[dset].attrs['fwhm_v_shadow']
-        
-       
-                if(0): # Calculate 2D peak positions
-                    xpeak_idx, ypeak_idx = self.find_peak(f[dset])
-                    x_properties[4][i] = x_pts_local[xpeak_idx[0]] 
-                    y_properties[4][i] = y_pts_local[ypeak_idx[0]]
+
+            x_properties[0] = self.get_fwhm_of_cuts(x_grids, x_cuts)
+            y_properties[0] = self.get_fwhm_of_cuts(y_grids, y_cuts)
+
         #### fit fwhm and rms
-        total_limits = np.linspace(0, len(z_points)-1, len(z_points), dtype=int)
-        
         if not(zrangeXZ[0]==0 and zrangeXZ[1]==0):
             flXZ = np.where(np.logical_and(z_points>=zrangeXZ[0]/zf, z_points<=zrangeXZ[1]/zf)) # limits for fitting
         else:
-            flXZ = total_limits
+            flXZ = np.ones(nz, dtype=bool)
             
         if not(zrangeYZ[0]==0 and zrangeYZ[1]==0):
             flYZ = np.where(np.logical_and(z_points>=zrangeYZ[0]/zf, z_points<=zrangeYZ[1]/zf)) # limits for fitting
         else:
-            flYZ = total_limits
-        
-        try:
-#            sys.stdout.write('\n beta guess = {0:.6f}\n'.format(x_properties[0][int(nz/2)]/((x_properties[0][-1] -x_properties[0][int(nz/2)]) / (z_points[-1] - z_points[int(nz/2)]))))
-            popt1, pcov1 = curve_fit(f=self.gaussian_beam, xdata=z_points[flXZ], ydata=x_properties[0][flXZ], 
-                                     p0=[x_properties[0][int(nz/2)], z_points[int(nz/2.2)], x_properties[0][int(nz/2)]/((x_properties[0][-1] -x_properties[0][int(nz/2)]) / (z_points[-1] - z_points[int(nz/2)]))], maxfev=5000)
-        except:
-            popt1=[0]*3 
-        try:
-            popt2, pcov2 = curve_fit(f=self.gaussian_beam, xdata=z_points[flXZ], ydata=x_properties[1][flXZ], 
-                                     p0=[x_properties[1][int(nz/2)], z_points[int(nz/2.2)], x_properties[1][int(nz/2)]/((x_properties[1][-1] -x_properties[1][int(nz/2)]) / (z_points[-1] - z_points[int(nz/2)]))], maxfev=5000)
-        except:
-            popt2=[0]*3 
-        try:
-            popt3, pcov3 = curve_fit(f=self.gaussian_beam, xdata=z_points[flXZ], ydata=x_properties[4][flXZ], 
-                                     p0=[x_properties[4][int(nz/2)], z_points[int(nz/2.2)], x_properties[4][int(nz/2)]/((x_properties[4][-1] -x_properties[4][int(nz/2)]) / (z_points[-1] - z_points[int(nz/2)]))], maxfev=5000)
-        except:
-            popt3=[0]*3
-        try:
-            popt4, pcov4 = curve_fit(f=self.gaussian_beam, xdata=z_points[flYZ], ydata=y_properties[0][flYZ], 
-                                     p0=[y_properties[0][int(nz/2)], z_points[int(nz/2.2)], y_properties[0][int(nz/2)]/((y_properties[0][-1] -y_properties[0][int(nz/2)]) / (z_points[-1] - z_points[int(nz/2)]))], maxfev=5000)
-        except:
-            popt4=[0]*3
-        try:
-            popt5, pcov5 = curve_fit(f=self.gaussian_beam, xdata=z_points[flYZ], ydata=y_properties[1][flYZ], 
-                                     p0=[y_properties[1][int(nz/2)], z_points[int(nz/2.2)], y_properties[1][int(nz/2)]/((y_properties[1][-1] -y_properties[1][int(nz/2)]) / (z_points[-1] - z_points[int(nz/2)]))], maxfev=5000)
-        except:
-            popt5=[0]*3
-        try:
-            popt6, pcov6 = curve_fit(f=self.gaussian_beam, xdata=z_points[flYZ], ydata=y_properties[4][flYZ], 
-                                     p0=[y_properties[4][int(nz/2)], z_points[int(nz/2.2)], x_properties[4][int(nz/2)]/((x_properties[4][-1] -x_properties[4][int(nz/2)]) / (z_points[-1] - z_points[int(nz/2)]))], maxfev=5000)
-        except:
-            popt6=[0]*3
+            flYZ = np.ones(nz, dtype=bool)
+        
+        maskXZ = np.zeros(nz, dtype=bool)
+        maskXZ[flXZ] = True
+        maskYZ = np.zeros(nz, dtype=bool)
+        maskYZ[flYZ] = True
+
+        # fwhm cut, rms cut and shadow fwhm of both planes, in a single solve
+        curves = [x_properties[0], x_properties[1], x_properties[4], y_properties[0], y_properties[1], y_properties[4]]
+        fits = fit_gaussian_beams(z_points, curves, masks=[maskXZ]*3 + [maskYZ]*3, refine=refine_fits)
+        
+        popt = [[fits['s0'][k], fits['z0'][k], fits['beta'][k]] if fits['valid'][k] else [0]*3 for k in range(6)]
+        perr = [[fits['s0_err'][k], fits['z0_err'][k], fits['beta_err'][k]] if fits['valid'][k] else [0]*3 for k in range(6)]
+        popt1, popt2, popt3, popt4, popt5, popt6 = popt
+        perr1, perr2, perr3, perr4, perr5, perr6 = perr
+
+        # M² = 4 pi emittance / wavelength, with the emittance of the waist (size**2/beta, rms sizes)
+        if wavelength is not None:
+            to_rms = np.array([1/(2*np.sqrt(2*np.log(2))), 1, 1/(2*np.sqrt(2*np.log(2)))]*2)
+            m2 = beam_quality_factor(np.square(fits['s0']*to_rms)/fits['beta'], wavelength*1e-7)
+            m2 = np.where(fits['valid'], m2, 0.0)
+        else:
+            m2 = np.zeros(6)
         
         save_filename, ext = os.path.splitext(filename)
     
@@ -1615,12 +1704,22 @@ class CausticWidget(LNLSShadowWidgetC):
                    "peak_y_cut":y_properties[2],
                    "z_peak_x_cut":x_properties[3]*zf,
                    "z_peak_y_cut":y_properties[3]*zf,
+                   "peak_x_2D":x_properties[5]*xf,
+                   "peak_y_2D":y_properties[5]*yf,
                    "popt_fwhm_x_cut":[popt1[0]*xf, popt1[1]*zf, popt1[2]*zf],
                    "popt_rms_x_cut":[popt2[0]*xf, popt2[1]*zf, popt2[2]*zf],
                    "popt_fwhm_x_histo":[popt3[0]*xf, popt3[1]*zf, popt3[2]*zf],
                    "popt_fwhm_y_cut":[popt4[0]*yf, popt4[1]*zf, popt4[2]*zf],
                    "popt_rms_y_cut":[popt5[0]*yf, popt5[1]*zf, popt5[2]*zf],
-                   "popt_fwhm_y_histo":[popt6[0]*yf, popt6[1]*zf, popt6[2]*zf]} 
+                   "popt_fwhm_y_histo":[popt6[0]*yf, popt6[1]*zf, popt6[2]*zf],
+                   "perr_fwhm_x_cut":[perr1[0]*xf, perr1[1]*zf, perr1[2]*zf],
+                   "perr_rms_x_cut":[perr2[0]*xf, perr2[1]*zf, perr2[2]*zf],
+                   "perr_fwhm_x_histo":[perr3[0]*xf, perr3[1]*zf, perr3[2]*zf],
+                   "perr_fwhm_y_cut":[perr4[0]*yf, perr4[1]*zf, perr4[2]*zf],
+                   "perr_rms_y_cut":[perr5[0]*yf, perr5[1]*zf, perr5[2]*zf],
+                   "perr_fwhm_y_histo":[perr6[0]*yf, perr6[1]*zf, perr6[2]*zf],
+                   "m2_x":m2[:3],
+                   "m2_y":m2[3:]} 
             
         
         self.outtext  = "File name: " + filename + '\n'
@@ -1632,6 +1731,9 @@ class CausticWidget(LNLSShadowWidgetC):
         self.outtext += "Cut Minimum (RMS, Z) = ({0:.3f} {2}, {1:.3f} {3}) \n".format(outdict["popt_rms_x_cut"][0], outdict["popt_rms_x_cut"][1], ylabelXZ, xlabelXZ)
         self.outtext += "Minimum Z (average) = {0:.3f} {1}\n".format(np.mean([outdict["popt_fwhm_x_cut"][1], outdict["popt_fwhm_x_histo"][1], outdict["popt_rms_x_cut"][1]]), xlabelXZ)
         self.outtext += "Betas: (cut-FWHM, histo-FWHM, cut-RMS) = {0:.6f}, {1:.6f}, {2:.6f} {3}\n".format(outdict["popt_fwhm_x_cut"][2], outdict["popt_fwhm_x_histo"][2], outdict["popt_rms_x_cut"][2], xlabelXZ)
+        self.outtext += "Z uncertainties: (cut-FWHM, histo-FWHM, cut-RMS) = {0:.3f}, {1:.3f}, {2:.3f} {3}\n".format(outdict["perr_fwhm_x_cut"][1], outdict["perr_fwhm_x_histo"][1], outdict["perr_rms_x_cut"][1], xlabelXZ)
+        if wavelength is not None:
+            self.outtext += "M2: (cut-FWHM, histo-FWHM, cut-RMS) = {0:.3f}, {1:.3f}, {2:.3f}\n".format(*outdict["m2_x"][[0, 2, 1]])
 
         self.outtext += "\nYZ Slice: \n"
         self.outtext += "Cut Minimum (FWHM, Z) = ({0:.3f} {2}, {1:.3f} {3}) \n".format(outdict["popt_fwhm_y_cut"][0], outdict["popt_fwhm_y_cut"][1], ylabelYZ, xlabelYZ)
@@ -1639,6 +1741,9 @@ class CausticWidget(LNLSShadowWidgetC):
         self.outtext += "Cut Minimum (RMS, Z) = ({0:.3f} {2}, {1:.3f} {3}) \n".format(outdict["popt_rms_y_cut"][0], outdict["popt_rms_y_cut"][1], ylabelYZ, xlabelYZ)
         self.outtext += "Minimum Z (average) = {0:.3f} {1}\n".format(np.mean([outdict["popt_fwhm_y_cut"][1], outdict["popt_fwhm_y_histo"][1], outdict["popt_rms_y_cut"][1]]), xlabelXZ)
         self.outtext += "Betas: (cut-FWHM, histo-FWHM, cut-RMS) = {0:.6f}, {1:.6f}, {2:.6f} {3}\n".format(outdict["popt_fwhm_y_cut"][2], outdict["popt_fwhm_y_histo"][2], outdict["popt_rms_y_cut"][2], xlabelYZ)
+        self.outtext += "Z uncertainties: (cut-FWHM, histo-FWHM, cut-RMS) = {0:.3f}, {1:.3f}, {2:.3f} {3}\n".format(outdict["perr_fwhm_y_cut"][1], outdict["perr_fwhm_y_histo"][1], outdict["perr_rms_y_cut"][1], xlabelYZ)
+        if wavelength is not None:
+            self.outtext += "M2: (cut-FWHM, histo-FWHM, cut-RMS) = {0:.3f}, {1:.3f}, {2:.3f}\n".format(*outdict["m2_y"][[0, 2, 1]])
         
 
         #self.time_string = time.strftime("%Y-%m-%d-%Hh-%Mm-%Ss", time.localtime())
@@ -1676,23 +1781,23 @@ class CausticWidget(LNLSShadowWidgetC):
         
         if(scale==0):
 
-            self.axXZ.imshow(x_caustic, extent=[zStart*zf, zFin*zf, xmin*xf, xmax*xf], aspect='auto', origin='lower')        
-            self.axYZ.imshow(y_caustic, extent=[zStart*zf, zFin*zf, ymin*yf, ymax*yf], aspect='auto', origin='lower')
-            self.axXY.imshow(mtx_to_plot, extent=[xmin*xf, xmax*xf, ymin*yf, ymax*yf], aspect='auto', origin='lower')
+            self.plot_caustic_map(self.axXZ, x_caustic, z_points, zf, xmin*xf, xmax*xf)        
+            self.plot_caustic_map(self.axYZ, y_caustic, z_points, zf, ymin*yf, ymax*yf)
+            self.axXY.imshow(mtx_to_plot, extent=[xy_extent[0]*xf, xy_extent[1]*xf, xy_extent[2]*yf, xy_extent[3]*yf], aspect='auto', origin='lower')
             
         elif(scale==1):
 
             xc_min_except_0 = np.min(x_caustic[x_caustic>0])
             x_caustic[x_caustic<=0.0] = xc_min_except_0/2.0
-            self.axXZ.imshow(x_caustic, extent=[zStart*zf, zFin*zf, xmin*xf, xmax*xf], aspect='auto', origin='lower', norm=LogNorm(vmin=xc_min_except_0/2.0, vmax=np.max(x_caustic)))
+            self.plot_caustic_map(self.axXZ, x_caustic, z_points, zf, xmin*xf, xmax*xf, norm=LogNorm(vmin=xc_min_except_0/2.0, vmax=np.max(x_caustic)))
     
             yc_min_except_0 = np.min(y_caustic[y_caustic>0])
             y_caustic[y_caustic<=0.0] = yc_min_except_0/2.0
-            self.axYZ.imshow(y_caustic, extent=[zStart*zf, zFin*zf, ymin*yf, ymax*yf], aspect='auto', origin='lower', norm=LogNorm(vmin=yc_min_except_0/2.0, vmax=np.max(y_caustic)))
+            self.plot_caustic_map(self.axYZ, y_caustic, z_points, zf, ymin*yf, ymax*yf, norm=LogNorm(vmin=yc_min_except_0/2.0, vmax=np.max(y_caustic)))
 
             xy_min_except_0 = np.min(mtx_to_plot[mtx_to_plot>0])
             mtx_to_plot[mtx_to_plot<=0.0] = xy_min_except_0/2.0
-            self.axXY.imshow(mtx_to_plot, extent=[xmin*xf, xmax*xf, ymin*yf, ymax*yf], aspect='auto', origin='lower', norm=LogNorm(vmin=xy_min_except_0/2.0, vmax=np.max(mtx_to_plot)))
+            self.axXY.imshow(mtx_to_plot, extent=[xy_extent[0]*xf, xy_extent[1]*xf, xy_extent[2]*yf, xy_extent[3]*yf], aspect='auto', origin='lower', norm=LogNorm(vmin=xy_min_except_0/2.0, vmax=np.max(mtx_to_plot)))
                         
         ##############
         ## 2D Analysis
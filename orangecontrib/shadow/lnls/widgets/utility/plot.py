@@ -13,23 +13,7 @@ from optlnls.math import get_fwhm, calc_rms, zero_padding
 from optlnls.fitting import gauss_function, lorentz_function, lorentz_gauss_function, pseudo_voigt_asymmetric
 from optlnls.fitting import fit_gauss, fit_lorentz, fit_lorentz_gauss, fit_pseudo_voigt_asymmetric
 from scipy.signal import savgol_filter
-
-def find_peak(xz):
-    zmax = [0, 0]; xmax = [0, 0]
-
-    for i in range(len(xz[:,0])):
-        for j in range(len(xz[0,:])):
-            
-            if(xz[i,j] > zmax[1]):
-                zmax[0] = j
-                zmax[1] = xz[i,j]
-                                
-            if(xz[i,j] > xmax[1]):
-                xmax[0] = i
-                xmax[1] = xz[i,j]
-                
-    return xmax, zmax
-
+from orangecontrib.shadow.lnls.widgets.utility.histogram import image_statistics
 
 def beam_integral(mtx):
     px = ((mtx[0, -1] - mtx[0, 1]) / (len(mtx[0,1:]) - 1))
@@ -227,14 +211,12 @@ def plot_beam(beam2D, show_plot=True, outfilename='', outfileext='png', cut=0, t
     x_cut_coord = 0.0
     z_cut_coord = 0.0
    
-    # FIND MEAN VALUE
-    z_int = np.array([np.sum(xz[i,1:]) for i in range(len(z_axis))])
-    x_int = np.array([np.sum(xz[1:,j]) for j in range(len(x_axis))])
-    z_mean = np.average(z_axis, weights=z_int)
-    x_mean = np.average(x_axis, weights=x_int)
-    
-    # FIND PEAK VALUES
-    xmax, zmax = [[0, 0], [0, 0]]
+    # FIND MEAN AND PEAK VALUES
+    xz_stats = image_statistics(xz, z_axis, x_axis)
+    z_mean = xz_stats['mean_h']
+    x_mean = xz_stats['mean_v']
+    z_peak_idx = xz_stats['peak_h_index']
+    x_peak_idx = xz_stats['peak_v_index']
     
     # CHANGE MINIMUM VALUE IF NEEDED (e.g. z_min_factor=1e-5 for log plots)
     if(z_min_factor != 0):
@@ -253,11 +235,10 @@ def plot_beam(beam2D, show_plot=True, outfilename='', outfileext='png', cut=0, t
         x_cut = xz[np.abs(z_axis).argmin(), :]
     
     elif(cut==2): # PLOT CUT AT PEAK
-        xmax, zmax = find_peak(xz)
-        x_cut_coord = x_axis[zmax[0]]
-        z_cut_coord = z_axis[xmax[0]]
-        z_cut = xz[:, zmax[0]]
-        x_cut = xz[xmax[0], :]
+        x_cut_coord = x_axis[x_peak_idx]
+        z_cut_coord = z_axis[z_peak_idx]
+        z_cut = xz[:, x_peak_idx]
+        x_cut = xz[z_peak_idx, :]
 
     elif(cut==3): # PLOT CUT AT MEAN VALUE OF INTEGRATED DISTRIBUTION
         x_cut_coord = x_axis[np.abs(x_axis-x_mean).argmin()]
@@ -536,8 +517,8 @@ def plot_beam(beam2D, show_plot=True, outfilename='', outfileext='png', cut=0, t
     text2 += vert_label+' POS. MEAN = {0:.3f}\n\n'.format(z_mean)
     
     # PEAK COORDINATES
-    text3  = hor_label+' POS. PEAK = {0:.3f}\n'.format(x_axis[zmax[0]])
-    text3 += vert_label+' POS. PEAK = {0:.3f}\n'.format(z_axis[xmax[0]])
+    text3  = hor_label+' POS. PEAK = {0:.3f}\n'.format(x_axis[x_peak_idx])
+    text3 += vert_label+' POS. PEAK = {0:.3f}\n'.format(z_axis[z_peak_idx])
 
     # DATA RANGE
     text4  = hor_label+' RANGE = {0:.3f}\n'.format(x_axis[-1] - x_axis[0])
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def gaussian_beam():
+    """
+    Factory of Shadow beams of a Gaussian source with its waist near y = 0
+    (mm, rad), with a few lost rays.
+    """
+    Shadow = pytest.importorskip('Shadow')
+
+    def make(nrays=5000, seed=0):
+        rng = np.random.default_rng(seed)
+        beam = Shadow.Beam(nrays)
+        rays = beam.rays
+        rays[:, 0] = rng.normal(0, 5e-3, nrays)
+        rays[:, 1] = rng.normal(0, 1e-1, nrays)
+        rays[:, 2] = rng.normal(0, 2e-3, nrays)
+        rays[:, 3] = rng.normal(0, 2e-4, nrays)
+        rays[:, 5] = rng.normal(0, 1e-4, nrays)
+        rays[:, 4] = np.sqrt(1 - rays[:, 3]**2 - rays[:, 5]**2)
+        rays[:, 6] = rng.uniform(0.5, 1.0, nrays)
+        rays[:, 9] = np.where(rng.uniform(size=nrays) < 0.02, -1.0, 1.0)
+        rays[:, 10] = 8000.0
+        rays[:, 11] = np.arange(nrays) + 1
+        return beam
+
+    return make
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+pytest.importorskip('Shadow')
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic import FreeSpacePropagator, iter_caustic_histograms
+
+
+Z_POINTS = np.linspace(-30.0, 30.0, 7)
+RANGE = [-0.02, 0.02]
+
+
+def test_propagator_matches_retrace(gaussian_beam):
+    beam = gaussian_beam()
+    rays = beam.rays.copy()
+    h, v = FreeSpacePropagator(beam, 1, 3, 23).propagate(Z_POINTS)
+
+    for i, z in enumerate(Z_POINTS):
+        retraced = beam.duplicate()
+        retraced.retrace(z)
+        np.testing.assert_allclose(h[i], retraced.getshonecol(1, nolost=1), rtol=0, atol=1e-12)
+        np.testing.assert_allclose(v[i], retraced.getshonecol(3, nolost=1), rtol=0, atol=1e-12)
+
+    # the input beam is left untouched
+    np.testing.assert_array_equal(beam.rays, rays)
+
+def test_propagator_blocks(gaussian_beam):
+    beam = gaussian_beam()
+    propagator = FreeSpacePropagator(beam, 1, 3, 23, max_block_bytes=16 * 3 * beam.nrays(nolost=1))
+    assert propagator.block_size() == 3
+
+    blocks = list(propagator.iter_blocks(Z_POINTS))
+    assert [len(z_block) for z_block, h, v in blocks] == [3, 3, 1]
+    h, v = propagator.propagate(Z_POINTS)
+    np.testing.assert_array_equal(np.concatenate([block[1] for block in blocks]), h)
+    np.testing.assert_array_equal(np.concatenate([block[2] for block in blocks]), v)
+
+def test_propagator_unsupported_columns(gaussian_beam):
+    assert not FreeSpacePropagator.is_supported(1, 20)
+    with pytest.raises(ValueError):
+        FreeSpacePropagator(gaussian_beam(), 1, 3, 1)
+
+def test_histograms_match_shadow(gaussian_beam):
+    # planes of the propagator against Shadow's retrace + histo2
+    beam = gaussian_beam()
+    histos = list(iter_caustic_histograms(beam, Z_POINTS, 1, 3, 23, 40, 30, RANGE, RANGE))
+    assert len(histos) == len(Z_POINTS)
+
+    for z, histo in zip(Z_POINTS, histos):
+        retraced = beam.duplicate()
+        retraced.retrace(z)
+        reference = retraced.histo2(col_h=1, col_v=3, nbins_h=40, nbins_v=30, nolost=1, ref=23, xrange=RANGE, yrange=RANGE)
+        np.testing.assert_allclose(histo['histogram'], reference['histogram'], rtol=1e-12, atol=1e-12)
+        assert histo['fwhm_h'] == pytest.approx(reference['fwhm_h'])
+
+def test_parallel_planes_match_serial(gaussian_beam):
+    beam = gaussian_beam()
+    serial = list(iter_caustic_histograms(beam, Z_POINTS, 1, 3, 23, 40, 30, RANGE, RANGE))
+    parallel = list(iter_caustic_histograms(beam, Z_POINTS, 1, 3, 23, 40, 30, RANGE, RANGE, n_processes=2, shards_in_flight=1))
+    assert len(parallel) == len(serial)
+    for a, b in zip(serial, parallel):
+        np.testing.assert_array_equal(a['histogram'], b['histogram'])
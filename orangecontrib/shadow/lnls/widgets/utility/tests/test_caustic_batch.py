@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+pytest.importorskip('Shadow')
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic_batch import merge_shards, plane_statistics, run_caustic
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import PLANE_COLUMNS, CausticReader
+from orangecontrib.shadow.lnls.widgets.utility.histogram import get_fwhm
+
+
+def _plane_data(seed=0):
+    rng = np.random.default_rng(seed)
+    h, v = rng.normal(0, 0.3, 4000), rng.normal(0.2, 0.5, 4000)
+    histogram, h_edges, v_edges = np.histogram2d(h, v, bins=[31, 27], range=[[-1, 1], [-1.5, 1.5]])
+    return {'histogram': histogram,
+            'bin_h_center': 0.5 * (h_edges[1:] + h_edges[:-1]), 'histogram_h': histogram.sum(axis=1),
+            'bin_v_center': 0.5 * (v_edges[1:] + v_edges[:-1]), 'histogram_v': histogram.sum(axis=0),
+            'fwhm_h': 0.7, 'fwhm_coordinates_h': (-0.35, 0.35), 'fwhm_v': None}
+
+def test_plane_statistics():
+    data = _plane_data()
+    stats = plane_statistics(data, 2.0, 100.0, 0.0)
+
+    assert stats['z'] == 102.0
+    assert stats['fwhm_h'] == get_fwhm(data['bin_h_center'], data['histogram_h'])[0]
+    assert stats['fwhm_v'] == get_fwhm(data['bin_v_center'], data['histogram_v'])[0]
+    assert stats['center_h_shadow'] == 0.0
+    assert np.isnan(stats['fwhm_v_shadow'])
+
+def _run(beam, filename, shard=None):
+    return run_caustic(filename, beam, -50.0, 50.0, 13, 0.0, 1, 3, 23, 16, 12, [-0.03, 0.03], [-0.02, 0.02], shard=shard)
+
+def test_merge_shards(tmp_path, gaussian_beam):
+    beam = gaussian_beam(3000)
+    single = str(tmp_path / 'single.h5')
+    assert _run(beam, single)
+
+    shards = [str(tmp_path / 'caustic.shard{0}.h5'.format(i)) for i in range(3)]
+    for i, name in enumerate(shards):
+        assert _run(beam, name, shard=(i, 3))
+    with pytest.raises(ValueError):
+        merge_shards(shards[:2], str(tmp_path / 'missing.h5'))
+
+    merged = str(tmp_path / 'merged.h5')
+    merge_shards(shards[::-1], merged)
+
+    with CausticReader(single) as a, CausticReader(merged) as b:
+        assert b.attrs['status'] == 'complete'
+        np.testing.assert_array_equal(a.read_level(1), b.read_level(1))
+        np.testing.assert_array_equal(a.f['histoXZ'][()], b.f['histoXZ'][()])
+        np.testing.assert_array_equal(a.f['histoYZ'][()], b.f['histoYZ'][()])
+        assert sorted(a.pyramid_levels()) == sorted(b.pyramid_levels())
+        stats_a, stats_b = a.statistics(), b.statistics()
+        for name in PLANE_COLUMNS:
+            if name != 'elapsed_time':
+                np.testing.assert_allclose(stats_a[name], stats_b[name], rtol=1e-12, atol=1e-12)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import numpy as np
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic_cache import CausticSessionCache
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import CausticWriter
+
+
+def _write(filename, nz=6, n=8, seed=0):
+    planes = np.random.default_rng(seed).uniform(0, 1, (nz, n, n))
+    z_points = np.linspace(-1.0, 1.0, nz)
+    with CausticWriter(filename, z_points, 0.0, 1, 3, 23, n, n, [-1, 1], [-1, 1], 100) as writer:
+        for z, plane in zip(z_points, planes):
+            writer.append_plane(plane, {'z': z})
+    return planes
+
+def test_session_cache_lru(tmp_path):
+    filenames = [str(tmp_path / 'caustic{0}.h5'.format(i)) for i in range(3)]
+    planes = [_write(filename, seed=i) for i, filename in enumerate(filenames)]
+
+    cache = CausticSessionCache()
+    entry = cache.load(filenames[0])
+    assert cache.load(filenames[0]) is entry
+    np.testing.assert_array_equal(entry.read_plane(2), planes[0][2])
+
+    for filename in filenames:
+        cache.load(filename).projections()
+    assert cache.statistics()['entries'] == 3
+
+    # each entry now holds its cube: only the most recent ones fit
+    cache.max_bytes = 2 * entry.nbytes
+    cache.evict()
+    assert cache.statistics()['entries'] < 3
+    assert cache.statistics()['bytes'] <= cache.max_bytes
+
+def test_session_cache_threads(tmp_path):
+    filenames = [str(tmp_path / 'caustic{0}.h5'.format(i)) for i in range(3)]
+    for i, filename in enumerate(filenames):
+        _write(filename, seed=i)
+
+    cache = CausticSessionCache(max_bytes=10000)
+    errors = []
+
+    def worker(i):
+        try:
+            for n in range(30):
+                cache.load(filenames[(i + n) % len(filenames)]).projections()
+                if(n % 7 == 0):
+                    cache.clear()
+                cache.statistics()
+        except Exception as exception:
+            errors.append(exception)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import PLANE_COLUMNS, PYRAMID_FACTORS, CausticReader, CausticWriter, \
+    attach_shared_volume, pyramid_level, read_shared_volume, read_volume, volume_level, write_pyramid
+from orangecontrib.shadow.lnls.widgets.utility.histogram import rebin_planes
+
+
+NX, NY = 12, 10
+XRANGE = [-1.0, 1.0]
+YRANGE = [-2.0, 2.0]
+Z_OFFSET = 100.0
+
+def _planes(nz, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, 10, (nz, NX, NY))
+
+def _stats(i, z):
+    stats = {name: float(i) + k / 100.0 for k, name in enumerate(PLANE_COLUMNS)}
+    stats['z'] = z + Z_OFFSET
+    return stats
+
+def _writer(filename, z_points, chunks=None, background=False, **kwargs):
+    return CausticWriter(filename, z_points, Z_OFFSET, 1, 3, 23, NX, NY, XRANGE, YRANGE, 1000, chunks=chunks, background=background, **kwargs)
+
+def _write(filename, z_points, planes, chunks=None, background=False):
+    with _writer(filename, z_points, chunks, background) as writer:
+        for i, plane in enumerate(planes):
+            writer.append_plane(plane, _stats(i, z_points[i]))
+
+@pytest.mark.parametrize('background', [False, True])
+def test_round_trip(tmp_path, background):
+    filename = str(tmp_path / 'caustic.h5')
+    z_points = np.linspace(-5.0, 5.0, 19)
+    planes = _planes(len(z_points))
+    _write(filename, z_points, planes, chunks=(4, 6, 5), background=background)
+
+    with CausticReader(filename) as reader:
+        assert reader.version == 2
+        assert reader.nz == len(z_points)
+        np.testing.assert_allclose(reader.z_points(), z_points)
+        for i in range(reader.nz):
+            np.testing.assert_array_equal(reader.read_plane(i), planes[i])
+
+        slabs = list(reader.iter_slabs())
+        assert [start for start, slab in slabs] == [0, 4, 8, 12, 16]
+        np.testing.assert_array_equal(np.concatenate([slab for start, slab in slabs]), planes)
+
+        stats = reader.statistics()
+        for name in PLANE_COLUMNS:
+            if name != 'z':
+                np.testing.assert_allclose(stats[name], [_stats(i, z)[name] for i, z in enumerate(z_points)])
+
+        histoH, histoV = reader.projections()
+        np.testing.assert_allclose(histoH, planes.sum(axis=2).transpose())
+        np.testing.assert_allclose(histoV, planes.sum(axis=1).transpose())
+
+        assert reader.attrs['status'] == 'complete'
+
+def test_partial_file(tmp_path):
+    # a scan stopped after 5 of 40 planes, with slabs of 8 planes
+    filename = str(tmp_path / 'partial.h5')
+    z_points = np.linspace(-5.0, 5.0, 40)
+    planes = _planes(5)
+    _write(filename, z_points, planes, chunks=(8, NX, NY))
+
+    with CausticReader(filename) as reader:
+        assert reader.attrs['status'] == 'incomplete'
+        np.testing.assert_array_equal(reader.read_plane(4), planes[4])
+
+        slabs = list(reader.iter_slabs())
+        assert sum(len(slab) for start, slab in slabs) == reader.nz
+        np.testing.assert_array_equal(slabs[0][1][:5], planes)
+
+        histoH, histoV = reader.projections()
+        assert histoH.shape == (NX, reader.nz)
+        assert histoV.shape == (NY, reader.nz)
+        np.testing.assert_allclose(histoH[:, :5], planes.sum(axis=2).transpose())
+
+def test_writer_thread_error_is_raised(tmp_path):
+    z_points = np.linspace(-5.0, 5.0, 8)
+    planes = _planes(3)
+
+    # a plane of the wrong shape fails in the writer thread
+    writer = _writer(str(tmp_path / 'cancelled.h5'), z_points, chunks=(2, NX, NY), background=True)
+    writer.append_plane(planes[0], _stats(0, z_points[0]))
+    writer.append_plane(planes[1][:, :3], _stats(1, z_points[1]))
+    with pytest.raises(ValueError):
+        writer.close(status='cancelled')
+
+    with CausticReader(str(tmp_path / 'cancelled.h5')) as reader:
+        assert reader.attrs['status'] == 'failed'
+
+    # while another exception stops the scan, the writer error is chained to it
+    with pytest.raises(ValueError) as info:
+        with _writer(str(tmp_path / 'failed.h5'), z_points, chunks=(2, NX, NY), background=True) as writer:
+            writer.append_plane(planes[0], _stats(0, z_points[0]))
+            writer.append_plane(planes[1][:, :3], _stats(1, z_points[1]))
+            raise KeyError('scan stopped')
+    assert isinstance(info.value.__context__, KeyError)
+
+def test_resume(tmp_path):
+    filename = str(tmp_path / 'resumed.h5')
+    z_points = np.linspace(-5.0, 5.0, 30)
+    planes = _planes(len(z_points))
+
+    # a run interrupted after 11 planes, in slabs of 4 planes
+    with _writer(filename, z_points, chunks=(4, NX, NY), resume=True, fingerprint='abc') as writer:
+        assert writer.start == 0
+        for i in range(11):
+            writer.append_plane(planes[i], _stats(i, z_points[i]))
+
+    # the partial slab (planes 8 to 10) is computed again
+    with _writer(filename, z_points, chunks=(4, NX, NY), resume=True, fingerprint='abc') as writer:
+        assert writer.start == 8
+        for i in range(writer.start, len(z_points)):
+            writer.append_plane(planes[i], _stats(i, z_points[i]))
+    assert writer.complete
+
+    with CausticReader(filename) as reader:
+        assert reader.attrs['status'] == 'complete'
+        assert reader.nz == len(z_points)
+        np.testing.assert_array_equal(np.concatenate([slab for start, slab in reader.iter_slabs()]), planes)
+        np.testing.assert_allclose(reader.statistics()['rms_h'], [_stats(i, z)['rms_h'] for i, z in enumerate(z_points)])
+
+    # the file of another beam is overwritten
+    with _writer(filename, z_points, chunks=(4, NX, NY), resume=True, fingerprint='def') as writer:
+        assert writer.start == 0
+
+def test_pyramid(tmp_path):
+    filename = str(tmp_path / 'pyramid.h5')
+    z_points = np.linspace(-5.0, 5.0, 21)
+    planes = _planes(len(z_points))
+    _write(filename, z_points, planes, chunks=(4, 6, 5))
+
+    histoH, histoV = write_pyramid(filename)
+    np.testing.assert_allclose(histoH, planes.sum(axis=2).transpose())
+    np.testing.assert_allclose(histoV, planes.sum(axis=1).transpose())
+
+    with CausticReader(filename) as reader:
+        levels = reader.pyramid_levels()
+        assert sorted(levels) == [1] + list(PYRAMID_FACTORS)
+        for factor in PYRAMID_FACTORS:
+            # binned in x and y only: every plane is kept
+            z, ranges = levels[factor]
+            np.testing.assert_allclose(z, z_points)
+            assert (ranges[4], ranges[5]) == (-(-NX // factor), -(-NY // factor))
+            np.testing.assert_allclose(reader.read_level(factor), rebin_planes(planes, factor))
+            np.testing.assert_allclose(reader.read_level(factor, 7), rebin_planes(planes[7:8], factor)[0])
+
+    # x and y are chosen on their own, and z does not constrain the level
+    assert pyramid_level(levels, nx=3, ny=3) == 4
+    assert pyramid_level(levels, nx=3, ny=4) == 2
+    assert pyramid_level(levels, nx=13) == 1
+    assert pyramid_level(levels) == 8
+    assert volume_level(levels, 3) == (4, 7)
+    assert volume_level(levels, 30) == (1, 1)
+
+def test_read_volume(tmp_path):
+    filename = str(tmp_path / 'volume.h5')
+    z_points = np.linspace(-5.0, 5.0, 21)
+    planes = _planes(len(z_points))
+    _write(filename, z_points, planes, chunks=(4, 6, 5))
+    write_pyramid(filename)
+
+    with CausticReader(filename) as reader:
+        volume, z = read_volume(reader)
+        np.testing.assert_allclose(volume, planes.transpose(0, 2, 1))
+        np.testing.assert_allclose(z, z_points)
+
+        # level 2 in x and y, planes averaged by 3 in z
+        volume, z = read_volume(reader, factor=2, z_step=3, reverse_xy=True)
+        binned = rebin_planes(planes, 2)[:, ::-1, ::-1]
+        expected = [binned[i:i + 3].mean(axis=0).transpose() for i in range(0, len(z_points), 3)]
+        np.testing.assert_allclose(volume, expected)
+        np.testing.assert_allclose(z, [z_points[i:i + 3].mean() for i in range(0, len(z_points), 3)])
+
+        volume, z = read_volume(reader, max_voxels=300)
+        assert volume.size <= 300
+
+def test_shared_volume(tmp_path):
+    filename = str(tmp_path / 'shared.h5')
+    z_points = np.linspace(-5.0, 5.0, 21)
+    _write(filename, z_points, _planes(len(z_points)), chunks=(4, 6, 5))
+    write_pyramid(filename)
+
+    with CausticReader(filename) as reader:
+        expected, z = read_volume(reader, factor=2, z_step=3, reverse_xy=True)
+        shm, volume, z_shared = read_shared_volume(reader, factor=2, z_step=3, reverse_xy=True)
+    try:
+        np.testing.assert_array_equal(volume, expected)
+        np.testing.assert_allclose(z_shared, z)
+        attached, mapped = attach_shared_volume(shm.name, volume.shape, volume.dtype.str)
+        np.testing.assert_array_equal(mapped, expected)
+        del mapped
+        attached.close()
+    finally:
+        del volume
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from orangecontrib.shadow.lnls.widgets.utility.histogram import bin_indices, fwhm_stack, get_fwhm, histogram1d_stack, histogram2d_stack
+
+
+XRANGE = [-1.0, 1.0]
+YRANGE = [-0.5, 1.5]
+
+def _batches(nbatch=4, nrays=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    h = rng.normal(0, 0.6, (nbatch, nrays))
+    v = rng.normal(0.5, 0.6, (nbatch, nrays))
+    # values exactly on the edges of the range and of inner bins
+    h[:, :4] = [XRANGE[0], XRANGE[1], 0.0, 0.5]
+    v[:, :4] = [YRANGE[1], YRANGE[0], 0.5, 1.0]
+    return h, v, rng.uniform(0.1, 1.0, nrays)
+
+@pytest.mark.parametrize('use_weights', [True, False])
+def test_histogram2d_stack_matches_numpy(use_weights):
+    h, v, weights = _batches()
+    if not use_weights:
+        weights = None
+
+    stack = histogram2d_stack(h, v, weights, XRANGE, YRANGE, 25, 17)
+    assert stack['histogram'].shape == (len(h), 25, 17)
+
+    for i in range(len(h)):
+        reference, h_edges, v_edges = np.histogram2d(h[i], v[i], bins=[25, 17], range=[XRANGE, YRANGE], weights=weights)
+        np.testing.assert_allclose(stack['histogram'][i], reference, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(stack['histogram_h'][i], reference.sum(axis=1), rtol=1e-12)
+        np.testing.assert_allclose(stack['histogram_v'][i], reference.sum(axis=0), rtol=1e-12)
+        np.testing.assert_allclose(stack['bin_h_edges'], h_edges)
+        np.testing.assert_allclose(stack['bin_v_edges'], v_edges)
+
+def test_histogram2d_stack_per_batch_weights():
+    h, v, weights = _batches(nbatch=3)
+    weights = np.outer([1.0, 2.0, 0.5], weights)
+    stack = histogram2d_stack(h, v, weights, XRANGE, YRANGE, 10, 10)
+    for i in range(len(h)):
+        reference = np.histogram2d(h[i], v[i], bins=[10, 10], range=[XRANGE, YRANGE], weights=weights[i])[0]
+        np.testing.assert_allclose(stack['histogram'][i], reference, rtol=1e-12)
+
+def test_histogram2d_stack_single_batch():
+    h, v, weights = _batches(nbatch=1)
+    stack = histogram2d_stack(h[0], v[0], weights, XRANGE, YRANGE, 8, 6, dtype=np.float32)
+    reference = np.histogram2d(h[0], v[0], bins=[8, 6], range=[XRANGE, YRANGE], weights=weights)[0]
+    assert stack['histogram'].dtype == np.float32
+    np.testing.assert_allclose(stack['histogram'][0], reference, rtol=1e-6)
+
+@pytest.mark.parametrize('use_weights', [True, False])
+def test_histogram1d_stack_matches_numpy(use_weights):
+    h, v, weights = _batches()
+    if not use_weights:
+        weights = None
+
+    profiles = histogram1d_stack(h, weights, XRANGE, 25)
+    assert profiles.shape == (len(h), 25)
+    for i in range(len(h)):
+        reference = np.histogram(h[i], bins=25, range=XRANGE, weights=weights)[0]
+        np.testing.assert_allclose(profiles[i], reference, rtol=1e-12)
+
+def test_bin_indices_out_of_range():
+    x = np.array([-1.5, -1.0, 1.0, 1.5, np.nan])
+    np.testing.assert_array_equal(bin_indices(x, XRANGE, 4), [4, 0, 3, 4, 4])
+
+def _profiles(nbins=60, nz=40, seed=0):
+    # Poisson-noisy Gaussians, with samples exactly at half maximum, flat
+    # tops, peaks at the edges and an empty profile
+    rng = np.random.default_rng(seed)
+    x = np.linspace(-1, 1, nbins)
+    center = rng.uniform(-1.2, 1.2, (nz, 1))
+    sigma = rng.uniform(0.03, 0.5, (nz, 1))
+    profiles = rng.poisson(20 * np.exp(-0.5 * np.square((x - center) / sigma))).astype(np.float64)
+    profiles[0] = 0.0
+    profiles[1, 20:25] = 10.0
+    return x, profiles
+
+@pytest.mark.parametrize('oversampling', [1, 200, 3.5])
+def test_fwhm_stack_matches_get_fwhm(oversampling):
+    x, profiles = _profiles()
+    result = np.array(fwhm_stack(x, profiles, oversampling=oversampling)).transpose()
+    for profile, row in zip(profiles, result):
+        if(profile.argmax() == len(profile) - 2):
+            continue # get_fwhm fails there
+        np.testing.assert_array_equal(row, get_fwhm(x, profile, oversampling=oversampling)[:3])
+
+def test_fwhm_stack_unsorted_grid():
+    # the cuts of plot_shadow_caustic have an edge point inserted before the last one
+    x, profiles = _profiles(nz=10, seed=1)
+    x = np.insert(x, -1, 1.05)
+    profiles = np.insert(profiles, -1, 0.0, axis=1)
+    fwhm = fwhm_stack(x, profiles, oversampling=200)[0]
+    np.testing.assert_array_equal(fwhm, [get_fwhm(x, profile, oversampling=200)[0] for profile in profiles])
+
+def test_fwhm_stack_inmost():
+    x = np.arange(12.0)
+    profile = [0, 5, 6, 0, 0, 2, 8, 10, 9, 3, 0, 0]
+    fwhm, x_left, x_right = fwhm_stack(x, profile)
+    assert (x_left[0], x_right[0]) == (3.0, 8.0)
+    # the scan starts after the last sample at or below half maximum
+    fwhm, x_left, x_right = fwhm_stack(x, profile, inmost_outmost=0)
+    assert (x_left[0], x_right[0]) == (6.0, 8.0)
@@ -3,16 +3,70 @@
 # License: BSD Style.
 
 import numpy as np
-import h5py
 import optparse
 
+import collections
 import sys
+import time
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 import pyvista as pv
 from pyvistaqt import QtInteractor, MainWindow
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication, QGridLayout, QWidget
 
+from orangecontrib.shadow.lnls.widgets.utility.caustic_io import CausticReader, attach_shared_volume, read_volume, volume_level
+
+
+def peak_memory():
+    """
+    ', peak memory X MB' where the peak resident memory of the process is
+    known (Linux and macOS), '' otherwise.
+    """
+    if resource is None:
+        return ''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return ', peak memory {0:.1f} MB'.format(peak / 1024**2 if sys.platform == 'darwin' else peak / 1024)
+
+def lod_step(shape, max_voxels):
+    """
+    Smallest integer step that decimates a volume of shape to at most
+    max_voxels.
+    """
+    step = 1
+    while np.prod([-(-n // step) for n in shape]) > max_voxels:
+        step += 1
+    return step
+
+def block_mean(volume, step):
+    """
+    Mean of the step x step x step blocks of an (nx, ny, nz) volume (partial
+    blocks at the edges included), computed plane group by plane group so
+    that no full-size temporary is made.
+    """
+    planes = volume.transpose()
+    nz, ny, nx = planes.shape
+    y_starts, x_starts = np.arange(0, ny, step), np.arange(0, nx, step)
+    counts = np.outer(np.diff(np.append(y_starts, ny)), np.diff(np.append(x_starts, nx)))
+    
+    lod = np.empty((-(-nz // step), len(y_starts), len(x_starts)))
+    for i, start in enumerate(range(0, nz, step)):
+        group = planes[start:start + step].mean(axis=0)
+        group = np.add.reduceat(np.add.reduceat(group, y_starts, axis=0), x_starts, axis=1)
+        lod[i] = group / counts
+    return lod.transpose()
+
+# index of the volume axis of each slice
+SLICE_AXES = {'x': 0, 'y': 1, 'z': 2}
+# camera zoom of the slice views
+SLICE_ZOOM = {'x': 2, 'y': 2, 'z': 1.3}
+
 class VolumeSlicerPyVista(MainWindow):
-    def __init__(self, data, parent=None):
+    def __init__(self, data, lod_voxels=2e6, idle_delay=0.3, parent=None):
         super().__init__(parent)
         
         self.setWindowTitle("Volume Slicer (PyVista)")
@@ -22,7 +76,39 @@ class VolumeSlicerPyVista(MainWindow):
 
         self.data = pv.ImageData()
         self.data.dimensions = data.shape
-        self.data.point_data["values"] = data.flatten(order="F")  
+        # no copy for (nx, ny, nz) views of (nz, ny, nx) arrays, as read_volume gives
+        self.data.point_data["values"] = np.ravel(data, order="F")  
+        self.volume = data
+
+        # decimated copy rendered while the 3D view is interacted with
+        self.lod_step = lod_step(data.shape, lod_voxels)
+        self.lod_data = None
+        if(self.lod_step > 1):
+            self.lod_data = pv.ImageData()
+            lod = block_mean(data, self.lod_step)
+            self.lod_data.dimensions = lod.shape
+            self.lod_data.spacing = [self.lod_step * d for d in self.data.spacing]
+            self.lod_data.origin = [o + 0.5 * (self.lod_step - 1) * d for o, d in zip(self.data.origin, self.data.spacing)]
+            self.lod_data.point_data["values"] = np.ravel(lod, order="F")
+        self.lod_active = False
+        self.lod_timer = QTimer(self)
+        self.lod_timer.setSingleShot(True)
+        self.lod_timer.setInterval(int(1000 * idle_delay))
+        self.lod_timer.timeout.connect(self.render_full_volume)
+
+        # end times and durations of the last renders of the 3D view
+        self.frame_times = collections.deque(maxlen=30)
+        self.render_start = 0.0
+
+        # slice meshes, actors and indices, updated in place by the plane widgets
+        self.slices = {}
+        self.pending_slices = {}
+        # at most one slice update per frame of the display
+        rate = QApplication.primaryScreen().refreshRate() if QApplication.primaryScreen() is not None else 0
+        self.slice_timer = QTimer(self)
+        self.slice_timer.setSingleShot(True)
+        self.slice_timer.setInterval(int(1000 / (rate if rate > 0 else 60)))
+        self.slice_timer.timeout.connect(self.apply_slices)
 
         # The 4 views displayed
         self.scene3d = QtInteractor(self)
@@ -39,6 +125,60 @@ class VolumeSlicerPyVista(MainWindow):
         self.make_3d_view()
         self.make_side_view()
         
+        self.scene3d.ren_win.AddObserver('StartEvent', self.start_render)
+        self.scene3d.ren_win.AddObserver('EndEvent', self.end_render)
+        
+    def start_render(self, obj, event):
+        """
+        Picks the volume of the next frame: the decimated copy while the
+        camera or a plane widget moves (VTK then asks for an interactive
+        update rate), and for the still frame that ends an interaction, so
+        that the full volume is rendered only after idle_delay without
+        interaction.
+        """
+        self.render_start = time.perf_counter()
+        if(self.lod_data is None):
+            return
+        interactive = obj.GetDesiredUpdateRate() > obj.GetInteractor().GetStillUpdateRate()
+        if(interactive or self.lod_active):
+            self.lod_active = True
+            self.lod_timer.start()
+        self.volume_actor.SetVisibility(not self.lod_active)
+        self.lod_actor.SetVisibility(self.lod_active)
+
+    def end_render(self, obj, event):
+        """
+        Updates the readout of the 3D view: frame rate over the renders of
+        the last second and duration of the last render.
+        """
+        now = time.perf_counter()
+        self.frame_times.append(now)
+        recent = [t for t in self.frame_times if now - t < 1.0]
+        fps = (len(recent) - 1) / (recent[-1] - recent[0]) if len(recent) > 1 else 0.0
+        level = 'LOD 1/{0}'.format(self.lod_step) if self.lod_active else 'full'
+        self.readout.SetText(3, '{0}: {1:.1f} fps, {2:.0f} ms'.format(level, fps, 1e3 * (now - self.render_start)))
+
+    def render_full_volume(self):
+        self.lod_active = False
+        self.scene3d.render()
+
+    def report_first_frame(self, t0, quit=False):
+        """
+        Prints the time from t0 (e.g. the click on the widget button) to the
+        end of the first render of the 3D view; with quit, the application
+        then exits (headless tests).
+        """
+        def on_render(obj, event):
+            if self._first_frame:
+                return
+            self._first_frame = True
+            print('First frame {0:.2f} s after launch'.format(time.time() - t0), flush=True)
+            if quit:
+                QApplication.instance().quit()
+
+        self._first_frame = False
+        self.scene3d.ren_win.AddObserver('EndEvent', on_render)
+
     def reset_views(self):
         self.make_3d_view()
         self.make_side_view()
@@ -48,7 +188,13 @@ class VolumeSlicerPyVista(MainWindow):
         self.scene3d.clear_plane_widgets()
         
         self.scene3d.add_text("3D View", font_size=10)
-        self.scene3d.add_volume(self.data, cmap="viridis", opacity="linear", show_scalar_bar=False) 
+        clim = self.data.get_data_range()
+        self.volume_actor = self.scene3d.add_volume(self.data, cmap="viridis", opacity="linear", clim=clim, show_scalar_bar=False, name='volume')
+        if(self.lod_data is not None):
+            # same color and opacity mapping as the full volume
+            self.lod_actor = self.scene3d.add_volume(self.lod_data, cmap="viridis", opacity="linear", clim=clim, show_scalar_bar=False, name='volume_lod')
+            self.lod_actor.SetVisibility(False)
+        self.readout = self.scene3d.add_text("", font_size=8, position="upper_right", name='readout')
         self.scene3d.add_checkbox_button_widget(callback=lambda value: self.reset_views(), position=(850, 40), size=30, value=False)
         self.scene3d.add_text("Reset Views", font_size=10, position=("lower_right"))
         
@@ -63,78 +209,168 @@ class VolumeSlicerPyVista(MainWindow):
         center = self.data.center
         
         self.scene_x.add_text("Cross section YZ Plane (X slice)", font_size=12)
-        self.scene_x.add_mesh(self.data.slice(normal='x', origin=center), name='slice_x', cmap="viridis", show_scalar_bar=False, reset_camera = True)
+        self.add_slice(self.scene_x, 'x', center)
         self.scene_x.disable()
         self.scene_x.view_yz()
-        self.scene_x.zoom_camera(2)
+        self.scene_x.zoom_camera(SLICE_ZOOM['x'])
         
         self.scene_y.add_text("XZ Plane (Y slice)", font_size=10)
-        self.scene_y.add_mesh(self.data.slice(normal='y', origin=center), name='slice_y', cmap="viridis", show_scalar_bar=False, reset_camera = True)
+        self.add_slice(self.scene_y, 'y', center)
         self.scene_y.disable()
         self.scene_y.view_xz()
-        self.scene_y.zoom_camera(2)
+        self.scene_y.zoom_camera(SLICE_ZOOM['y'])
         
         self.scene_z.add_text("XY Plane (Z slice)", font_size=10)
-        self.scene_z.add_mesh(self.data.slice(normal='z', origin=center), name='slice_z', cmap="viridis", show_scalar_bar=False, reset_camera = True)
+        self.add_slice(self.scene_z, 'z', center)
         self.scene_z.disable()
         self.scene_z.view_xy()
-        self.scene_z.zoom_camera(1.3)
+        self.scene_z.zoom_camera(SLICE_ZOOM['z'])
+
+    def slice_index(self, axis, origin):
+        k = SLICE_AXES[axis]
+        index = int(round((origin[k] - self.data.origin[k]) / self.data.spacing[k]))
+        return min(max(index, 0), self.volume.shape[k] - 1)
+
+    def slice_values(self, axis, index):
+        """
+        Plane index of the volume along axis, straight from the array, with
+        the point order of a one-voxel thick ImageData.
+        """
+        cut = [slice(None)] * 3
+        cut[SLICE_AXES[axis]] = slice(index, index + 1)
+        return np.ravel(self.volume[tuple(cut)], order="F")
+
+    def add_slice(self, scene, axis, origin):
+        """
+        Adds the slice through origin normal to axis to scene, as an image
+        actor whose scalars are updated in place by set_slice.
+        """
+        k = SLICE_AXES[axis]
+        index = self.slice_index(axis, origin)
+        dimensions = list(self.volume.shape)
+        dimensions[k] = 1
+        mesh = pv.ImageData(dimensions=dimensions, spacing=self.data.spacing, origin=self.data.origin)
+        mesh.point_data["values"] = self.slice_values(axis, index)
+        self.move_slice(mesh, axis, index)
+        actor = scene.add_mesh(mesh, name='slice_' + axis, cmap="viridis", show_scalar_bar=False, reset_camera=True)
+        self.slices[axis] = [mesh, actor, scene, index]
+
+    def move_slice(self, mesh, axis, index):
+        k = SLICE_AXES[axis]
+        origin = list(self.data.origin)
+        origin[k] += index * self.data.spacing[k]
+        mesh.origin = origin
+
+    def set_slice(self, axis, index):
+        """
+        Shows plane index along axis: the values of the existing slice mesh
+        are overwritten, and its color range rescaled, without new VTK
+        objects.
+        """
+        mesh, actor, scene, current = self.slices[axis]
+        if(index == current):
+            return
+        values = self.slice_values(axis, index)
+        mesh.point_data["values"][:] = values
+        self.move_slice(mesh, axis, index)
+        mesh.Modified()
+        actor.mapper.scalar_range = (values.min(), values.max())
+        self.slices[axis][3] = index
+        scene.render()
+
+    def request_slice(self, axis, normal, origin):
+        """
+        Plane widget callback. Axis-aligned planes are queued and drawn by
+        apply_slices at the display refresh rate; oblique planes go through
+        the VTK slice filter.
+        """
+        k = SLICE_AXES[axis]
+        if(not np.allclose(np.abs(normal), np.eye(3)[k])):
+            scene = getattr(self, 'scene_' + axis)
+            scene.add_mesh(self.data.slice(normal=normal, origin=origin), name='slice_' + axis, cmap="viridis", show_scalar_bar=False, reset_camera = True)
+            scene.zoom_camera(SLICE_ZOOM[axis])
+            # the image actor was replaced
+            self.slices.pop(axis, None)
+            return
+        
+        self.pending_slices[axis] = origin
+        if(not self.slice_timer.isActive()):
+            self.slice_timer.start()
+
+    def apply_slices(self):
+        for axis, origin in self.pending_slices.items():
+            if(axis in self.slices):
+                self.set_slice(axis, self.slice_index(axis, origin))
+            else:
+                scene = getattr(self, 'scene_' + axis)
+                self.add_slice(scene, axis, origin)
+                scene.zoom_camera(SLICE_ZOOM[axis])
+        self.pending_slices.clear()
 
     def update_x_slice(self, normal, origin):
-        self.scene_x.add_mesh(self.data.slice(normal=normal, origin=origin), name='slice_x', cmap="viridis", show_scalar_bar=False, reset_camera = True)
-        self.scene_x.zoom_camera(2)
+        self.request_slice('x', normal, origin)
         
     def update_y_slice(self, normal, origin):
-        self.scene_y.add_mesh(self.data.slice(normal=normal, origin=origin), name='slice_y', cmap="viridis", show_scalar_bar=False, reset_camera = True)
-        self.scene_y.zoom_camera(2)
+        self.request_slice('y', normal, origin)
         
     def update_z_slice(self, normal, origin):
-        self.scene_z.add_mesh(self.data.slice(normal=normal, origin=origin), name='slice_z', cmap="viridis", show_scalar_bar=False, reset_camera = True)
-        self.scene_z.zoom_camera(1.3)
+        self.request_slice('z', normal, origin)
 
 if __name__=='__main__':
 
     p = optparse.OptionParser()
     p.add_option('-f', '--infile', dest='infile', metavar='FILE', default='', help='input file name')
+    p.add_option('-r', '--resolution', dest='resolution', type='int', default=0,
+                 help='voxels to fill along each axis: x and y from the coarsest pyramid level with at least as many bins, z averaged in groups of planes (0: full resolution)')
+    p.add_option('-m', '--max-voxels', dest='max_voxels', type='float', default=0,
+                 help='voxel budget: the volume is decimated while it is read to fit (0: no limit)')
+    p.add_option('--shm', dest='shm', default='',
+                 help='name of a shared memory block with the volume (instead of -f), mapped without a copy')
+    p.add_option('--shape', dest='shape', default='', help='nz,ny,nx of the shared volume')
+    p.add_option('--dtype', dest='dtype', default='float64', help='data type of the shared volume')
+    p.add_option('--t0', dest='t0', type='float', default=0,
+                 help='launch time (seconds since the epoch) for the time to first frame')
+    p.add_option('--lod-voxels', dest='lod_voxels', type='float', default=2e6,
+                 help='voxel budget of the decimated volume rendered while interacting with the 3D view')
+    p.add_option('--idle-delay', dest='idle_delay', type='float', default=0.3,
+                 help='seconds without interaction before the full volume is rendered')
+    p.add_option('--exit-after-first-frame', dest='exit_after_first_frame', action='store_true', default=False,
+                 help='quit once the first frame is rendered (headless tests)')
     opt, args = p.parse_args()    
     
-    filename=opt.infile
-
-    with h5py.File(filename, 'r+') as f:
+    t0 = opt.t0 or time.time()
+    shm = None
+    if(opt.shm):
+        shape = tuple(int(n) for n in opt.shape.split(','))
+        shm, volume = attach_shared_volume(opt.shm, shape, opt.dtype)
+        print('Mapped {0} x {1} x {2} voxels from shared memory, {3:.1f} MB{4}'.format(volume.shape[2], volume.shape[1], volume.shape[0],
+                                                                                     volume.nbytes/1024**2, peak_memory()))
+    else:
+        filename=opt.infile
+        with CausticReader(filename) as reader:
             
-        zStart = f.attrs['zStart']
-        zFin = f.attrs['zFin']
-        nz = f.attrs['nz']
-        
-        dset_names = list(f.keys())
-        
-        #####################
-        # find maximum ranges
-        #####################
-        xy_range = np.zeros((len(dset_names), 4))
-        dset = dset_names[2]
-        xS, xF, nx =  f[dset].attrs['xStart'], f[dset].attrs['xFin'], f[dset].attrs['nx']
-        yS, yF, ny =  f[dset].attrs['yStart'], f[dset].attrs['yFin'], f[dset].attrs['ny']
-        
-        x_array = np.linspace(xS, xF, nx)[::-1]
-        y_array = np.linspace(yS, yF, ny)[::-1]
-        z_array = np.linspace(zStart, zFin, nz)
-        
-        for i in range(len(dset_names)-2):
-                        
-            dset = dset_names[i+2]
-            mtx = np.array(f[dset])
-            mtx = mtx[:,::-1][::-1,:]            
+            factor, z_step = 1, 1
+            if(opt.resolution > 0):
+                factor, z_step = volume_level(reader.pyramid_levels(), opt.resolution)
             
-            if i==0:
-                values = mtx
-            else:
-                values = np.dstack((values,mtx))
+            # preallocated and filled slab by slab; the viewer shows x and y reversed
+            volume, z_array = read_volume(reader, factor=factor, z_step=z_step, max_voxels=int(opt.max_voxels) or None, reverse_xy=True)
+        
+        print('Loaded {0} x {1} x {2} voxels (pyramid level {3}, planes averaged by {4}) in {5:.2f} s, {6:.1f} MB{7}'.format(
+              volume.shape[2], volume.shape[1], volume.shape[0], factor, z_step, time.time() - t0, volume.nbytes/1024**2, peak_memory()))
+    # the launcher may release its handle of the shared memory from now on
+    print('VIEWER READY', flush=True)
+    
     #x, y, z = np.ogrid[-5:5:64j, -5:5:64j, -5:5:64j]
     #data = np.sin(3*x)/x + 0.05*z**2 + np.cos(3*y)        
-    data = values
+    data = volume.transpose()
     
     app = QApplication(sys.argv)
-    window = VolumeSlicerPyVista(data)
+    window = VolumeSlicerPyVista(data, lod_voxels=opt.lod_voxels, idle_delay=opt.idle_delay)
+    window.report_first_frame(t0, quit=opt.exit_after_first_frame)
     window.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    status = app.exec()
+    
+    if shm is not None:
+        shm.close()
+    sys.exit(status)
@@ -96,6 +96,9 @@ ENTRY_POINTS = {
         "Shadow LNLS Utility = orangecontrib.shadow.lnls.widgets.utility",
     ),
     "oasys.menus": ("shadowlnlsmenu = orangecontrib.shadow.lnls.menu",),
+    "console_scripts": (
+        "oasys-lnls-caustic = orangecontrib.shadow.lnls.widgets.utility.caustic_batch:main",
+    ),
 }
 
 if __name__ == "__main__":